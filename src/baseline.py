@@ -0,0 +1,159 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+
+from typing import List, Tuple, Union
+
+from .timeseries import time_of_day_seconds
+from .profiling import profiled
+
+
+# Baseline Profiles
+# The "normal" behaviour of every series is summarised once from the train day, per time-of-day bucket,
+# so that comparisons and anomaly checks look a baseline up instead of rescanning the train frames
+DEFAULT_QUANTILES = (0.05, 0.25, 0.75, 0.95)
+ESB_VALUE_COLUMNS = ['avg_time', 'num', 'succee_num', 'succee_rate']
+
+
+class BaselineProfile:
+    '''
+    Time-of-day profiles of many series, stored as a single (series x bucket x statistic) float32 array:
+    - keys: the key tuple of every series (e.g. (cmdb_id, name) for host KPIs, (serviceName, column) for ESB)
+    - stats: the statistic names (count, mean, std, median, mad, and one 'q<percent>' per quantile)
+    - bucket_seconds: the size of the time-of-day buckets, bucket b covering [b * bucket_seconds, (b + 1) * bucket_seconds) seconds past 00:00
+
+    Buckets without any sample are NaN (with a count of 0). lookup() is O(1), through a dictionary from key to row.
+    '''
+
+    def __init__(self, keys: List[Tuple[str, ...]], key_names: List[str], stats: List[str], values: np.ndarray, bucket_seconds: int):
+        self.keys = [tuple(key) for key in keys]
+        self.key_names = list(key_names)
+        self.stats = list(stats)
+        self.values = values
+        self.bucket_seconds = int(bucket_seconds)
+
+        self._rows = {key: row for row, key in enumerate(self.keys)}
+        self._columns = {stat: column for column, stat in enumerate(self.stats)}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Tuple[str, ...]) -> bool:
+        return tuple(key) in self._rows
+
+    @property
+    def n_buckets(self) -> int:
+        return self.values.shape[1]
+
+    def bucket(self, seconds_past: float) -> int:
+        '''
+        Return the bucket holding seconds_past (seconds past 00:00, as in data/failures.json).
+        '''
+        return int(seconds_past // self.bucket_seconds) % self.n_buckets
+
+    def lookup(self, key: Tuple[str, ...], seconds_past: float, stat: str = None) -> Union[dict, float]:
+        '''
+        Return the statistics of series key at seconds_past as a dictionary, or a single statistic if stat is given.
+        Raise KeyError if the series has no profile.
+        '''
+        values = self.values[self._rows[tuple(key)], self.bucket(seconds_past)]
+        if stat is not None:
+            return float(values[self._columns[stat]])
+
+        return dict(zip(self.stats, values.tolist()))
+
+    def series(self, key: Tuple[str, ...]) -> pd.DataFrame:
+        '''
+        Return the whole day profile of series key, indexed by the bucket start (seconds past 00:00).
+        '''
+        index = pd.Index(np.arange(self.n_buckets) * self.bucket_seconds, name='seconds_past')
+        return pd.DataFrame(self.values[self._rows[tuple(key)]], index=index, columns=self.stats)
+
+    def frame(self, seconds_past: float) -> pd.DataFrame:
+        '''
+        Return the statistics of every series at seconds_past, indexed by key (e.g. a baseline for rca.score_host()).
+        '''
+        index = pd.MultiIndex.from_tuples(self.keys, names=self.key_names)
+        return pd.DataFrame(self.values[:, self.bucket(seconds_past)], index=index, columns=self.stats)
+
+    def save(self, path: str) -> None:
+        '''
+        Save the profile to a single uncompressed .npz file (no pickled objects).
+        '''
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+
+        np.savez(path,
+                 keys=np.array(self.keys, dtype=str).reshape(len(self.keys), len(self.key_names)),
+                 key_names=np.array(self.key_names, dtype=str),
+                 stats=np.array(self.stats, dtype=str),
+                 values=self.values,
+                 bucket_seconds=np.array(self.bucket_seconds))
+
+    @classmethod
+    def load(cls, path: str) -> 'BaselineProfile':
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['keys'].tolist(), data['key_names'].tolist(), data['stats'].tolist(), data['values'], int(data['bucket_seconds']))
+
+
+@profiled('compute')
+def build_profile(df: pd.DataFrame,
+                  time_column: str,
+                  key_columns: List[str],
+                  value_column: str,
+                  bucket: str = '10min',
+                  quantiles: List[float] = DEFAULT_QUANTILES) -> BaselineProfile:
+    '''
+    Build the time-of-day profile of every series (unique key_columns) of a long dataframe, in vectorized groupby passes
+    over (series, bucket) codes.
+    '''
+    bucket_seconds = int(pd.Timedelta(bucket).total_seconds())
+    n_buckets = int(np.ceil(86400 / bucket_seconds))
+
+    series_codes, keys = pd.MultiIndex.from_frame(df[key_columns].astype(str)).factorize()
+    bucket_codes = (time_of_day_seconds(df[time_column]) // bucket_seconds).astype(np.int64)
+    codes = pd.Series(series_codes.astype(np.int64) * n_buckets + bucket_codes, index=df.index)
+
+    values = df[value_column].astype(np.float64)
+    grouped = values.groupby(codes)
+
+    stats = grouped.agg(['count', 'mean', 'std', 'median'])
+    stats['mad'] = (values - grouped.transform('median')).abs().groupby(codes).median()
+    for quantile in quantiles:
+        stats[f'q{int(round(quantile * 100))}'] = grouped.quantile(quantile)
+
+    profile = np.full((len(keys), n_buckets, stats.shape[1]), np.nan, dtype=np.float32)
+    profile[:, :, 0] = 0
+    profile.reshape(-1, stats.shape[1])[stats.index.to_numpy()] = stats.to_numpy(dtype=np.float32)
+
+    return BaselineProfile(keys.tolist(), key_columns, stats.columns.tolist(), profile, bucket_seconds)
+
+
+def build_host_profile(train_host: pd.DataFrame, bucket: str = '10min', quantiles: List[float] = DEFAULT_QUANTILES) -> BaselineProfile:
+    '''
+    Build the per-(cmdb_id, name) KPI profiles of a read_host() dataframe.
+    '''
+    return build_profile(train_host, 'timestamp', ['cmdb_id', 'name'], 'value', bucket, quantiles)
+
+
+def build_esb_profile(train_esb: pd.DataFrame, bucket: str = '10min', quantiles: List[float] = DEFAULT_QUANTILES) -> BaselineProfile:
+    '''
+    Build the per-(serviceName, column) profiles of every ESB value column of a read_esb() dataframe.
+    '''
+    long = train_esb.melt(id_vars=['serviceName', 'startTime'], value_vars=ESB_VALUE_COLUMNS, var_name='name', value_name='value')
+    return build_profile(long, 'startTime', ['serviceName', 'name'], 'value', bucket, quantiles)
+
+
+if __name__ == '__main__':
+    from .utils import read_host, read_esb
+
+    parser = argparse.ArgumentParser(description="Build the host KPI and ESB baseline profiles of a train day.")
+    parser.add_argument('--train-prefix', default="train_data/2020_05_04")
+    parser.add_argument('--output', default="data/baselines", help="directory to write host.npz and esb.npz to")
+    parser.add_argument('--bucket', default='10min', help="size of the time-of-day buckets")
+    parser.add_argument('--cache', action='store_true', help="use the columnar on-disk cache (requires pyarrow)")
+    args = parser.parse_args()
+
+    build_host_profile(read_host(args.train_prefix, cache=args.cache), args.bucket).save(os.path.join(args.output, 'host.npz'))
+    build_esb_profile(read_esb(f"data/{args.train_prefix}/esb.csv", cache=args.cache), args.bucket).save(os.path.join(args.output, 'esb.npz'))
@@ -0,0 +1,130 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+from typing import Any, Callable, List, Tuple
+
+from .utils import read_host, read_trace, read_esb, trace_length
+from .compute_actual_time import build_dictionary_graph, compute_actual_time, compute_actual_time_vectorized, avg_actual_time
+from .plots import compare_esb, compare_host, compare_trace_for_failure
+from .synthetic import generate_dataset
+
+
+# Benchmark Harness
+# Every step is timed (wall time) and its peak traced memory recorded, so that regressions and speedups can be tracked offline
+def measure(name: str, func: Callable, *args, memory: bool = True, **kwargs) -> Tuple[Any, dict]:
+    '''
+    Run func(*args, **kwargs) and return its result with a record of its wall time and (if memory is True) its peak memory,
+    as traced by tracemalloc (numpy and pandas buffers included).
+    '''
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory: tracemalloc.stop()
+
+    record = {'name': name, 'seconds': seconds, 'peak_mb': peak / 2**20 if peak is not None else None}
+    if isinstance(result, pd.DataFrame):
+        record['rows'] = len(result)
+
+    return result, record
+
+
+def run_benchmarks(prefix_path: str = "synthetic",
+                   sample: int = 200,
+                   seconds_past: int = None,
+                   memory: bool = True,
+                   trace_interval: int = 7200,
+                   output_dir: str = None) -> List[dict]:
+    '''
+    Benchmark the readers, trace_length(), build_dictionary_graph() / compute_actual_time() (against compute_actual_time_vectorized()),
+    avg_actual_time() and the plot functions (rendered headless) on the dataset under data/<prefix_path>.
+
+    sample is the number of traces used by the per-trace steps, and seconds_past the failure time of the plots
+    (the first failure of data/<prefix_path>/failures.json by default), with trace_interval seconds of traces around it.
+    '''
+    test_prefix, train_prefix = f"{prefix_path}/test_data", f"{prefix_path}/train_data/2020_05_04"
+    if seconds_past is None:
+        with open(f"data/{prefix_path}/failures.json") as f:
+            seconds_past = json.load(f)[0][0]
+    if output_dir is None: output_dir = tempfile.mkdtemp()
+
+    records = []
+
+    def step(name: str, func: Callable, *args, **kwargs) -> Any:
+        result, record = measure(name, func, *args, memory=memory, **kwargs)
+        records.append(record)
+        return result
+
+    # Readers
+    test_host = step('read_host', read_host, test_prefix)
+    train_host = step('read_host (train)', read_host, train_prefix)
+    test_trace = step('read_trace', read_trace, test_prefix, test_data=True)
+    train_trace = step('read_trace (train)', read_trace, train_prefix)
+    test_esb = step('read_esb', read_esb, f"data/{test_prefix}/esb.csv")
+    train_esb = step('read_esb (train)', read_esb, f"data/{train_prefix}/esb.csv")
+
+    # Trace analysis on a sample of traces
+    trace_list = pd.Series(test_trace.traceId.astype(str).unique()).sample(min(sample, test_trace.traceId.nunique()), random_state=0).tolist()
+    sampled = test_trace[test_trace.traceId.isin(trace_list)].copy()
+
+    step('trace_length', trace_length, test_trace, trace_list)
+    elapsed_time_dict, children_dict = step('build_dictionary_graph', build_dictionary_graph, sampled)
+    step('compute_actual_time', compute_actual_time, sampled.copy(), elapsed_time_dict, children_dict)
+    step('compute_actual_time_vectorized', compute_actual_time_vectorized, sampled.copy())
+    step('compute_actual_time_vectorized (all)', compute_actual_time_vectorized, test_trace.copy())
+    step('avg_actual_time', avg_actual_time, test_trace, trace_list)
+
+    # Plots, rendered headless to output_dir
+    cmdb_id, name = test_host[['cmdb_id', 'name']].iloc[0].astype(str)
+    step('compare_esb', compare_esb, seconds_past, test_esb=test_esb, train_esb=train_esb,
+         output=os.path.join(output_dir, 'esb.png'), show=False)
+    step('compare_host', compare_host, test_host, train_host, seconds_past, cmdb_id, name,
+         output=os.path.join(output_dir, 'host.png'), show=False)
+    # The trace plots sample 100 parent traces around the failure, so the window is widened for small synthetic days
+    step('compare_trace_for_failure', compare_trace_for_failure, test_trace, train_trace, seconds_past, trace_interval,
+         output=os.path.join(output_dir, 'trace.png'), show=False)
+
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the readers, analyses and plots on a (synthetic) dataset.")
+    parser.add_argument('--prefix', default="synthetic", help="dataset under data/<prefix>/{train_data/2020_05_04,test_data}")
+    parser.add_argument('--generate', action='store_true', help="generate the synthetic dataset first (see src.synthetic)")
+    parser.add_argument('--traces', type=int, default=10000, help="number of traces per generated day")
+    parser.add_argument('--sample', type=int, default=200, help="number of traces used by the per-trace steps")
+    parser.add_argument('--no-memory', action='store_true', help="skip peak memory tracing (which slows the steps down)")
+    parser.add_argument('--output', default="output/benchmark.json", help="JSON report to write")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_dataset(args.prefix, args.traces)
+
+    records = run_benchmarks(args.prefix, args.sample, memory=not args.no_memory)
+
+    report = {
+        'prefix': args.prefix,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'steps': records,
+    }
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for record in records:
+        print("%-40s %8.3f s %10s MB" % (record['name'], record['seconds'], "%.1f" % record['peak_mb'] if record['peak_mb'] is not None else '-'))
@@ -0,0 +1,223 @@
+import pandas as pd
+import numpy as np
+import argparse
+import glob
+import json
+import os
+
+from typing import Dict, List, Union
+
+from .utils import read_host, read_esb, read_trace_window, _concat_frames
+from .indexes import epoch_ms
+from .profiling import profiled
+
+
+# Dataset Catalog
+# Every day-partition under data/ (a folder with host/*.csv, trace/*.csv and/or esb.csv, e.g. train_data/2020_05_04 or test_data)
+# is recorded once with the time range and file stats of each source, so that loads only read the partitions overlapping the query
+DATA_DIR = "data"
+CATALOG_PATH = "data/catalog.json"
+TIME_COLUMNS = {'host': 'timestamp', 'trace': 'startTime', 'esb': 'startTime'}
+SKIPPED_DIRS = {'.cache', 'baselines'}
+
+
+def _source_files(prefix_path: str, data_dir: str = DATA_DIR) -> Dict[str, List[str]]:
+    return {
+        'host': sorted(glob.glob(f"{data_dir}/{prefix_path}/host/*.csv")),
+        'trace': sorted(glob.glob(f"{data_dir}/{prefix_path}/trace/*.csv")),
+        'esb': sorted(glob.glob(f"{data_dir}/{prefix_path}/esb.csv")),
+    }
+
+
+def _file_stats(files: List[str]) -> List[list]:
+    return [[file, os.stat(file).st_size, os.stat(file).st_mtime_ns] for file in files]
+
+
+def _to_ms(time: Union[int, str, pd.Timestamp]) -> int:
+    '''
+    Return a time (epoch ms, or a timestamp / string in Asia/Singapore time unless it has a timezone) as epoch ms.
+    '''
+    if time is None or isinstance(time, (int, np.integer)):
+        return time
+
+    time = pd.Timestamp(time)
+    if time.tzinfo is None: time = time.tz_localize('Asia/Singapore')
+
+    return int(epoch_ms(pd.Series([time]))[0])
+
+
+def discover(data_dir: str = DATA_DIR) -> List[str]:
+    '''
+    Return the prefix paths (relative to data_dir, as taken by the readers) of every day-partition under data_dir.
+    '''
+    prefixes = []
+    for directory, subdirectories, files in os.walk(data_dir):
+        subdirectories[:] = sorted(d for d in subdirectories if d not in SKIPPED_DIRS)
+
+        if 'esb.csv' in files or any(glob.glob(os.path.join(directory, d, '*.csv')) for d in ('host', 'trace') if d in subdirectories):
+            prefixes.append(os.path.relpath(directory, data_dir).replace(os.sep, '/'))
+            subdirectories[:] = [d for d in subdirectories if d not in ('host', 'trace')]
+
+    return prefixes
+
+
+class DatasetCatalog:
+    '''
+    Catalog of the day-partitions under data/, persisted to a JSON file. For every partition and source (host, trace, esb) it records
+    the files (path, size, mtime), the number of rows and the [start, end] time range (epoch ms) of the data.
+
+    refresh() only scans the partitions that are new or whose files changed, so appending a day does not reprocess the others.
+    Partitions are discovered, scanned and loaded under data_dir (data/ by default), and recorded by their prefix path relative to it.
+    '''
+
+    def __init__(self, path: str = CATALOG_PATH, data_dir: str = DATA_DIR):
+        self.path = path
+        self.data_dir = data_dir
+        self.partitions: Dict[str, dict] = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.partitions = json.load(f)
+
+    def save(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory: os.makedirs(directory, exist_ok=True)
+
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.partitions, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    @profiled('index')
+    def add(self, prefix_path: str, save: bool = True) -> dict:
+        '''
+        Scan one partition (reading only the time column of each file) and record it in the catalog.
+        '''
+        partition = {'sources': {}, 'test_data': False}
+
+        for source, files in _source_files(prefix_path, self.data_dir).items():
+            if not files:
+                continue
+
+            start, end, rows = None, None, 0
+            for file in files:
+                timestamps = pd.read_csv(file, usecols=[TIME_COLUMNS[source]], dtype=np.int64)[TIME_COLUMNS[source]].to_numpy()
+                if len(timestamps):
+                    start = int(timestamps.min()) if start is None else min(start, int(timestamps.min()))
+                    end = int(timestamps.max()) if end is None else max(end, int(timestamps.max()))
+                rows += len(timestamps)
+
+            partition['sources'][source] = {'files': _file_stats(files), 'start': start, 'end': end, 'rows': rows}
+
+            # Only the trace files of the test day have a msgTime column (see read_trace())
+            if source == 'trace':
+                partition['test_data'] = 'msgTime' in pd.read_csv(files[0], nrows=0).columns
+
+        self.partitions[prefix_path] = partition
+        if save: self.save()
+
+        return partition
+
+    def _changed(self, prefix_path: str) -> bool:
+        recorded = self.partitions.get(prefix_path)
+        if recorded is None:
+            return True
+
+        current = {source: _file_stats(files) for source, files in _source_files(prefix_path, self.data_dir).items() if files}
+        return current != {source: entry['files'] for source, entry in recorded['sources'].items()}
+
+    def refresh(self) -> List[str]:
+        '''
+        Discover the partitions under data_dir, scan the new and changed ones, drop the removed ones, and return the scanned prefixes.
+        '''
+        prefixes = discover(self.data_dir)
+        scanned = [prefix for prefix in prefixes if self._changed(prefix)]
+
+        for prefix in scanned:
+            self.add(prefix, save=False)
+        for prefix in set(self.partitions) - set(prefixes):
+            del self.partitions[prefix]
+
+        self.save()
+        return scanned
+
+    def summary(self) -> pd.DataFrame:
+        '''
+        Return one row per (partition, source) with its rows and time range (Asia/Singapore).
+        '''
+        rows = [{'prefix_path': prefix, 'source': source, 'files': len(entry['files']), 'rows': entry['rows'],
+                 'start': entry['start'], 'end': entry['end']}
+                for prefix, partition in self.partitions.items() for source, entry in partition['sources'].items()]
+
+        summary = pd.DataFrame(rows, columns=['prefix_path', 'source', 'files', 'rows', 'start', 'end'])
+        for column in ['start', 'end']:
+            summary[column] = pd.to_datetime(summary[column], unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+
+        return summary
+
+    def overlapping(self, source: str, start: Union[int, str, pd.Timestamp] = None, end: Union[int, str, pd.Timestamp] = None) -> List[str]:
+        '''
+        Return the partitions with data of source overlapping [start, end] (epoch ms, or timestamps in Asia/Singapore time).
+        '''
+        start, end = _to_ms(start), _to_ms(end)
+
+        prefixes = []
+        for prefix, partition in sorted(self.partitions.items(), key=lambda item: item[1]['sources'].get(source, {}).get('start') or 0):
+            entry = partition['sources'].get(source)
+            if entry is None or entry['start'] is None:
+                continue
+            if (start is None or entry['end'] >= start) and (end is None or entry['start'] <= end):
+                prefixes.append(prefix)
+
+        return prefixes
+
+    @profiled('reader')
+    def load(self,
+             source: str,
+             start: Union[int, str, pd.Timestamp] = None,
+             end: Union[int, str, pd.Timestamp] = None,
+             cache: bool = False,
+             **kwargs) -> pd.DataFrame:
+        '''
+        Load the rows of source within [start, end] from the overlapping partitions only, into a single dataframe
+        with the columns and dtypes of read_host() / read_trace() / read_esb().
+
+        Trace windows are pushed down into iter_trace() (extra kwargs such as cmdb_id or roots_only are passed to it);
+        host and ESB partitions are read whole (with the columnar cache if cache is True) and then filtered.
+        Note that trace partitions of test and train days have different columns (msgTime), so they are best loaded separately.
+        '''
+        start, end = _to_ms(start), _to_ms(end)
+
+        frames = []
+        for prefix in self.overlapping(source, start, end):
+            # The readers take prefixes relative to data/, so partitions of another data_dir are reached through a relative path
+            reader_prefix = os.path.relpath(os.path.join(self.data_dir, prefix), DATA_DIR).replace(os.sep, '/')
+
+            if source == 'trace':
+                frames.append(read_trace_window(reader_prefix, start_time=start, end_time=end, test_data=self.partitions[prefix]['test_data'], **kwargs))
+                continue
+
+            df = read_host(reader_prefix, cache=cache) if source == 'host' else read_esb(f"{self.data_dir}/{prefix}/esb.csv", cache=cache)
+            timestamps = epoch_ms(df[TIME_COLUMNS[source]])
+            mask = np.ones(len(df), dtype=bool)
+            if start is not None: mask &= timestamps >= start
+            if end is not None: mask &= timestamps <= end
+            frames.append(df[mask] if not mask.all() else df)
+
+        return _concat_frames(frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Discover the day-partitions under data/ and record their time ranges in the catalog.")
+    parser.add_argument('--catalog', default=CATALOG_PATH)
+    parser.add_argument('--data-dir', default=DATA_DIR, help="directory the day-partitions are discovered under")
+    parser.add_argument('--add', nargs='*', default=None, help="only scan these prefix paths (e.g. train_data/2020_05_05)")
+    args = parser.parse_args()
+
+    catalog = DatasetCatalog(args.catalog, args.data_dir)
+    if args.add:
+        for prefix in args.add:
+            catalog.add(prefix)
+    else:
+        print("Scanned:", catalog.refresh())
+
+    print(catalog.summary().to_string(index=False))
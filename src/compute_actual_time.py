@@ -1,12 +1,19 @@
 import pandas as pd
+import numpy as np
+import time
 
-from typing import Tuple
+from typing import Callable, List, Tuple
 from collections import defaultdict
 
+from .indexes import TraceIndex, epoch_ms, midnight_ms
+from .profiling import profiled
+
 # Calculate Actual Time
 
 # Note that this functions are very very slow
 # A potential speed up is to track by the traceId instead, this avoids computing for every single row, maintaining large df and dictionaries
+# See compute_actual_time_vectorized() below, which computes the actual time for the whole dataframe in one pass
+@profiled('compute')
 def build_dictionary_graph(df: pd.DataFrame) -> Tuple[dict, dict]:
     '''
     Using a dictionary, build a graph to mimic the hierarchy of the service tree.
@@ -32,6 +39,7 @@ def build_dictionary_graph(df: pd.DataFrame) -> Tuple[dict, dict]:
     return elapsed_time_dict, children_dict
 
 
+@profiled('compute')
 def compute_actual_time(df: pd.DataFrame, elapsed_time_dict: dict, children_dict: dict) -> pd.DataFrame:
     # Initialize a new column to store actual time
     df['actual_time'] = 0
@@ -56,100 +64,310 @@ def compute_actual_time(df: pd.DataFrame, elapsed_time_dict: dict, children_dict
 
     return df
 
-def avg_actual_time(trace_filtered, sample_trace):
-    cumulative= pd.DataFrame()
 
-    for trace_id in sample_trace:
-        # Gather all the rows for the traceId
-        temp = trace_filtered[trace_filtered.traceId == trace_id]
+def parent_positions(df: pd.DataFrame) -> np.ndarray:
+    '''
+    Map the pid of every row to the row position (not index label) of its parent span.
 
-        # Build the dictionary graph and compute the actual time for each node
-        elapsed_time_dict, children_dict = build_dictionary_graph(temp)
-        temp = compute_actual_time(temp, elapsed_time_dict, children_dict)
+    Root spans (pid == "None") and spans whose parent is not in the dataframe are mapped to -1.
+    If a span id appears more than once, the first occurrence is treated as the parent.
+
+    For compact_trace() dataframes, the parent span keys are resolved against the span keys instead.
+    '''
+    n = len(df)
+
+    if 'pid' not in df.columns and 'parent' in df.columns:
+        # Span keys are increasing in compact dataframes (and any subset of rows that keeps the order)
+        span = df['span'].to_numpy()
+        parent = df['parent'].to_numpy()
+        if n == 0:
+            return np.empty(0, dtype=np.int64)
+        if not np.all(span[1:] > span[:-1]):
+            return pd.Index(span).get_indexer(parent)
+
+        position = np.searchsorted(span, parent).clip(max=n - 1)
+        return np.where((parent >= 0) & (span[position] == parent), position, -1)
+
+    # Intern the span ids, keeping the row position of the first occurrence of each id
+    id_codes, id_uniques = pd.factorize(df['id'])
+    first_position = np.full(len(id_uniques), -1, dtype=np.int64)
+    first_position[id_codes[::-1]] = np.arange(n, dtype=np.int64)[::-1]
+
+    # Resolve pid against the interned ids (via the categories to avoid materialising millions of strings)
+    pid = df['pid']
+    if isinstance(pid.dtype, pd.CategoricalDtype):
+        category_position = pd.Index(id_uniques).get_indexer(pid.cat.categories.astype(str))
+        pid_codes = pid.cat.codes.to_numpy()
+        parent = np.where(pid_codes >= 0, category_position[pid_codes], -1)
+    else:
+        parent = pd.Index(id_uniques).get_indexer(pid.astype(str))
+
+    return np.where(parent >= 0, first_position[parent], -1)
+
+
+@profiled('compute')
+def compute_actual_time_vectorized(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Vectorized equivalent of build_dictionary_graph() + compute_actual_time() for the whole dataframe at once.
+
+    Each pid is mapped to the row position of its parent, and the elapsed time of all direct children is summed per parent with np.bincount.
+    The actual time is the elapsed time less the cumulative elapsed time of the direct children.
+    '''
+    elapsed = df['elapsedTime'].to_numpy(dtype=np.int64)
+    parent = parent_positions(df)
+
+    # Sum the elapsed time of the direct children into the row position of their parent
+    has_parent = parent >= 0
+    children_cumulative_time = np.bincount(parent[has_parent], weights=elapsed[has_parent], minlength=len(df))
+
+    df['actual_time'] = elapsed - children_cumulative_time.astype(np.int64)
+
+    return df
+
+
+def _unique_identifier(df: pd.DataFrame) -> pd.Series:
+    # Concatenate cmdb_id, serviceName, dsName to create a unique identifier (even if there are null values)
+    # Note that pandas >= 3.0 keeps nulls as NaN in astype(str), hence the fillna
+    return (df['cmdb_id'].astype(str).fillna('nan') + ':' + df['serviceName'].astype(str).fillna('nan') + ':' + df['dsName'].astype(str).fillna('nan'))
+
+
+def _sampled_spans(trace_filtered: pd.DataFrame, trace_list: List[str], index: TraceIndex = None) -> pd.DataFrame:
+    '''
+    Return a copy of the rows of trace_filtered belonging to the traceIds of trace_list.
+
+    With a TraceIndex (usually built over the whole day), the rows are taken from the index and then restricted to the rows of trace_filtered
+    (by index label, so trace_filtered must be a row subset of the index's dataframe, e.g. from TimeIndex.around()),
+    so that the spans of a selected trace outside the window are left out exactly as without the index.
+    '''
+    if index is not None:
+        temp = index.take(trace_list)
+        temp = temp[temp.index.isin(trace_filtered.index)]
+    else:
+        temp = trace_filtered[trace_filtered.traceId.isin(trace_list)]
+
+    return temp.copy()
 
-        # Concatenate cmdb_id, serviceName, dsName to create a unique identifier (even if there are null values)
-        temp['unique_identifier'] = temp['cmdb_id'].astype(str) + ':' + temp['serviceName'].astype(str) + ':' + temp['dsName'].astype(str)
-        temp = temp.groupby('unique_identifier').agg({'actual_time': 'sum'}).sort_values(by='unique_identifier').reset_index()
-        
-        # Combine b1 and b2 to get sum of actual_time
-        cumulative = pd.concat([cumulative, temp]).groupby('unique_identifier').agg({'actual_time': 'sum'}).sort_values(by='unique_identifier').reset_index()
+
+@profiled('compute')
+def avg_actual_time(trace_filtered, sample_trace, index: TraceIndex = None):
+    # Gather all the rows for the sampled traceIds in one pass (or from the TraceIndex if given), instead of filtering the df per traceId
+    temp = _sampled_spans(trace_filtered, sample_trace, index)
+
+    # Compute the actual time for every node of every sampled trace at once
+    temp = compute_actual_time_vectorized(temp)
+
+    temp['unique_identifier'] = _unique_identifier(temp)
+    cumulative = temp.groupby('unique_identifier').agg({'actual_time': 'sum'}).sort_values(by='unique_identifier').reset_index()
 
     cumulative.actual_time = cumulative.actual_time / len(sample_trace)
     
     return cumulative
 
-def compare_trace_childrens_failure1(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host):
-    sample_trace_test = test_trace_filtered_parent_host[test_trace_filtered_parent_host.elapsedTime > 4000].sample(100).traceId.tolist()
-    sample_trace_train = train_trace_filtered_parent_host[
-        (train_trace_filtered_parent_host.elapsedTime < train_trace_filtered_parent_host.elapsedTime.mean()) &
-        (train_trace_filtered_parent_host.elapsedTime > 0)].sample(100).traceId.tolist()
-    
-    cumulative_test = avg_actual_time(test_trace_filtered, sample_trace_test)
-    cumulative_train = avg_actual_time(train_trace_filtered, sample_trace_train)
+def _actual_time_cells(spans: pd.DataFrame, trace_list: List[str], identifiers: pd.Index) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Return the non-empty cells of the (trace x unique identifier) matrix of the total actual time of each identifier within each trace,
+    as (trace codes, identifier codes, actual times) sorted by identifier, in one grouped pass over the spans of the traces (see _sampled_spans()).
 
-    # Merge the two dataframes
-    cumulative_train = cumulative_train.rename(columns={'actual_time': 'train_actual_time'})
-    cumulative_test = cumulative_test.rename(columns={'actual_time': 'test_actual_time'})
-    cumulative_train_test = pd.merge(cumulative_train, cumulative_test, on='unique_identifier', how='outer')
+    The matrix itself is never built, as it would hold (number of traces x number of identifiers) values for the full population.
+    Spans of other traces or identifiers are left out.
+    '''
+    temp = compute_actual_time_vectorized(spans)
 
-    # Calculate the difference between train and test
-    cumulative_train_test['difference'] = cumulative_train_test.train_actual_time - cumulative_train_test.test_actual_time
+    trace_codes = pd.Index(trace_list).get_indexer(temp.traceId.astype(str))
+    identifier_codes = identifiers.get_indexer(_unique_identifier(temp))
+    known = (trace_codes >= 0) & (identifier_codes >= 0)
 
-    cumulative_train_test.sort_values(by='difference', ascending=True, inplace=True)
-    
-    return cumulative_train_test
+    # Sum the actual time of the spans of each (identifier, trace) cell
+    cells, cell_codes = np.unique(identifier_codes[known].astype(np.int64) * len(trace_list) + trace_codes[known], return_inverse=True)
+    actual_time = np.bincount(cell_codes.ravel(), weights=temp.actual_time.to_numpy(dtype=np.float64)[known], minlength=len(cells))
+
+    return cells % len(trace_list), cells // len(trace_list), actual_time
 
 
-def trace_to_parent(df:pd.DataFrame, traceId: str) -> pd.DataFrame:
+def _mean_actual_time(cells: Tuple[np.ndarray, np.ndarray, np.ndarray], n_traces: int, n_identifiers: int) -> np.ndarray:
     '''
-    Given a traceId, query the dataframe and return the parent traceId.
+    Return the mean over the traces of the actual time of each identifier, NaN for identifiers without any span in the traces.
     '''
+    _, identifier_codes, actual_time = cells
+    totals = np.bincount(identifier_codes, weights=actual_time, minlength=n_identifiers)
 
-    return df[(df.traceId == traceId) & (df.pid == "None")]
+    return np.where(np.bincount(identifier_codes, minlength=n_identifiers) > 0, totals / max(n_traces, 1), np.nan)
 
 
-def compare_trace_childrens_failure2(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host):
-    sample_trace_test = test_trace_filtered_parent_host[(test_trace_filtered_parent_host.elapsedTime > 4000) | (test_trace_filtered_parent_host.elapsedTime < 0)].sample(100).traceId.tolist()
-    sample_trace_train = train_trace_filtered_parent_host[
-        (train_trace_filtered_parent_host.elapsedTime < train_trace_filtered_parent_host.elapsedTime.mean()) & 
-        (train_trace_filtered_parent_host.elapsedTime > 0)].sample(100).traceId.tolist()
-    
-    cumulative_test = avg_actual_time(test_trace_filtered, sample_trace_test)
-    cumulative_train = avg_actual_time(train_trace_filtered, sample_trace_train)
+def _select_traces(parent_host: pd.DataFrame, predicate: Callable[[pd.DataFrame], pd.Series], sample: int, rng: np.random.Generator) -> List[str]:
+    trace_list = parent_host[predicate(parent_host)].traceId.astype(str).unique()
+
+    if sample is not None and sample < len(trace_list):
+        trace_list = rng.choice(trace_list, size=sample, replace=False)
+
+    return list(trace_list)
+
+
+def _bootstrap_means(cells: Tuple[np.ndarray, np.ndarray, np.ndarray], n_traces: int, n_identifiers: int, n_bootstrap: int,
+                     rng: np.random.Generator, deadline: float, memory_budget: int = 256 * 2 ** 20) -> np.ndarray:
+    '''
+    Return up to n_bootstrap bootstrap replicates of the per-identifier mean over traces (resampling traces with replacement),
+    from the cells of _actual_time_cells().
+
+    Each replicate is a multinomial reweighting of the traces, so a batch of replicates is a product of the weights with the sparse cells:
+    the weights of each cell's trace times its actual time, summed per identifier. Batches are sized so that the weights and the weighted
+    cells of a batch fit in memory_budget bytes. Stops early once the deadline (time.perf_counter()) has passed.
+    '''
+    trace_codes, identifier_codes, actual_time = cells
+    batch_size = max(int(memory_budget // ((n_traces + len(actual_time)) * 8)), 1)
+
+    # Cells are sorted by identifier, so each identifier is a contiguous run of cells
+    present, run_starts = np.unique(identifier_codes, return_index=True)
+    replicates = []
+
+    for start in range(0, n_bootstrap, batch_size):
+        if start and time.perf_counter() > deadline:
+            break
+        weights = rng.multinomial(n_traces, np.full(n_traces, 1 / n_traces), size=min(batch_size, n_bootstrap - start))
+
+        replicate = np.zeros((len(weights), n_identifiers))
+        if len(actual_time):
+            replicate[:, present] = np.add.reduceat(weights[:, trace_codes] * actual_time, run_starts, axis=1)
+        replicates.append(replicate / n_traces)
+
+    return np.concatenate(replicates) if replicates else np.empty((0, n_identifiers))
+
+
+@profiled('compare')
+def compare_trace_childrens(test_trace_filtered: pd.DataFrame,
+                            train_trace_filtered: pd.DataFrame,
+                            test_trace_filtered_parent_host: pd.DataFrame,
+                            train_trace_filtered_parent_host: pd.DataFrame,
+                            test_predicate: Callable[[pd.DataFrame], pd.Series],
+                            train_predicate: Callable[[pd.DataFrame], pd.Series],
+                            sample: int = None,
+                            seed: int = None,
+                            n_bootstrap: int = 1000,
+                            confidence: float = 0.95,
+                            time_budget: float = None,
+                            test_index: TraceIndex = None,
+                            train_index: TraceIndex = None) -> pd.DataFrame:
+    '''
+    Compare the average actual time of each cmdb_id:serviceName:dsName between the train and test traces.
+
+    The traces are the parent rows selected by test_predicate / train_predicate (functions of the parent dataframe returning a boolean mask).
+    All qualifying traces are used by default, or a reproducible random sample of that size (seeded by seed) if sample is given.
+
+    The actual time of every span of every selected trace is computed in one grouped pass, and the difference (train - test) comes with a
+    bootstrap confidence interval (difference_low, difference_high) from n_bootstrap replicates.
+    If time_budget (in seconds) is given, bootstrapping stops once the budget is exhausted, and the number of replicates used is stored in df.attrs['n_bootstrap'].
+
+    Identifiers that only appear on one side have an average actual time (and a difference and interval) of NaN on the other side.
+    '''
+    start = time.perf_counter()
+    deadline = start + time_budget if time_budget is not None else np.inf
+    rng = np.random.default_rng(seed)
+
+    sample_trace_test = _select_traces(test_trace_filtered_parent_host, test_predicate, sample, rng)
+    sample_trace_train = _select_traces(train_trace_filtered_parent_host, train_predicate, sample, rng)
+
+    # Spans of the selected traces within the filtered rows (the same rows with or without an index)
+    spans_test = _sampled_spans(test_trace_filtered, sample_trace_test, test_index)
+    spans_train = _sampled_spans(train_trace_filtered, sample_trace_train, train_index)
 
-    # Merge the two dataframes
-    cumulative_train = cumulative_train.rename(columns={'actual_time': 'train_actual_time'})
-    cumulative_test = cumulative_test.rename(columns={'actual_time': 'test_actual_time'})
-    cumulative_train_test = pd.merge(cumulative_train, cumulative_test, on='unique_identifier', how='outer')
+    # Identifiers over both days, from the spans that fill the cells, so that the train and test cells share their identifier codes
+    identifiers = pd.Index(pd.concat([_unique_identifier(spans_test), _unique_identifier(spans_train)]).unique()).sort_values()
+
+    cells_test = _actual_time_cells(spans_test, sample_trace_test, identifiers)
+    cells_train = _actual_time_cells(spans_train, sample_trace_train, identifiers)
+
+    cumulative_train_test = pd.DataFrame({
+        'unique_identifier': identifiers,
+        'train_actual_time': _mean_actual_time(cells_train, len(sample_trace_train), len(identifiers)),
+        'test_actual_time': _mean_actual_time(cells_test, len(sample_trace_test), len(identifiers)),
+    })
 
     # Calculate the difference between train and test
     cumulative_train_test['difference'] = cumulative_train_test.train_actual_time - cumulative_train_test.test_actual_time
 
+    # Bootstrap confidence interval of the difference (train and test traces are resampled independently)
+    n_replicates = 0
+    if n_bootstrap and len(sample_trace_test) and len(sample_trace_train):
+        replicates_train = _bootstrap_means(cells_train, len(sample_trace_train), len(identifiers), n_bootstrap, rng, deadline)
+        replicates_test = _bootstrap_means(cells_test, len(sample_trace_test), len(identifiers), len(replicates_train), rng, np.inf)
+        differences = replicates_train - replicates_test
+        n_replicates = len(differences)
+
+    if n_replicates:
+        alpha = (1 - confidence) / 2
+        both_sides = cumulative_train_test.difference.notna().to_numpy()
+        cumulative_train_test['difference_low'] = np.where(both_sides, np.quantile(differences, alpha, axis=0), np.nan)
+        cumulative_train_test['difference_high'] = np.where(both_sides, np.quantile(differences, 1 - alpha, axis=0), np.nan)
+    else:
+        cumulative_train_test['difference_low'] = np.nan
+        cumulative_train_test['difference_high'] = np.nan
+
     cumulative_train_test.sort_values(by='difference', ascending=True, inplace=True)
-    
+
+    cumulative_train_test.attrs.update({
+        'n_test_traces': len(sample_trace_test),
+        'n_train_traces': len(sample_trace_train),
+        'n_bootstrap': n_replicates,
+        'seconds': time.perf_counter() - start,
+    })
+
     return cumulative_train_test
 
-def compare_trace_childrens_failure4(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host):
-    avg_elapsed_for_errorneous_calls = test_trace_filtered_parent_host[
-    (test_trace_filtered_parent_host.startTime > pd.to_datetime('2020-05-30 04:29:00').tz_localize('Asia/Singapore')) &
-    (test_trace_filtered_parent_host.startTime < pd.to_datetime('2020-05-30 04:30:00').tz_localize('Asia/Singapore'))].elapsedTime.mean()
-    
-    sample_trace_test = test_trace_filtered_parent_host[test_trace_filtered_parent_host.elapsedTime < avg_elapsed_for_errorneous_calls].sample(100).traceId.tolist()
-    sample_trace_train = train_trace_filtered_parent_host[
-        (train_trace_filtered_parent_host.elapsedTime < train_trace_filtered_parent_host.elapsedTime.mean()) & 
-        (train_trace_filtered_parent_host.elapsedTime > avg_elapsed_for_errorneous_calls)].sample(100).traceId.tolist()
-    
-    cumulative_test = avg_actual_time(test_trace_filtered, sample_trace_test)
-    cumulative_train = avg_actual_time(train_trace_filtered, sample_trace_train)
 
-    # Merge the two dataframes
-    cumulative_train = cumulative_train.rename(columns={'actual_time': 'train_actual_time'})
-    cumulative_test = cumulative_test.rename(columns={'actual_time': 'test_actual_time'})
-    cumulative_train_test = pd.merge(cumulative_train, cumulative_test, on='unique_identifier', how='outer')
+def _train_below_mean(train_trace_filtered_parent_host: pd.DataFrame, lower: float = 0) -> Callable[[pd.DataFrame], pd.Series]:
+    # Normal train traces: faster than the train average, and slower than the lower bound
+    mean = train_trace_filtered_parent_host.elapsedTime.mean()
+    return lambda df: (df.elapsedTime < mean) & (df.elapsedTime > lower)
 
-    # Calculate the difference between train and test
-    cumulative_train_test['difference'] = cumulative_train_test.train_actual_time - cumulative_train_test.test_actual_time
 
-    cumulative_train_test.sort_values(by='difference', ascending=True, inplace=True)
-    
-    return cumulative_train_test
\ No newline at end of file
+def compare_trace_childrens_failure1(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                     test_index: TraceIndex = None, train_index: TraceIndex = None, **kwargs):
+    '''
+    Slow test traces (elapsedTime > 4000) vs normal train traces. See compare_trace_childrens() for the keyword arguments (sample, seed, ...).
+    '''
+    return compare_trace_childrens(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                   lambda df: df.elapsedTime > 4000,
+                                   _train_below_mean(train_trace_filtered_parent_host),
+                                   test_index=test_index, train_index=train_index, **kwargs)
+
+
+def trace_to_parent(df:pd.DataFrame, traceId: str, index: TraceIndex = None) -> pd.DataFrame:
+    '''
+    Given a traceId, query the dataframe and return the parent traceId.
+
+    If a TraceIndex of the dataframe is given, the parent is looked up from the index instead of scanning the dataframe.
+    '''
+    if index is not None:
+        return index.root(traceId)
+
+    return df[(df.traceId == traceId) & (df.pid == "None")]
+
+
+def compare_trace_childrens_failure2(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                     test_index: TraceIndex = None, train_index: TraceIndex = None, **kwargs):
+    '''
+    Slow or overflowed test traces (elapsedTime > 4000 or < 0) vs normal train traces. See compare_trace_childrens() for the keyword arguments.
+    '''
+    return compare_trace_childrens(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                   lambda df: (df.elapsedTime > 4000) | (df.elapsedTime < 0),
+                                   _train_below_mean(train_trace_filtered_parent_host),
+                                   test_index=test_index, train_index=train_index, **kwargs)
+
+def compare_trace_childrens_failure4(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                     test_index: TraceIndex = None, train_index: TraceIndex = None, **kwargs):
+    '''
+    Test traces faster than the erroneous calls (04:29 - 04:30) vs normal train traces slower than them. See compare_trace_childrens() for the keyword arguments.
+    '''
+    # 04:29 - 04:30 of the day of the test traces, rather than of a fixed date
+    avg_elapsed_for_errorneous_calls = np.nan
+    if len(test_trace_filtered_parent_host):
+        day_start_ms = midnight_ms(int(epoch_ms(test_trace_filtered_parent_host.startTime).min()))
+        day_start = pd.Timestamp(day_start_ms, unit='ms', tz='UTC').tz_convert('Asia/Singapore')
+        avg_elapsed_for_errorneous_calls = test_trace_filtered_parent_host[
+        (test_trace_filtered_parent_host.startTime > day_start + pd.Timedelta('04:29:00')) &
+        (test_trace_filtered_parent_host.startTime < day_start + pd.Timedelta('04:30:00'))].elapsedTime.mean()
+
+    return compare_trace_childrens(test_trace_filtered, train_trace_filtered, test_trace_filtered_parent_host, train_trace_filtered_parent_host,
+                                   lambda df: df.elapsedTime < avg_elapsed_for_errorneous_calls,
+                                   _train_below_mean(train_trace_filtered_parent_host, avg_elapsed_for_errorneous_calls),
+                                   test_index=test_index, train_index=train_index, **kwargs)
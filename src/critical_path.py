@@ -0,0 +1,106 @@
+import pandas as pd
+import numpy as np
+
+from .compute_actual_time import parent_positions
+from .indexes import epoch_ms
+from .topology import _node_labels
+from .profiling import profiled
+
+
+# Critical Path Analysis
+# The critical path of a trace starts at its root span and repeatedly follows the child that finished last (the child that blocked its parent),
+# down to a leaf. Spans are walked level by level over the whole frame at once, so the cost is one vectorized step per level of depth
+def blocking_children(df: pd.DataFrame, parent: np.ndarray = None) -> np.ndarray:
+    '''
+    Return, for every row, the row position of its child with the latest end time (startTime + elapsedTime), or -1 for leaf spans.
+    Ties are broken by the longest elapsedTime.
+    '''
+    if parent is None: parent = parent_positions(df)
+    elapsed = df['elapsedTime'].to_numpy(dtype=np.int64)
+    end = epoch_ms(df['startTime']) + elapsed
+
+    child = np.flatnonzero(parent >= 0)
+    # Sort the children by (parent, end, elapsed), so the last child of each parent is its blocking child
+    child = child[np.lexsort((elapsed[child], end[child], parent[child]))]
+
+    blocking = np.full(len(df), -1, dtype=np.int64)
+    blocking[parent[child]] = child   # the last assignment (latest end) wins
+
+    return blocking
+
+
+@profiled('compute')
+def critical_path(df: pd.DataFrame, min_elapsed: int = None) -> pd.DataFrame:
+    '''
+    Mark the critical path of every trace of a trace dataframe (read_trace(), iter_trace() chunks or compact_trace() output).
+
+    Only traces whose root elapsedTime is above min_elapsed are walked (all traces if None). Adds the columns:
+    - on_critical_path: whether the span is on the critical path of its trace
+    - critical_time: the time (ms) the span contributes to the critical path, i.e. its elapsedTime less that of its blocking child
+    - critical_depth: the depth of the span on the path (0 for the root, -1 off the path)
+    - critical_root: the row position of the root of the path (-1 off the path)
+
+    Spans whose parent is missing from the dataframe are treated as roots.
+    '''
+    parent = parent_positions(df)
+    blocking = blocking_children(df, parent)
+    elapsed = df['elapsedTime'].to_numpy(dtype=np.int64)
+
+    frontier = np.flatnonzero(parent < 0)
+    if min_elapsed is not None:
+        frontier = frontier[elapsed[frontier] > min_elapsed]
+    root = frontier
+
+    depth = np.full(len(df), -1, dtype=np.int32)
+    critical_root = np.full(len(df), -1, dtype=np.int64)
+    level = 0
+    while len(frontier):
+        depth[frontier] = level
+        critical_root[frontier] = root
+
+        # Step every path to its blocking child, dropping the paths that reached a leaf
+        following = blocking[frontier]
+        keep = following >= 0
+        frontier, root = following[keep], root[keep]
+        level += 1
+
+    on_path = depth >= 0
+    blocking_elapsed = np.where(blocking >= 0, elapsed[blocking.clip(min=0)], 0)
+
+    df['on_critical_path'] = on_path
+    df['critical_time'] = np.where(on_path, np.maximum(elapsed - blocking_elapsed, 0), 0)
+    df['critical_depth'] = depth
+    df['critical_root'] = critical_root
+
+    return df
+
+
+@profiled('compute')
+def critical_path_counts(df: pd.DataFrame, min_elapsed: int = 4000, level: str = 'cmdb_id', cmdb: pd.DataFrame = None) -> pd.DataFrame:
+    '''
+    Aggregate how often each node (level 'serviceName', 'cmdb_id' or 'host', see topology.build_call_graph()) appears on the critical path
+    of the slow traces (root elapsedTime > min_elapsed, as in compare_trace_childrens_failure1()).
+
+    Return one row per node, sorted by the number of slow traces it appears in, with:
+    - traces: number of slow traces with the node on their critical path, and share: the fraction of all slow traces
+    - spans: number of critical path spans of the node
+    - critical_time / mean_critical_time: the total time the node contributes to the critical paths, and its mean per trace
+    The number of slow traces is kept in attrs['n_traces'].
+    '''
+    paths = critical_path(df.copy(), min_elapsed)
+    on_path = paths['on_critical_path'].to_numpy()
+
+    spans = pd.DataFrame({
+        'node': _node_labels(paths, level, cmdb).to_numpy()[on_path],
+        'root': paths['critical_root'].to_numpy()[on_path],
+        'critical_time': paths['critical_time'].to_numpy()[on_path],
+    })
+    n_traces = int((paths['critical_depth'] == 0).sum())
+
+    counts = spans.groupby('node').agg(traces=('root', 'nunique'), spans=('root', 'size'), critical_time=('critical_time', 'sum'))
+    counts['share'] = counts['traces'] / max(n_traces, 1)
+    counts['mean_critical_time'] = counts['critical_time'] / counts['traces']
+    counts = counts.sort_values(['traces', 'critical_time'], ascending=False).reset_index()
+    counts.attrs['n_traces'] = n_traces
+
+    return counts
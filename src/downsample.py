@@ -0,0 +1,159 @@
+import pandas as pd
+import numpy as np
+
+from typing import Dict, List, Tuple
+
+from .timeseries import time_of_day
+from .profiling import profiled
+
+
+# Downsampling
+# A line plot cannot show more points than the axis is wide in pixels, so series are reduced to about that many points before plotting.
+# min/max keeps the lowest and highest point of every pixel column (so a one-sample spike at a failure still reaches its full height),
+# LTTB keeps the point of every bucket that best preserves the shape of the line. SeriesTiles precompute min/max levels of a whole day,
+# so that any zoom level is a slice of the closest level instead of a pass over the raw samples
+DOWNSAMPLE_METHODS = ('minmax', 'lttb')
+
+
+def _sorted_valid(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    '''
+    Return the positions of the non-NaN points, in increasing x order (stable).
+    '''
+    positions = np.flatnonzero(~np.isnan(y))
+    if len(positions) > 1 and np.any(x[positions][1:] < x[positions][:-1]):
+        positions = positions[np.argsort(x[positions], kind='stable')]
+
+    return positions
+
+
+def minmax_indices(x: np.ndarray, y: np.ndarray, n_bins: int) -> np.ndarray:
+    '''
+    Split the x range into n_bins equal bins, and return the positions (in x order) of the first and last points
+    and of the minimum and maximum of every bin, i.e. at most 2 * n_bins + 2 points. NaN values are dropped.
+    '''
+    x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+    positions = _sorted_valid(x, y)
+    if len(positions) <= 2 * n_bins + 2:
+        return positions
+
+    x_valid = x[positions].astype(np.float64)
+    span = max(x_valid[-1] - x_valid[0], np.finfo(np.float64).tiny)
+    bins = np.floor((x_valid - x_valid[0]) / span * n_bins).astype(np.int64).clip(0, n_bins - 1)
+
+    # Sort by (bin, y): the first point of each bin is its minimum and the last its maximum
+    order = np.lexsort((y[positions], bins))
+    boundaries = np.flatnonzero(np.diff(bins[order]))
+    minimum = order[np.r_[0, boundaries + 1]]
+    maximum = order[np.r_[boundaries, len(order) - 1]]
+
+    keep = np.unique(np.concatenate([[0, len(positions) - 1], minimum, maximum]))
+    return positions[keep]
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    '''
+    Largest-Triangle-Three-Buckets: keep the first and last points, and from each of n_out - 2 equal-count buckets the point forming
+    the largest triangle with the point kept from the previous bucket and the average of the next bucket.
+    Return the positions (in x order) of the n_out points kept. NaN values are dropped.
+    '''
+    x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+    positions = _sorted_valid(x, y)
+    n = len(positions)
+    if n_out >= n or n_out < 3:
+        return positions
+
+    x_valid, y_valid = x[positions].astype(np.float64), y[positions]
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    # Averages of every bucket (and of the last point, which follows the last bucket), in one pass
+    starts = np.r_[edges[:-1], n - 1]
+    counts = np.diff(np.r_[starts, n])
+    average_x = np.add.reduceat(x_valid, starts) / counts
+    average_y = np.add.reduceat(y_valid, starts) / counts
+
+    # Buckets padded to the same width by repeating their last point (argmax keeps the first of equal areas), so every step is a row
+    width = int(counts[:-1].max())
+    padded = np.minimum(edges[:-1, None] + np.arange(width), edges[1:, None] - 1)
+    bucket_x, bucket_y = x_valid[padded], y_valid[padded]
+
+    # The doubled triangle area with the previous point p and the next average a is |(p_x - a_x) * (y - p_y) + (a_y - p_y) * (x - p_x)|,
+    # so each step is a single expression over one row, with the previous point kept as scalars
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous_x, previous_y = x_valid[0], y_valid[0]
+    for bucket in range(n_out - 2):
+        a = previous_x - average_x[bucket + 1]
+        b = average_y[bucket + 1] - previous_y
+        best = int(np.argmax(np.abs(a * (bucket_y[bucket] - previous_y) + b * (bucket_x[bucket] - previous_x))))
+        selected[bucket + 1] = padded[bucket, best]
+        previous_x, previous_y = bucket_x[bucket, best], bucket_y[bucket, best]
+
+    return positions[selected]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, n_points: int, method: str = 'minmax') -> np.ndarray:
+    '''
+    Return the positions (in x order) of about n_points points representing the series, with minmax_indices() (n_points / 2 bins)
+    or lttb_indices(). Series with fewer points are returned whole.
+    '''
+    if method == 'minmax':
+        return minmax_indices(x, y, max(n_points // 2, 1))
+    if method == 'lttb':
+        return lttb_indices(x, y, n_points)
+
+    raise ValueError(f"method must be one of {DOWNSAMPLE_METHODS}, not {method!r}")
+
+
+class SeriesTiles:
+    '''
+    Multi-resolution min/max levels of one series, finest first: level 0 holds every (non-NaN) point sorted by x,
+    and every following level halves the previous one with minmax_indices(), down to about min_points points.
+    The levels add up to at most twice the raw series, and every level keeps the extremes of the series.
+
+    view() answers a zoom (x range and pixel width) from the finest level with few enough points in the range.
+    '''
+
+    def __init__(self, x: np.ndarray, y: np.ndarray, min_points: int = 1024):
+        x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+        positions = _sorted_valid(x, y)
+        self.levels: List[Tuple[np.ndarray, np.ndarray]] = [(x[positions], y[positions])]
+
+        while len(self.levels[-1][0]) > min_points:
+            level_x, level_y = self.levels[-1]
+            keep = minmax_indices(level_x, level_y, len(level_x) // 4)
+            if len(keep) >= len(level_x):
+                break
+            self.levels.append((level_x[keep], level_y[keep]))
+
+    def __len__(self) -> int:
+        return len(self.levels[0][0])
+
+    def view(self, start=None, end=None, n_points: int = 2000) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Return the x and y values of at most about n_points points within [start, end] (the whole series if None).
+        '''
+        for level_x, level_y in self.levels:
+            first = np.searchsorted(level_x, start, 'left') if start is not None else 0
+            last = np.searchsorted(level_x, end, 'right') if end is not None else len(level_x)
+            if last - first <= 2 * n_points:
+                break
+
+        x, y = level_x[first:last], level_y[first:last]
+        if len(x) > n_points:
+            keep = minmax_indices(x, y, max(n_points // 2, 1))
+            x, y = x[keep], y[keep]
+
+        return x, y
+
+
+@profiled('index')
+def build_tiles(df: pd.DataFrame, time_column: str, value_column: str, key_columns: List[str], min_points: int = 1024) -> Dict[tuple, SeriesTiles]:
+    '''
+    Build the SeriesTiles of every series (unique key_columns) of a long dataframe, e.g. (cmdb_id, name) of read_host().
+    x is the time of day as int64 nanoseconds (see timeseries.time_of_day()), so that the tiles of a test and a train day share their x axis.
+    '''
+    x = time_of_day(df[time_column]).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    y = df[value_column].to_numpy(dtype=np.float64)
+
+    groups = df.groupby(key_columns, observed=True, sort=False).indices
+    return {key if isinstance(key, tuple) else (key,): SeriesTiles(x[positions], y[positions], min_points) for key, positions in groups.items()}
@@ -0,0 +1,172 @@
+import pandas as pd
+import numpy as np
+import argparse
+
+from typing import List
+
+from .compute_actual_time import parent_positions
+from .indexes import epoch_ms
+from .profiling import profiled
+
+
+# Error Origin Analysis
+# A failed call usually fails because something it called failed: the error surfaces at the top of a chain of failed spans
+# (success == False) and originates at its deepest end. Every failed span is mapped to the origin of its chain bottom-up,
+# one vectorized step per level of depth over the whole frame, so millions of spans are resolved without any per-trace filtering
+ORIGIN_COLUMNS = ['cmdb_id', 'serviceName', 'callType']
+
+
+def span_depths(parent: np.ndarray) -> np.ndarray:
+    '''
+    Return the depth of every span (0 for roots and spans whose parent is not in the dataframe), from parent_positions().
+
+    Spans on (or below) a cycle of parent pointers never reach a root, and get a depth of 0 too.
+    '''
+    depth = (parent >= 0).astype(np.int64)
+    ancestor = parent.copy()
+
+    # Pointer jumping: every step adds the depth of each span's ancestor and jumps to the ancestor's ancestor, doubling the distance covered,
+    # so a chain of depth d is resolved in log2(d) steps. A chain is at most len(parent) long, so spans left after that many steps are on a cycle
+    pending = np.flatnonzero(ancestor >= 0)
+    for _ in range(len(parent).bit_length() + 1):
+        if not len(pending):
+            break
+        above = ancestor[pending]
+        depth[pending] += depth[above]
+        ancestor[pending] = ancestor[above]
+        pending = pending[ancestor[pending] >= 0]
+
+    depth[pending] = 0
+    return depth.astype(np.int32)
+
+
+def _chain_surfaces(parent: np.ndarray, failed: np.ndarray) -> np.ndarray:
+    '''
+    Return, for every span, the row position of the top of its failed chain (the span where its error surfaced), itself for successful spans.
+    '''
+    surface = np.arange(len(parent))
+    chained = np.flatnonzero(failed & (parent >= 0))
+    chained = chained[failed[parent[chained]]]
+    surface[chained] = parent[chained]
+
+    # Pointer jumping up the failed parents, as in span_depths()
+    for _ in range(len(parent).bit_length() + 1):
+        following = surface[surface]
+        if np.array_equal(following, surface):
+            break
+        surface = following
+
+    return surface
+
+
+@profiled('compute')
+def error_origins(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Find where the error of every failed span of a trace dataframe (read_trace(), iter_trace() chunks or compact_trace() output) originated.
+
+    The origin of a failed span is itself if none of its children failed, otherwise the origin of its failed child whose origin is
+    the deepest (ties broken by the latest start). Adds the columns:
+    - error_origin: the row position of the originating span (-1 for successful spans)
+    - error_depth: the depth of the span in its trace
+    - error_surface: whether the span is the top of a failed chain (a failed span whose parent succeeded or is missing),
+      i.e. where the error surfaced to a caller that handled it
+
+    Spans whose parent is missing from the dataframe are treated as roots.
+    '''
+    parent = parent_positions(df)
+    depth = span_depths(parent)
+    failed = ~df['success'].to_numpy(dtype=bool)
+    start = epoch_ms(df['startTime'])
+
+    origin = np.where(failed, np.arange(len(df)), -1)
+    origin_depth = np.where(failed, depth, -1)
+
+    # Failed spans with a failed parent pass their origin up, deepest level first, so children are final before their parents
+    passing = np.flatnonzero(failed & (parent >= 0))
+    passing = passing[failed[parent[passing]]]
+    passing = passing[np.argsort(-depth[passing], kind='stable')]
+    levels = np.flatnonzero(np.diff(depth[passing])) + 1
+
+    for children in np.split(passing, levels):
+        # Sort the children by (parent, origin depth, start), so the last child of each parent carries the deepest origin
+        children = children[np.lexsort((start[origin[children]], origin_depth[children], parent[children]))]
+        parents = parent[children]
+        deeper = origin_depth[children] > origin_depth[parents]
+        origin[parents[deeper]] = origin[children[deeper]]   # the last assignment (deepest origin) wins
+        origin_depth[parents[deeper]] = origin_depth[children[deeper]]
+
+    df['error_origin'] = origin
+    df['error_depth'] = depth
+    df['error_surface'] = failed & ((parent < 0) | ~failed[parent.clip(min=0)])
+
+    return df
+
+
+@profiled('compute')
+def error_origin_counts(df: pd.DataFrame, bucket: str = '1min', by: List[str] = ORIGIN_COLUMNS) -> pd.DataFrame:
+    '''
+    Count the errors of a trace dataframe (e.g. a window from Query or read_trace_window()) per time bucket and originating node.
+
+    Every failed chain (see error_origins()) is counted once, in the bucket of the startTime of the span where it surfaced,
+    against the by columns (cmdb_id, serviceName and callType by default) of the span it originated at. The failed spans of a chain
+    are counted in the same bucket as the chain. Return one row per (bucket, origin) with:
+    - errors: number of failed chains originating there
+    - failed_spans: number of failed spans (of any chain) whose error originated there
+    - surfaced_at: the most frequent cmdb_id where these errors surfaced
+    '''
+    origins = error_origins(df.copy())
+    origin = origins['error_origin'].to_numpy()
+    failed = np.flatnonzero(origin >= 0)
+    surface = origins['error_surface'].to_numpy()[failed]
+    chain_surface = _chain_surfaces(parent_positions(origins), origin >= 0)[failed]
+
+    bucket_ms = int(pd.Timedelta(bucket) / pd.Timedelta(milliseconds=1))
+    spans = pd.DataFrame({column: origins[column].astype(str).to_numpy()[origin[failed]] for column in by})
+    spans['bucket'] = epoch_ms(origins['startTime'])[chain_surface] // bucket_ms * bucket_ms
+    spans['surface'] = surface
+    spans['surface_cmdb_id'] = origins['cmdb_id'].astype(str).to_numpy()[failed]
+
+    keys = ['bucket'] + list(by)
+    chains = spans[spans['surface']]
+    counts = chains.groupby(keys).size().rename('errors').to_frame()
+    counts['failed_spans'] = spans.groupby(keys).size().reindex(counts.index)
+
+    # Most frequent surfacing cmdb_id per group: the largest (group, cmdb_id) count, without a Python call per group
+    surfaced = chains.groupby(keys + ['surface_cmdb_id']).size().sort_values(kind='stable').reset_index()
+    surfaced = surfaced.drop_duplicates(keys, keep='last').set_index(keys)['surface_cmdb_id']
+    counts['surfaced_at'] = surfaced.reindex(counts.index)
+    counts = counts.reset_index()[keys + ['errors', 'failed_spans', 'surfaced_at']]
+
+    counts['bucket'] = pd.to_datetime(counts['bucket'], unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+    return counts.sort_values(['bucket', 'errors'], ascending=[True, False], ignore_index=True)
+
+
+def rank_error_origins(counts: pd.DataFrame, by: List[str] = ORIGIN_COLUMNS) -> pd.DataFrame:
+    '''
+    Rank the originating nodes of error_origin_counts() over all its buckets, by their number of errors.
+    '''
+    ranking = counts.groupby(list(by)).agg(errors=('errors', 'sum'), failed_spans=('failed_spans', 'sum'), buckets=('bucket', 'nunique'),
+                                           first=('bucket', 'min'), last=('bucket', 'max'))
+    ranking = ranking.sort_values(['errors', 'failed_spans'], ascending=False).reset_index()
+    ranking.insert(0, 'rank', np.arange(1, len(ranking) + 1))
+
+    return ranking
+
+
+if __name__ == '__main__':
+    from .query import Query
+    from .utils import has_msg_time
+
+    parser = argparse.ArgumentParser(description="Rank where the failed calls of the traces around a failure time originated.")
+    parser.add_argument('seconds_past', type=float, nargs='?', default=None, help="failure time, in seconds past 00:00 (the whole day if omitted)")
+    parser.add_argument('--prefix', default="test_data")
+    parser.add_argument('--interval', type=float, default=1800, help="seconds around the failure time")
+    parser.add_argument('--bucket', default='1min')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    query = Query('trace', prefix_path=args.prefix, test_data=has_msg_time(args.prefix))
+    if args.seconds_past is not None: query = query.window(args.seconds_past, args.interval)
+
+    counts = error_origin_counts(query.collect(), args.bucket)
+    print(rank_error_origins(counts).head(args.top).to_string(index=False))
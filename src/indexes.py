@@ -0,0 +1,225 @@
+import pandas as pd
+import numpy as np
+import math
+
+from typing import List, Tuple
+from .profiling import profiled
+
+
+# Per-trace index over read_trace() output
+class TraceIndex:
+    '''
+    Index built once over the traceId column of a trace dataframe (e.g. the output of read_trace()).
+
+    Row positions are sorted by traceId, with an offset and a length per trace, so that span counts, root lookups and per-trace slices
+    no longer require a full boolean scan of the dataframe (which is 1.4+ GB for test_data).
+
+    Traces are looked up by hashing the traceId (O(1)), and all batch APIs accept a list of traceIds.
+    '''
+
+    @profiled('index')
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+
+        # Intern the traceIds into dense codes (-1 for null traceIds)
+        codes, uniques = pd.factorize(df['traceId'])
+        self.trace_ids = pd.Index(np.asarray(uniques))
+
+        # Sort the row positions by trace (stable, so that the original row order is kept within a trace)
+        valid = np.flatnonzero(codes >= 0)
+        self.order = valid[np.argsort(codes[valid], kind='stable')]
+
+        # Offset and length of every trace in self.order
+        self.span_counts = np.bincount(codes[valid], minlength=len(self.trace_ids)).astype(np.int64)
+        self.offsets = np.zeros(len(self.trace_ids) + 1, dtype=np.int64)
+        np.cumsum(self.span_counts, out=self.offsets[1:])
+
+        # Row position of the root span (pid == "None") of every trace, -1 if the trace has no root in the dataframe
+        # If a trace has more than 1 root, the first one (in terms of row index) is kept
+        # Note that pandas >= 2.0 parses the "None" string as NaN by default, so null pids are treated as roots too
+        if 'pid' in df.columns:
+            is_root = (df['pid'] == "None") | df['pid'].isna()
+        else:
+            # compact_trace() dataframes mark roots with a parent of -1
+            is_root = df['parent'] == -1
+        root_rows = np.flatnonzero(is_root.to_numpy() & (codes >= 0))
+        self.root_positions = np.full(len(self.trace_ids), -1, dtype=np.int64)
+        self.root_positions[codes[root_rows][::-1]] = root_rows[::-1]
+
+    def __len__(self) -> int:
+        return len(self.trace_ids)
+
+    def codes(self, trace_list: List[str]) -> np.ndarray:
+        '''
+        Return the dense code of each traceId, -1 for traceIds that are not in the dataframe.
+        '''
+        return self.trace_ids.get_indexer(pd.Index(trace_list, dtype=object))
+
+    # Span counts
+    def length(self, trace_id: str) -> int:
+        return int(self.lengths([trace_id])[0])
+
+    def lengths(self, trace_list: List[str]) -> np.ndarray:
+        '''
+        Return the number of spans of each traceId (0 for traceIds that are not in the dataframe).
+        '''
+        codes = self.codes(trace_list)
+        return np.where(codes >= 0, self.span_counts[codes], 0)
+
+    # Per-trace slices
+    def positions(self, trace_list: List[str]) -> np.ndarray:
+        '''
+        Return the row positions of all spans of the given traceIds, grouped by trace in the order of trace_list.
+        '''
+        codes = self.codes(trace_list)
+        codes = codes[codes >= 0]
+
+        starts = self.offsets[codes]
+        lengths = self.span_counts[codes]
+
+        # Expand each (start, length) pair into a contiguous range without a Python loop
+        steps = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return self.order[np.repeat(starts, lengths) + steps]
+
+    def trace(self, trace_id: str) -> pd.DataFrame:
+        return self.take([trace_id])
+
+    def take(self, trace_list: List[str]) -> pd.DataFrame:
+        '''
+        Return all the rows of the given traceIds.
+        '''
+        return self.df.iloc[self.positions(trace_list)]
+
+    # Root lookups
+    def root(self, trace_id: str) -> pd.DataFrame:
+        return self.roots([trace_id])
+
+    def roots(self, trace_list: List[str]) -> pd.DataFrame:
+        '''
+        Return the root span (pid == "None") of each of the given traceIds, skipping traces without a root.
+        '''
+        codes = self.codes(trace_list)
+        positions = np.where(codes >= 0, self.root_positions[codes], -1)
+
+        return self.df.iloc[positions[positions >= 0]]
+
+
+# Time index for window queries
+def epoch_ms(timestamps: pd.Series) -> np.ndarray:
+    '''
+    Return the timestamps as int64 epoch milliseconds, for both datetime64[ns, Asia/Singapore] and raw (epoch ms) columns.
+    '''
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = (timestamps - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+
+    return timestamps.to_numpy(dtype=np.int64)
+
+
+def midnight_ms(timestamp_ms: int) -> int:
+    '''
+    Return the midnight (Asia/Singapore) of the day of an epoch ms timestamp, as epoch ms.
+    '''
+    day_start = pd.Timestamp(timestamp_ms, unit='ms', tz='UTC').tz_convert('Asia/Singapore').normalize()
+
+    return int(epoch_ms(pd.Series([day_start]))[0])
+
+
+def _series_key(key: Tuple) -> Tuple:
+    '''
+    Return the key of a series with its null values (NaN, None, NaT) as None, so that series with a null key can be looked up (NaN != NaN).
+    '''
+    return tuple(None if pd.isna(value) else value for value in key)
+
+
+class TimeIndex:
+    '''
+    Index built once over a timestamp column (e.g. 'timestamp' of read_host(), 'startTime' of read_trace()/read_esb()),
+    optionally per series (e.g. per ('cmdb_id', 'name') for host KPIs).
+
+    The timestamps of every series are stored as a sorted int64 (epoch ms) array, so that "rows within ±interval of seconds_past"
+    is answered with np.searchsorted instead of converting and comparing the whole column with .dt.time on every call.
+
+    Failure times (seconds past 00:00, as in data/failures.json) are resolved against the midnight of the day of the data,
+    so windows that cross midnight are handled correctly.
+    '''
+
+    @profiled('index')
+    def __init__(self, df: pd.DataFrame, time_column: str, key_columns: List[str] = None):
+        self.df = df
+        self.key_columns = list(key_columns or [])
+
+        timestamps = epoch_ms(df[time_column])
+        self.timestamps = timestamps
+
+        # Intern every series into a dense code (rows with a null key form their own series, rather than a NaN code)
+        if self.key_columns:
+            codes = df.groupby(self.key_columns, observed=True, sort=False, dropna=False).ngroup().to_numpy()
+            keys = df[self.key_columns].iloc[np.unique(codes, return_index=True)[1]]
+            self.keys = {_series_key(key): code for code, key in enumerate(keys.itertuples(index=False, name=None))}
+        else:
+            codes = np.zeros(len(df), dtype=np.int64)
+            self.keys = {(): 0}
+
+        # Sort the row positions by series, then by time
+        self.order = np.lexsort((timestamps, codes))
+        self.sorted_timestamps = timestamps[self.order]
+
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(self.keys)), out=self.offsets[1:])
+
+        # Row positions of all the series sorted by time, so that windows over all series are a single searchsorted too
+        if len(self.keys) > 1:
+            self.time_order = np.argsort(timestamps, kind='stable')
+            self.time_sorted_timestamps = timestamps[self.time_order]
+        else:
+            self.time_order, self.time_sorted_timestamps = self.order, self.sorted_timestamps
+
+        # Midnight (Asia/Singapore) of the day of the data, which seconds_past is relative to
+        self.day_start_ms = None
+        if len(timestamps):
+            self.day_start_ms = midnight_ms(int(timestamps.min()))
+
+    def positions(self, start_ms: int, end_ms: int, key: Tuple = None) -> np.ndarray:
+        '''
+        Return the row positions (sorted by time) with start_ms <= timestamp <= end_ms, for the given series key (or for all series).
+        '''
+        if key is None:
+            order, sorted_timestamps = self.time_order, self.time_sorted_timestamps
+        else:
+            key = _series_key(key if isinstance(key, tuple) else (key,))
+            if key not in self.keys:
+                return np.empty(0, dtype=np.int64)
+            lo, hi = self.offsets[self.keys[key]], self.offsets[self.keys[key] + 1]
+            order, sorted_timestamps = self.order[lo:hi], self.sorted_timestamps[lo:hi]
+
+        start = np.searchsorted(sorted_timestamps, start_ms, side='left')
+        end = np.searchsorted(sorted_timestamps, end_ms, side='right')
+
+        return order[start:end]
+
+    def window(self, start_ms: int, end_ms: int, key: Tuple = None) -> pd.DataFrame:
+        return self.df.iloc[self.positions(start_ms, end_ms, key)]
+
+    def around(self, seconds_past: float, interval: float, key: Tuple = None) -> pd.DataFrame:
+        '''
+        Return the rows within ±interval/2 seconds of the failure time (seconds past 00:00 of the day of the data).
+        '''
+        if self.day_start_ms is None:
+            return self.df.iloc[[]]
+
+        return self.window(*self.bounds(seconds_past, interval), key)
+
+    def bounds(self, seconds_past: float, interval: float) -> Tuple[int, int]:
+        '''
+        Return the [start, end] epoch ms window of ±interval/2 seconds around the failure time (seconds past 00:00 of the day of the data).
+        '''
+        return around_ms(self.day_start_ms, seconds_past, interval)
+
+
+def around_ms(day_start_ms: int, seconds_past: float, interval: float) -> Tuple[int, int]:
+    '''
+    Return the [start, end] epoch ms window of ±interval/2 seconds around seconds_past, for the day starting at day_start_ms.
+    '''
+    failure_ms = day_start_ms + int(seconds_past * 1000)
+
+    return math.ceil(failure_ms - interval * 1000 / 2), math.floor(failure_ms + interval * 1000 / 2)
@@ -0,0 +1,171 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+
+from typing import List, Tuple
+
+from .indexes import epoch_ms, midnight_ms, around_ms
+from .profiling import profiled
+
+
+# Host KPI Tensor
+# The long read_host() frame is pivoted once into a float32 (series x time bucket) array, with one row per existing (cmdb_id, name) pair
+# (block-sparse: host types have disjoint KPIs, so a dense host x KPI grid would be mostly empty), and dictionaries from names to positions
+class KpiTensor:
+    '''
+    Host KPI values on a regular time grid:
+    - hosts / kpis: the cmdb_id and name axes, with host_index / kpi_index dictionaries to their positions
+    - series: (n_series x 2) int32 array of the (host, KPI) positions of every row of values, with series_index from (cmdb_id, name) to row
+    - values: (n_series x n_buckets) float32 array (a read-only memory map once loaded), NaN where no sample falls in the bucket
+    - start_ms / bucket_ms: bucket b covers [start_ms + b * bucket_ms, start_ms + (b + 1) * bucket_ms), start_ms being midnight of the day
+
+    Whole-fleet queries (e.g. every KPI of every host in a 10 minute window) are array slices, see window() and dense().
+    '''
+
+    def __init__(self, hosts: List[str], kpis: List[str], series: np.ndarray, values: np.ndarray, start_ms: int, bucket_ms: int):
+        self.hosts = list(hosts)
+        self.kpis = list(kpis)
+        self.series = np.asarray(series, dtype=np.int32).reshape(-1, 2)
+        self.values = values
+        self.start_ms = int(start_ms)
+        self.bucket_ms = int(bucket_ms)
+
+        self.host_index = {host: position for position, host in enumerate(self.hosts)}
+        self.kpi_index = {kpi: position for position, kpi in enumerate(self.kpis)}
+        self.series_index = {(self.hosts[host], self.kpis[kpi]): row for row, (host, kpi) in enumerate(self.series.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.series)
+
+    @property
+    def timestamps(self) -> pd.DatetimeIndex:
+        '''
+        Start of every time bucket (Asia/Singapore).
+        '''
+        return pd.to_datetime(self.start_ms + np.arange(self.values.shape[1], dtype=np.int64) * self.bucket_ms, unit='ms', utc=True).tz_convert('Asia/Singapore')
+
+    def buckets(self, start_ms: int, end_ms: int) -> slice:
+        '''
+        Return the slice of the buckets overlapping [start_ms, end_ms].
+        '''
+        first = max((start_ms - self.start_ms) // self.bucket_ms, 0)
+        last = min((end_ms - self.start_ms) // self.bucket_ms + 1, self.values.shape[1])
+        return slice(int(first), int(max(last, first)))
+
+    def kpi(self, cmdb_id: str, name: str) -> pd.Series:
+        '''
+        Return the series of one KPI, indexed by bucket start (equivalent to filtering read_host() on cmdb_id and name).
+        '''
+        return pd.Series(self.values[self.series_index[(cmdb_id, name)]], index=self.timestamps, name=name)
+
+    def host(self, cmdb_id: str) -> pd.DataFrame:
+        '''
+        Return every KPI of a host, as a (bucket x KPI) dataframe.
+        '''
+        rows = np.flatnonzero(self.series[:, 0] == self.host_index[cmdb_id])
+        return pd.DataFrame(self.values[rows].T, index=self.timestamps, columns=[self.kpis[kpi] for kpi in self.series[rows, 1]])
+
+    def window(self, seconds_past: float, interval: float) -> Tuple[np.ndarray, pd.DatetimeIndex]:
+        '''
+        Return the (series x bucket) values within ±interval/2 seconds of seconds_past (seconds past 00:00, as in data/failures.json),
+        and the start of their buckets. Rows follow self.series.
+        '''
+        window = self.buckets(*around_ms(self.start_ms, seconds_past, interval))
+        return self.values[:, window], self.timestamps[window]
+
+    def dense(self, start_ms: int = None, end_ms: int = None) -> np.ndarray:
+        '''
+        Return a dense (host x KPI x bucket) float32 copy over [start_ms, end_ms] (the whole day by default), NaN for missing series.
+        '''
+        window = self.buckets(self.start_ms if start_ms is None else start_ms,
+                              self.start_ms + self.values.shape[1] * self.bucket_ms if end_ms is None else end_ms)
+        values = self.values[:, window]
+
+        dense = np.full((len(self.hosts), len(self.kpis), values.shape[1]), np.nan, dtype=np.float32)
+        dense[self.series[:, 0], self.series[:, 1]] = values
+
+        return dense
+
+    def save(self, directory: str) -> None:
+        '''
+        Save the values as directory/values.npy (memory-mappable) and the axes as directory/axes.json.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'values.npy'), np.asarray(self.values, dtype=np.float32))
+
+        with open(os.path.join(directory, 'axes.json'), 'w') as f:
+            json.dump({'hosts': self.hosts, 'kpis': self.kpis, 'series': self.series.tolist(), 'start_ms': self.start_ms, 'bucket_ms': self.bucket_ms}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'KpiTensor':
+        '''
+        Load a saved tensor, memory-mapping the values (read-only) unless mmap is False, so only the slices used are read from disk.
+        '''
+        with open(os.path.join(directory, 'axes.json')) as f:
+            axes = json.load(f)
+
+        values = np.load(os.path.join(directory, 'values.npy'), mmap_mode='r' if mmap else None)
+        return cls(axes['hosts'], axes['kpis'], np.array(axes['series']), values, axes['start_ms'], axes['bucket_ms'])
+
+
+@profiled('index')
+def build_kpi_tensor(host_df: pd.DataFrame, bucket: str = '1min', memory_budget: int = 64 * 2 ** 20) -> KpiTensor:
+    '''
+    Pivot a read_host() dataframe into a KpiTensor with buckets of the given size, starting at midnight of the day of the data.
+    Samples of the same series falling in the same bucket are averaged.
+
+    The float64 sums and counts of the average are accumulated one block of series at a time, sized so that they fit in memory_budget bytes,
+    so the only full-size array is the float32 tensor itself.
+    '''
+    bucket_ms = int(pd.Timedelta(bucket) / pd.Timedelta(milliseconds=1))
+    timestamps = epoch_ms(host_df['timestamp'])
+    start_ms = midnight_ms(int(timestamps.min())) if len(timestamps) else 0
+    n_buckets = int((timestamps.max() - start_ms) // bucket_ms + 1) if len(timestamps) else 0
+
+    host_codes, hosts = pd.factorize(host_df['cmdb_id'].astype(str), sort=True)
+    kpi_codes, kpis = pd.factorize(host_df['name'].astype(str), sort=True)
+
+    # Only the (host, KPI) pairs present in the data get a row
+    pair_codes = host_codes.astype(np.int64) * len(kpis) + kpi_codes
+    pairs, series_codes = np.unique(pair_codes, return_inverse=True)
+    series_codes = series_codes.ravel()
+    series = np.stack([pairs // len(kpis), pairs % len(kpis)], axis=1)
+
+    # Rows with a value, grouped by series (stable, so the samples of a cell are summed in the same order as in one pass)
+    values = host_df['value'].to_numpy(dtype=np.float64)
+    rows = np.flatnonzero(~np.isnan(values))
+    rows = rows[np.argsort(series_codes[rows], kind='stable')]
+    bucket_codes = (timestamps[rows] - start_ms) // bucket_ms
+
+    tensor = np.empty((len(pairs), n_buckets), dtype=np.float32)
+    block_size = max(int(memory_budget // (max(n_buckets, 1) * 16)), 1)
+    block_starts = np.arange(0, len(pairs) + block_size, block_size).clip(max=len(pairs))
+    block_bounds = np.searchsorted(series_codes[rows], block_starts)
+
+    # Average the samples of every (series, bucket) cell of a block with np.bincount
+    for first, last, lo, hi in zip(block_starts[:-1], block_starts[1:], block_bounds[:-1], block_bounds[1:]):
+        cells = (series_codes[rows[lo:hi]] - first) * n_buckets + bucket_codes[lo:hi]
+        sums = np.bincount(cells, weights=values[rows[lo:hi]], minlength=(last - first) * n_buckets)
+        counts = np.bincount(cells, minlength=(last - first) * n_buckets)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            tensor[first:last] = (sums / counts).reshape(last - first, n_buckets)
+
+    return KpiTensor(hosts.tolist(), kpis.tolist(), series, tensor, start_ms, bucket_ms)
+
+
+if __name__ == '__main__':
+    from .utils import read_host
+
+    parser = argparse.ArgumentParser(description="Pivot the host KPIs of a day into a memory-mappable KPI tensor.")
+    parser.add_argument('--prefix', default="test_data")
+    parser.add_argument('--bucket', default='1min')
+    parser.add_argument('--output', default=None, help="directory to save to (default: data/<prefix>/kpi_tensor)")
+    parser.add_argument('--cache', action='store_true', help="use the columnar on-disk cache (requires pyarrow)")
+    args = parser.parse_args()
+
+    tensor = build_kpi_tensor(read_host(args.prefix, cache=args.cache), args.bucket)
+    tensor.save(args.output or f"data/{args.prefix}/kpi_tensor")
+    print("Saved %s series of %s hosts and %s KPIs over %s buckets" % (len(tensor), len(tensor.hosts), len(tensor.kpis), tensor.values.shape[1]))
@@ -1,346 +1,515 @@
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
-import datetime
 
-from typing import Tuple
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from typing import Dict, List, NamedTuple, Tuple
 
 from .utils import read_esb, trace_length
+from .indexes import TimeIndex, TraceIndex
+from .query import Query
+from .timeseries import align_series, time_of_day, seconds_to_time_of_day
+from .downsample import SeriesTiles, build_tiles, downsample as downsample_indices
+from .profiling import profiled
+
+
+# Each comparison is split into a pure compute step (returning a NamedTuple of the filtered data) and a renderer.
+# The renderers either show the figure (pyplot), write it to a file via the Agg canvas without touching pyplot (output='x.png' / 'x.svg', show=False),
+# or are skipped entirely (render=False), so that batch jobs on headless servers do not pay for figures nobody looks at.
+# Series longer than the axis is wide (in pixels) are downsampled before plotting (downsample='minmax' or 'lttb', None to plot every point).
+def _new_figure(nrows: int, ncols: int, show: bool = True) -> Tuple[Figure, list]:
+      '''
+      Create a 30x15 figure, via pyplot if it is to be shown, otherwise as a standalone Figure on an Agg canvas.
+      '''
+      if show:
+            fig, axes = plt.subplots(nrows, ncols, figsize=(30, 15), squeeze=False)
+      else:
+            fig = Figure(figsize=(30, 15))
+            FigureCanvasAgg(fig)
+            axes = fig.subplots(nrows, ncols, squeeze=False)
+
+      return fig, axes.flatten().tolist()
+
+
+def _pixel_width(ax) -> int:
+      # Width of the axis in display pixels (i.e. the most points a line can show)
+      return max(int(ax.get_window_extent().width), 1)
+
+
+def _as_ns(dates) -> np.ndarray:
+      # Time of day datetimes as int64 nanoseconds
+      return pd.Series(dates).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def _downsampled(dates, values, max_points: int, method: str) -> Tuple[np.ndarray, np.ndarray]:
+      '''
+      Reduce a series to about max_points points (see downsample.downsample()), leaving shorter series untouched.
+      '''
+      if max_points is None or len(values) <= max_points:
+            return dates, values
+
+      x, y = _as_ns(dates), np.asarray(values, dtype=np.float64)
+      keep = downsample_indices(x, y, max_points, method)
+
+      return x[keep].view('datetime64[ns]'), y[keep]
+
+
+def _finish_figure(fig: Figure, output: str = None, show: bool = True) -> Figure:
+      '''
+      Save the figure to output (format inferred from the extension, e.g. .png or .svg) and/or show it.
+      '''
+      fig.tight_layout()
+
+      if output is not None:
+            fig.savefig(output)
+
+      if show:
+            plt.show()
+
+      return fig
+
+
+def _plot_test_train(ax,
+                     test_dates: list,
+                     test_values: pd.Series,
+                     train_dates: list,
+                     train_values: pd.Series,
+                     label: str,
+                     title: str,
+                     ylabel: str,
+                     seconds_past: int,
+                     aligned: pd.DataFrame = None,
+                     column: str = None,
+                     max_points: int = None,
+                     method: str = 'minmax') -> None:
+      '''
+      Plot the test and train series on the same axis & add a vertical line at the failure time.
+
+      If the aligned dataframe of align_series() is given, the area between the aligned test and train values of the column is filled.
+
+      If max_points is given, the series (and the filled area) are downsampled to about that many points with method ('minmax' or 'lttb').
+      '''
+      plt.setp(ax.xaxis.get_majorticklabels(), rotation=90)
+
+      test_dates, test_values = _downsampled(test_dates, test_values, max_points, method)
+      train_dates, train_values = _downsampled(train_dates, train_values, max_points, method)
+      if aligned is not None and max_points is not None and len(aligned) > max_points:
+            # Keep the extremes of both sides of the area
+            x = _as_ns(aligned.index)
+            keep = np.union1d(downsample_indices(x, aligned[f'{column}_test'].to_numpy(dtype=np.float64), max_points, 'minmax'),
+                              downsample_indices(x, aligned[f'{column}_train'].to_numpy(dtype=np.float64), max_points, 'minmax'))
+            aligned = aligned.iloc[keep]
+
+      ax.plot(test_dates, test_values, label=f'{label} (test)')
+      ax.plot(train_dates, train_values, label=f'{label} (train)', color='orange', alpha=0.5)
+      ax.axvline(x=seconds_to_time_of_day(seconds_past), color='r', linestyle='--', label=_hh_mm_ss_str(seconds_past))
+      if aligned is not None:
+            ax.fill_between(aligned.index, aligned[f'{column}_test'], aligned[f'{column}_train'], color='blue', alpha=0.05)
+
+      ax.set_title(title, fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
+      ax.set_xlabel('timestamp')
+      ax.set_ylabel(ylabel)
+      # ax.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
+      ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+      ax.legend(loc='upper left')
+
+
+def _hh_mm_ss_str(seconds_past: int) -> str:
+      # Return hh:mm:ss from seconds
+      return pd.to_datetime(seconds_past, unit='s').time().strftime('%H:%M:%S')
 
 
 # Analyse & Compare 2 ESB graphs
-def compare_esb(seconds_past: int, 
-                interval: int = 60, 
-                test_esb_filepath: str = r"data/test_data/esb.csv", 
-                train_esb_filepath: str = r"data/train_data/2020_05_04/esb.csv") -> Tuple[pd.DataFrame, pd.DataFrame]:
+ESB_COLUMNS = ['avg_time', 'num', 'succee_num', 'succee_rate']
+
+
+class EsbComparison(NamedTuple):
+      test_esb: pd.DataFrame
+      train_esb: pd.DataFrame
+      # Both days resampled onto a common time-of-day grid (see align_series())
+      aligned: pd.DataFrame
+      seconds_past: int
+      interval: int
+
+
+@profiled('compare')
+def esb_comparison(seconds_past: int,
+                   interval: int = 60,
+                   test_esb_filepath: str = r"data/test_data/esb.csv",
+                   train_esb_filepath: str = r"data/train_data/2020_05_04/esb.csv",
+                   test_esb: pd.DataFrame = None,
+                   train_esb: pd.DataFrame = None,
+                   freq: str = '1min',
+                   agg: str = 'mean') -> EsbComparison:
+      '''
+      Compute step of compare_esb(): filter the ESB data to the specified range (in mins) around the timestamp,
+      and align both days on a common time-of-day grid of freq (aggregated with agg).
+
+      If the ESB dataframes are given (e.g. already loaded with read_esb()), the filepaths are not read again.
+      '''
+      if test_esb is None: test_esb = read_esb(test_esb_filepath)
+      if train_esb is None: train_esb = read_esb(train_esb_filepath)
+
+      # Filter by timestamp range (interval is in mins)
+      test_esb = TimeIndex(test_esb, 'startTime').around(seconds_past, interval * 60)
+      train_esb = TimeIndex(train_esb, 'startTime').around(seconds_past, interval * 60)
+
+      aligned = align_series(test_esb, train_esb, 'startTime', ESB_COLUMNS, freq, agg)
+
+      return EsbComparison(test_esb, train_esb, aligned, seconds_past, interval)
+
+
+@profiled('plot')
+def render_esb_comparison(comparison: EsbComparison, output: str = None, show: bool = True, downsample: str = 'minmax') -> Figure:
+      '''
+      Render step of compare_esb(): plot avg_time, num, succee_num and succee_rate of both days.
+      '''
+      hh_mm_ss_str = _hh_mm_ss_str(comparison.seconds_past)
+      test_esb, train_esb = comparison.test_esb, comparison.train_esb
+
+      fig, axes = _new_figure(2, 2, show)
+
+      test_dates = time_of_day(test_esb.startTime)
+      train_dates = time_of_day(train_esb.startTime)
+
+      ylabels = {'avg_time': 'avg_time (ms)'}
+      for ax, column in zip(axes, ESB_COLUMNS):
+            _plot_test_train(ax, test_dates, test_esb[column], train_dates, train_esb[column],
+                             column, column, ylabels.get(column, column), comparison.seconds_past, comparison.aligned, column,
+                             _pixel_width(ax) if downsample else None, downsample)
+
+      # Add a title for the entire plot
+      fig.suptitle(f'Comparing ESB Data at {hh_mm_ss_str} (Range: {comparison.interval} mins)', fontsize=20, fontweight='bold', color='red', x=0.5)
+
+      return _finish_figure(fig, output, show)
+
+
+@profiled('plot')
+def compare_esb(seconds_past: int,
+                interval: int = 60,
+                test_esb_filepath: str = r"data/test_data/esb.csv",
+                train_esb_filepath: str = r"data/train_data/2020_05_04/esb.csv",
+                test_esb: pd.DataFrame = None,
+                train_esb: pd.DataFrame = None,
+                freq: str = '1min',
+                agg: str = 'mean',
+                output: str = None,
+                show: bool = True,
+                render: bool = True,
+                downsample: str = 'minmax') -> Tuple[pd.DataFrame, pd.DataFrame]:
       '''
       Since ESB data are recorded in intervals of 1 min, we filter the data by to the specified range (in mins) around the timestamp.
 
       Beware of the interval choice to avoid error (empty graph) due to missing data.
       E.g. For 00:37:00, if interval = 80, there is no data earlier than 00:00:00
+
+      If the ESB dataframes are given (e.g. already loaded with read_esb()), the filepaths are not read again.
+
+      The area between both days is filled after resampling them onto a common time-of-day grid of freq (see align_series()).
+
+      The figure is saved to output if given, shown if show is True, and not built at all if render is False.
+      Series longer than the axis width are downsampled with downsample ('minmax' or 'lttb', None to plot every point).
       '''
-      # Return hh:mm:ss from seconds
-      hh_mm_ss_dt = pd.to_datetime(seconds_past, unit='s')
-      hh_mm_ss_str = hh_mm_ss_dt.time().strftime('%H:%M:%S')
-
-
-      test_esb = read_esb(test_esb_filepath)
-      train_esb = read_esb(train_esb_filepath)
-
-      # Filter by timestamp range
-      test_esb.startTime = test_esb.startTime.dt.time
-      train_esb.startTime = train_esb.startTime.dt.time
-
-      test_esb = test_esb[
-            (test_esb.startTime >= (hh_mm_ss_dt - pd.Timedelta(minutes=interval/2)).time()) & 
-            (test_esb.startTime <= (hh_mm_ss_dt + pd.Timedelta(minutes=interval/2)).time())]
-      train_esb = train_esb[
-            (train_esb.startTime >= (hh_mm_ss_dt - pd.Timedelta(minutes=interval/2)).time()) & 
-            (train_esb.startTime <= (hh_mm_ss_dt + pd.Timedelta(minutes=interval/2)).time())]
-
-
-      # Plot the data
-      fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(2, 2, figsize=(30, 15))
-      plt.setp(ax1.xaxis.get_majorticklabels(), rotation=90)
-      plt.setp(ax2.xaxis.get_majorticklabels(), rotation=90)
-      plt.setp(ax3.xaxis.get_majorticklabels(), rotation=90)
-      plt.setp(ax4.xaxis.get_majorticklabels(), rotation=90)
-
-      test_dates = [datetime.datetime.strptime(str(ts), '%H:%M:%S') for ts in test_esb.startTime]
-      train_dates = [datetime.datetime.strptime(str(ts), '%H:%M:%S') for ts in train_esb.startTime]
-
-      # Plot avg_time & add a vertical line at x = 0.5
-      ax1.plot(test_dates, test_esb.avg_time, label='avg_time (test)')
-      ax1.plot(train_dates, train_esb.avg_time, label='avg_time (train)', color='orange', alpha=0.5)
-      ax1.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-      try:
-            ax1.fill_between(test_dates, test_esb.avg_time, train_esb.avg_time, color='blue', alpha=0.05)
-      except:
-            pass
-
-      ax1.set_title('avg_time', fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax1.set_xlabel('timestamp')
-      ax1.set_ylabel('avg_time (ms)')
-      # ax1.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax1.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax1.legend(loc='upper left')
-
-      # Plot num & add a vertical line at x = 0.5
-      ax2.plot(test_dates, test_esb.num, label='num (test)')
-      ax2.plot(train_dates, train_esb.num, label='num (train)', color='orange', alpha=0.5)
-      ax2.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-      try:
-            ax2.fill_between(test_dates, test_esb.num, train_esb.num, color='blue', alpha=0.05)
-      except:
-            pass
-
-      ax2.set_title('num', fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax2.set_xlabel('timestamp')
-      ax2.set_ylabel('num')
-      # ax2.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax2.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax2.legend(loc='upper left')
-
-      # Plot succee_num & add a vertical line at x = 0.5
-      ax3.plot(test_dates, test_esb.succee_num, label='succee_num (test)')
-      ax3.plot(train_dates, train_esb.succee_num, label='succee_num (train)', color='orange', alpha=0.5)
-      ax3.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-      try:
-            ax3.fill_between(test_dates, test_esb.succee_num, train_esb.succee_num, color='blue', alpha=0.05)
-      except:
-            pass
-
-      ax3.set_title('succee_num', fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax3.set_xlabel('timestamp')
-      ax3.set_ylabel('succee_num')
-      # ax3.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax3.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax3.legend(loc='upper left')
-
-      # Plot succee_rate & add a vertical line at x = 0.5
-      ax4.plot(test_dates, test_esb.succee_rate, label='succee_rate (test)')
-      ax4.plot(train_dates, train_esb.succee_rate, label='succee_rate (train)', color='orange', alpha=0.5)
-      ax4.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-      try:
-            ax4.fill_between(test_dates, test_esb.succee_rate, train_esb.succee_rate, color='blue', alpha=0.05)
-      except:
-            pass
-
-      ax4.set_title('succee_rate', fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax4.set_xlabel('timestamp')
-      ax4.set_ylabel('succee_rate')
-      # ax4.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax4.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax4.legend(loc='upper left')
+      comparison = esb_comparison(seconds_past, interval, test_esb_filepath, train_esb_filepath, test_esb, train_esb, freq, agg)
 
-      # Add a title for the entire plot
-      fig.suptitle(f'Comparing ESB Data at {hh_mm_ss_str} (Range: {interval} mins)', fontsize=20, fontweight='bold', color='red', x=0.5)
-      plt.tight_layout()
-      plt.show()
+      if render:
+            render_esb_comparison(comparison, output, show, downsample)
 
-      return test_esb, train_esb
+      return comparison.test_esb, comparison.train_esb
 
 
 # Analyse & Compare 2 Host graphs
-def compare_host(test_host: pd.DataFrame, 
-                train_host: pd.DataFrame,
-                seconds_past: int,
-                cmdb_id: str,
-                name: str,
-                interval: int = 60) -> Tuple[pd.DataFrame, pd.DataFrame]:
+@profiled('index')
+def host_time_index(host: pd.DataFrame) -> TimeIndex:
       '''
-      The data will first be filtered based on cmdb_id and name/key_name.
+      Build the TimeIndex used by compare_host(), i.e. per (cmdb_id, name) series of the read_host() dataframe.
+      '''
+      return TimeIndex(host, 'timestamp', ['cmdb_id', 'name'])
 
-      Since host data KPIs are recorded in different intervals (some in 1 second interval, some in 5 min interval), we filter the data by to the specified range (in seconds for greater granularity) around the timestamp.
 
-      Beware of the interval choice to avoid error (empty graph) due to missing data.
-      E.g. For 00:37:00, if interval = 80, there is no data earlier than 00:00:00
+def host_tiles(host: pd.DataFrame, min_points: int = 1024) -> Dict[Tuple[str, str], SeriesTiles]:
       '''
-      # Return hh:mm:ss from seconds
-      hh_mm_ss_dt = pd.to_datetime(seconds_past, unit='s')
-      hh_mm_ss_str = hh_mm_ss_dt.time().strftime('%H:%M:%S')
+      Build the multi-resolution tiles used by compare_host() to plot wide ranges, i.e. per (cmdb_id, name) series of the read_host() dataframe.
+      '''
+      return build_tiles(host, 'timestamp', 'value', ['cmdb_id', 'name'], min_points)
+
+
+class HostComparison(NamedTuple):
+      test_host: pd.DataFrame
+      train_host: pd.DataFrame
+      seconds_past: int
+      # Both days resampled onto a common time-of-day grid (see align_series())
+      aligned: pd.DataFrame
+      cmdb_id: str
+      name: str
+      interval: int
+
+
+@profiled('compare')
+def host_comparison(test_host: pd.DataFrame,
+                    train_host: pd.DataFrame,
+                    seconds_past: int,
+                    cmdb_id: str,
+                    name: str,
+                    interval: int = 60,
+                    test_index: TimeIndex = None,
+                    train_index: TimeIndex = None,
+                    freq: str = None,
+                    agg: str = 'mean') -> HostComparison:
+      '''
+      Compute step of compare_host(): filter the host data based on cmdb_id and name, and to the specified range (in seconds) around the timestamp,
+      and align both days on a common time-of-day grid of freq (inferred from the KPI's sampling interval if None, aggregated with agg).
+      '''
+      # Filter based on cmdb_id and name, and by timestamp range
+      if test_index is None: test_index = host_time_index(test_host)
+      if train_index is None: train_index = host_time_index(train_host)
 
+      test_host = test_index.around(seconds_past, interval, key=(cmdb_id, name))
+      train_host = train_index.around(seconds_past, interval, key=(cmdb_id, name))
 
-      # Filter based on cmdb_id and name
-      test_host = test_host[(test_host.cmdb_id == cmdb_id) & (test_host.name == name)]
-      train_host = train_host[(train_host.cmdb_id == cmdb_id) & (train_host.name == name)]
+      aligned = align_series(test_host, train_host, 'timestamp', ['value'], freq, agg)
 
-      # Filter by timestamp range
-      test_host.timestamp = test_host.timestamp.dt.time
-      train_host.timestamp = train_host.timestamp.dt.time
+      return HostComparison(test_host, train_host, seconds_past, aligned, cmdb_id, name, interval)
 
-      test_host = test_host[
-            (test_host.timestamp >= (hh_mm_ss_dt - pd.Timedelta(seconds=interval/2)).time()) & 
-            (test_host.timestamp <= (hh_mm_ss_dt + pd.Timedelta(seconds=interval/2)).time())]
-      train_host = train_host[
-            (train_host.timestamp >= (hh_mm_ss_dt - pd.Timedelta(seconds=interval/2)).time()) & 
-            (train_host.timestamp <= (hh_mm_ss_dt + pd.Timedelta(seconds=interval/2)).time())]
 
-      # # Truncate the 2 dataframe to the same length
-      # train_host = train_host.iloc[:len(test_host)]
+@profiled('plot')
+def render_host_comparison(comparison: HostComparison,
+                           output: str = None,
+                           show: bool = True,
+                           downsample: str = 'minmax',
+                           tiles: Tuple[SeriesTiles, SeriesTiles] = None) -> Figure:
+      '''
+      Render step of compare_host(): plot the KPI value of both days.
 
-      # Plot the data
-      fig, ax = plt.subplots(1, 1, figsize=(30, 15))
-      plt.setp(ax.xaxis.get_majorticklabels(), rotation=90)
+      If the (test, train) tiles of the KPI are given (see host_tiles()), the lines are read from their closest level instead of the raw rows.
+      '''
+      hh_mm_ss_str = _hh_mm_ss_str(comparison.seconds_past)
+      test_host, train_host, name = comparison.test_host, comparison.train_host, comparison.name
 
-      test_dates = [datetime.datetime.strptime(str(ts), '%H:%M:%S') for ts in test_host.timestamp]
-      train_dates = [datetime.datetime.strptime(str(ts), '%H:%M:%S') for ts in train_host.timestamp]
+      fig, (ax,) = _new_figure(1, 1, show)
+      max_points = _pixel_width(ax) if downsample else None
 
-      # Plot avg_time & add a vertical line at x = 0.5
-      ax.plot(test_dates, test_host.value, label=f'{name} value (test)')
-      ax.plot(train_dates, train_host.value, label=f'{name} value (train)', color='orange', alpha=0.5)
-      ax.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-      try:
-            ax.fill_between(test_dates, test_host.value, train_host.value, color='blue', alpha=0.05)
-      except:
-            pass
+      if tiles is not None:
+            start = _as_ns([seconds_to_time_of_day(comparison.seconds_past - comparison.interval / 2)])[0]
+            end = _as_ns([seconds_to_time_of_day(comparison.seconds_past + comparison.interval / 2)])[0]
+            (test_x, test_values), (train_x, train_values) = [series_tiles.view(start, end, max_points or len(series_tiles)) for series_tiles in tiles]
+            test_dates, train_dates = test_x.view('datetime64[ns]'), train_x.view('datetime64[ns]')
+      else:
+            test_dates, test_values = time_of_day(test_host.timestamp), test_host.value
+            train_dates, train_values = time_of_day(train_host.timestamp), train_host.value
 
-      ax.set_title(name, fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax.set_xlabel('timestamp')
-      ax.set_ylabel(name)
-      # ax.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax.legend(loc='upper left')
+      _plot_test_train(ax, test_dates, test_values, train_dates, train_values,
+                       f'{name} value', name, name, comparison.seconds_past, comparison.aligned, 'value', max_points, downsample)
 
       # Add a title for the entire plot
-      fig.suptitle(f'Comparing Host Data for {cmdb_id} at {hh_mm_ss_str} (Range: {interval} seconds)', fontsize=20, fontweight='bold', color='red', x=0.5)
-      plt.tight_layout()
-      plt.show()
+      fig.suptitle(f'Comparing Host Data for {comparison.cmdb_id} at {hh_mm_ss_str} (Range: {comparison.interval} seconds)', fontsize=20, fontweight='bold', color='red', x=0.5)
 
-      return test_host, train_host
+      return _finish_figure(fig, output, show)
 
-# Analyse & Compare 2 Trace graphs for Failure 1
-def compare_trace_for_failure(test_trace: pd.DataFrame, 
-                                train_trace: pd.DataFrame,
-                                seconds_past: int,
-                                interval: int = -1, 
-                                # strictly_parent: bool = True
-                              ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-      '''
-      # Depending on the value of strictly_parent, the data will first be filtered based pid == 'None' for strictly_parent rows.
 
-      This allows us to obtain the parent traceId and compare the data of the parent traceId.
+@profiled('plot')
+def compare_host(test_host: pd.DataFrame,
+                train_host: pd.DataFrame,
+                seconds_past: int,
+                cmdb_id: str,
+                name: str,
+                interval: int = 60,
+                test_index: TimeIndex = None,
+                train_index: TimeIndex = None,
+                freq: str = None,
+                agg: str = 'mean',
+                output: str = None,
+                show: bool = True,
+                render: bool = True,
+                downsample: str = 'minmax',
+                test_tiles: Dict[Tuple[str, str], SeriesTiles] = None,
+                train_tiles: Dict[Tuple[str, str], SeriesTiles] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+      '''
+      The data will first be filtered based on cmdb_id and name/key_name.
 
-      We filter the data to the specified range (in seconds for greater granularity) around the timestamp.
+      Since host data KPIs are recorded in different intervals (some in 1 second interval, some in 5 min interval), we filter the data by to the specified range (in seconds for greater granularity) around the timestamp.
 
       Beware of the interval choice to avoid error (empty graph) due to missing data.
       E.g. For 00:37:00, if interval = 80, there is no data earlier than 00:00:00
+
+      The filtering uses a TimeIndex per (cmdb_id, name) of test_host/train_host. Pass prebuilt indexes (see host_time_index()) to reuse them across calls.
+
+      The area between both days is filled after resampling them onto a common time-of-day grid of freq (see align_series()),
+      which defaults to the KPI's own sampling interval.
+
+      The figure is saved to output if given, shown if show is True, and not built at all if render is False.
+      Series longer than the axis width are downsampled with downsample ('minmax' or 'lttb', None to plot every point).
+      For wide ranges (e.g. a whole day), pass prebuilt tiles of both days (see host_tiles()) so the lines are sliced from precomputed levels.
       '''
-      # Return hh:mm:ss from seconds
-      hh_mm_ss_dt = pd.to_datetime(seconds_past, unit='s')
-      hh_mm_ss_str = hh_mm_ss_dt.time().strftime('%H:%M:%S')
+      comparison = host_comparison(test_host, train_host, seconds_past, cmdb_id, name, interval, test_index, train_index, freq, agg)
+
+      if render:
+            tiles = None
+            if test_tiles is not None and train_tiles is not None and (cmdb_id, name) in test_tiles and (cmdb_id, name) in train_tiles:
+                  tiles = (test_tiles[(cmdb_id, name)], train_tiles[(cmdb_id, name)])
+            render_host_comparison(comparison, output, show, downsample, tiles)
+
+      return comparison.test_host, comparison.train_host
 
+
+# Analyse & Compare 2 Trace graphs for Failure 1
+class TraceComparison(NamedTuple):
+      test_trace_filtered: pd.DataFrame
+      train_trace_filtered: pd.DataFrame
+      test_trace_sampled_parent: pd.DataFrame
+      train_trace_sampled_parent: pd.DataFrame
+      test_trace_length_list: List[int]
+      train_trace_length_list: List[int]
+      # Parent rows in the time range, per host (cmdb_id)
+      test_trace_filtered_parent_hosts: Dict[str, pd.DataFrame]
+      train_trace_filtered_parent_hosts: Dict[str, pd.DataFrame]
+      seconds_past: int
+      interval: float
+
+
+def default_trace_interval(test_trace: pd.DataFrame) -> float:
       # Dynamic interval (in seconds) to observe trend (same value used for both test and train)
-      if interval == -1: interval = 3 * 2 * (test_trace.elapsedTime.max() / 100)   # Multiply by 3 again to observe the wider trend
+      return 3 * 2 * (test_trace.elapsedTime.max() / 100)   # Multiply by 3 again to observe the wider trend
+
+
+def _rows_by_host(df: pd.DataFrame, hosts: Tuple[str, ...]) -> Dict[str, pd.DataFrame]:
+      '''
+      Split the rows of df by cmdb_id into one dataframe per host (in the original row order, empty for hosts without rows).
+      '''
+      groups = df.groupby(df.cmdb_id.astype(str), sort=False).indices
+
+      return {name: df.iloc[groups.get(name, [])] for name in hosts}
+
+
+@profiled('compare')
+def trace_comparison(test_trace: pd.DataFrame,
+                     train_trace: pd.DataFrame,
+                     seconds_past: int,
+                     interval: int = -1,
+                     test_index: TraceIndex = None,
+                     train_index: TraceIndex = None,
+                     test_time_index: TimeIndex = None,
+                     train_time_index: TimeIndex = None,
+                     hosts: Tuple[str, ...] = ('os_021', 'os_022'),
+                     seed: int = None) -> TraceComparison:
+      '''
+      Compute step of compare_trace_for_failure(): filter the trace data to the specified range (in seconds) around the timestamp,
+      sample up to 100 parent traceIds (reproducibly if seed is given) and obtain their trace length, and obtain the parent rows of each of the hosts.
+      '''
+      if interval == -1: interval = default_trace_interval(test_trace)
 
       # Filter for start_time
-      test_trace_filtered = test_trace[
-            (test_trace.startTime.dt.time >= (hh_mm_ss_dt - pd.Timedelta(seconds=interval/2)).time()) & 
-            (test_trace.startTime.dt.time <= (hh_mm_ss_dt + pd.Timedelta(seconds=interval/2)).time())]
-      train_trace_filtered = train_trace[
-            (train_trace.startTime.dt.time >= (hh_mm_ss_dt - pd.Timedelta(seconds=interval/2)).time()) &
-            (train_trace.startTime.dt.time <= (hh_mm_ss_dt + pd.Timedelta(seconds=interval/2)).time())]
+      if test_time_index is None: test_time_index = TimeIndex(test_trace, 'startTime')
+      if train_time_index is None: train_time_index = TimeIndex(train_trace, 'startTime')
+      test_trace_filtered = test_time_index.around(seconds_past, interval)
+      train_trace_filtered = train_time_index.around(seconds_past, interval)
 
-      # Filter for parent rows only
-      test_trace_filtered_parent = test_trace_filtered[test_trace_filtered.pid == 'None']
-      train_trace_filtered_parent = train_trace_filtered[train_trace_filtered.pid == 'None']
+      # Filter for parent rows only, queried once from the whole dataframes (and split per host below)
+      test_trace_filtered_parent = Query('trace', test_trace, time_index=test_time_index).window(seconds_past, interval).roots().collect()
+      train_trace_filtered_parent = Query('trace', train_trace, time_index=train_time_index).window(seconds_past, interval).roots().collect()
 
-      # Sample 100 parent traceId
-      test_trace_sampled_parent = test_trace_filtered_parent.sample(100).sort_values(by='startTime')
-      train_trace_sampled_parent = train_trace_filtered_parent.sample(100).sort_values(by='startTime')
+      # Sample 100 parent traceId (or all of them in windows with fewer parents)
+      test_trace_sampled_parent = test_trace_filtered_parent.sample(min(100, len(test_trace_filtered_parent)), random_state=seed).sort_values(by='startTime')
+      train_trace_sampled_parent = train_trace_filtered_parent.sample(min(100, len(train_trace_filtered_parent)), random_state=seed).sort_values(by='startTime')
 
       # Obtain the parent traceId
       test_parent_traceId_list = test_trace_sampled_parent.traceId.tolist()
       train_parent_traceId_list = train_trace_sampled_parent.traceId.tolist()
 
-      # Obtain traceId length
-      test_trace_length_list = trace_length(test_trace, test_parent_traceId_list)
-      train_trace_length_list = trace_length(train_trace, train_parent_traceId_list)
+      # Obtain traceId length (from the index, instead of rescanning the whole trace dataframe per traceId)
+      if test_index is None: test_index = TraceIndex(test_trace)
+      if train_index is None: train_index = TraceIndex(train_trace)
+      test_trace_length_list = trace_length(test_trace, test_parent_traceId_list, test_index)
+      train_trace_length_list = trace_length(train_trace, train_parent_traceId_list, train_index)
 
-      # Create the timestamps for graph axis
-      test_dates = []
-      for ts in test_trace_sampled_parent.startTime.dt.time:
-            try:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
+      # Obtain the parent rows of each host, from a single grouping of the parent rows by cmdb_id
+      test_trace_filtered_parent_hosts = _rows_by_host(test_trace_filtered_parent, hosts)
+      train_trace_filtered_parent_hosts = _rows_by_host(train_trace_filtered_parent, hosts)
 
-      train_dates = []
-      for ts in train_trace_sampled_parent.startTime.dt.time:
-            try:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
+      return TraceComparison(test_trace_filtered, train_trace_filtered, test_trace_sampled_parent, train_trace_sampled_parent,
+                             test_trace_length_list, train_trace_length_list,
+                             test_trace_filtered_parent_hosts, train_trace_filtered_parent_hosts, seconds_past, interval)
 
 
-      # Graph 1: traceId length
-      # Graph 2: elapsedTime (parent - os_021)
-      # Graph 3: elapsedTime (parent - os_022)
+@profiled('plot')
+def render_trace_comparison(comparison: TraceComparison, output: str = None, show: bool = True, downsample: str = 'minmax') -> Figure:
+      '''
+      Render step of compare_trace_for_failure():
+      Graph 1: traceId length
+      Graph 2 onwards: elapsedTime of the parent rows of each host (e.g. os_021, os_022)
+      '''
+      hh_mm_ss_str = _hh_mm_ss_str(comparison.seconds_past)
+      hosts = list(comparison.test_trace_filtered_parent_hosts.keys())
+
+      fig, axes = _new_figure(1 + len(hosts), 1, show)
 
       # Graph 1: traceId length
-      fig, (ax1, ax2, ax3) = plt.subplots(3, 1, figsize=(30, 15))
-
-      # Plot avg_time & add a vertical line at x = 0.5
-      ax1.plot(test_dates, test_trace_length_list, label='os_021 trace length (test)')
-      ax1.plot(train_dates, train_trace_length_list, label='os_021 trace length (train)', color='orange', alpha=0.5)
-      ax1.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-
-      ax1.set_title("Trace Length", fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax1.set_xlabel('timestamp')
-      ax1.set_ylabel('trace length')
-      # ax1.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax1.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax1.legend(loc='upper left')
-
-
-      # Graph 2: elapsedTime (parent - os_021)
-      # Create the timestamps for graph axis
-      name = 'os_021'
-      test_trace_filtered_parent_os_021 = test_trace_filtered_parent[test_trace_filtered_parent.cmdb_id == name]
-      train_trace_filtered_parent_os_021 = train_trace_filtered_parent[train_trace_filtered_parent.cmdb_id == name]
-
-      test_dates = []
-      for ts in test_trace_filtered_parent_os_021.startTime.dt.time:
-            try:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
-
-      train_dates = []
-      for ts in train_trace_filtered_parent_os_021.startTime.dt.time:
-            try:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
-
-      # Plot elapsedTime for os_021 & add a vertical line at x = 0.5
-      ax2.plot(test_dates, test_trace_filtered_parent_os_021.elapsedTime, label=f'{name} elapsedTime (test)')
-      ax2.plot(train_dates, train_trace_filtered_parent_os_021.elapsedTime, label=f'{name} elapsedTime (train)', color='orange', alpha=0.5)
-      ax2.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-
-      ax2.set_title(name, fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax2.set_xlabel('timestamp')
-      ax2.set_ylabel('elapsedTime')
-      # ax2.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax2.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax2.legend(loc='upper left')
-
-      # Graph 3: elapsedTime (parent - os_022)
-      # Create the timestamps for graph axis
-      name = 'os_022'
-      test_trace_filtered_parent_os_022 = test_trace_filtered_parent[test_trace_filtered_parent.cmdb_id == name]
-      train_trace_filtered_parent_os_022 = train_trace_filtered_parent[train_trace_filtered_parent.cmdb_id == name]
-
-      test_dates = []
-      for ts in test_trace_filtered_parent_os_022.startTime.dt.time:
-            try:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  test_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
-
-      train_dates = []
-      for ts in train_trace_filtered_parent_os_022.startTime.dt.time:
-            try:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S.%f'))
-            except:
-                  train_dates.append(datetime.datetime.strptime(str(ts), '%H:%M:%S'))
-
-      # Plot elapsedTime for os_022 & add a vertical line at x = 0.5
-      ax3.plot(test_dates, test_trace_filtered_parent_os_022.elapsedTime, label=f'{name} elapsedTime (test)')
-      ax3.plot(train_dates, train_trace_filtered_parent_os_022.elapsedTime, label=f'{name} elapsedTime (train)', color='orange', alpha=0.5)
-      ax3.axvline(x=datetime.datetime.strptime(hh_mm_ss_str, '%H:%M:%S'), color='r', linestyle='--', label=hh_mm_ss_str)
-
-      ax3.set_title(name, fontsize=15, fontweight='bold', pad=30, color='black', loc='center')
-      ax3.set_xlabel('timestamp')
-      ax3.set_ylabel('elapsedTime')
-      # ax3.xaxis.set_major_locator(mdates.MinuteLocator(interval=5))
-      ax3.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-      ax3.legend(loc='upper left')
+      test_dates = time_of_day(comparison.test_trace_sampled_parent.startTime)
+      train_dates = time_of_day(comparison.train_trace_sampled_parent.startTime)
+
+      _plot_test_train(axes[0], test_dates, comparison.test_trace_length_list, train_dates, comparison.train_trace_length_list,
+                       'os_021 trace length', "Trace Length", 'trace length', comparison.seconds_past,
+                       max_points=_pixel_width(axes[0]) if downsample else None, method=downsample)
+
+      # Graph 2 onwards: elapsedTime (parent - host)
+      for ax, name in zip(axes[1:], hosts):
+            test_trace_filtered_parent_host = comparison.test_trace_filtered_parent_hosts[name]
+            train_trace_filtered_parent_host = comparison.train_trace_filtered_parent_hosts[name]
+
+            test_dates = time_of_day(test_trace_filtered_parent_host.startTime)
+            train_dates = time_of_day(train_trace_filtered_parent_host.startTime)
+
+            _plot_test_train(ax, test_dates, test_trace_filtered_parent_host.elapsedTime, train_dates, train_trace_filtered_parent_host.elapsedTime,
+                             f'{name} elapsedTime', name, 'elapsedTime', comparison.seconds_past,
+                             max_points=_pixel_width(ax) if downsample else None, method=downsample)
 
       # Add a title for the entire plot
-      fig.suptitle(f'Comparing Trace Data at {hh_mm_ss_str} (Range: {interval} seconds)', fontsize=20, fontweight='bold', color='red', x=0.5)
-      plt.tight_layout()
-      plt.show()
+      fig.suptitle(f'Comparing Trace Data at {hh_mm_ss_str} (Range: {comparison.interval} seconds)', fontsize=20, fontweight='bold', color='red', x=0.5)
+
+      return _finish_figure(fig, output, show)
+
+
+@profiled('plot')
+def compare_trace_for_failure(test_trace: pd.DataFrame,
+                                train_trace: pd.DataFrame,
+                                seconds_past: int,
+                                interval: int = -1,
+                                # strictly_parent: bool = True
+                                test_index: TraceIndex = None,
+                                train_index: TraceIndex = None,
+                                test_time_index: TimeIndex = None,
+                                train_time_index: TimeIndex = None,
+                                output: str = None,
+                                show: bool = True,
+                                render: bool = True,
+                                downsample: str = 'minmax',
+                                seed: int = None,
+                              ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+      '''
+      # Depending on the value of strictly_parent, the data will first be filtered based pid == 'None' for strictly_parent rows.
+
+      This allows us to obtain the parent traceId and compare the data of the parent traceId.
+
+      We filter the data to the specified range (in seconds for greater granularity) around the timestamp.
+
+      Trace lengths are looked up from a TraceIndex, and the time range from a TimeIndex on startTime, of test_trace/train_trace.
+      Pass prebuilt indexes to reuse them across calls.
+
+      Beware of the interval choice to avoid error (empty graph) due to missing data.
+      E.g. For 00:37:00, if interval = 80, there is no data earlier than 00:00:00
+
+      The figure is saved to output if given, shown if show is True, and not built at all if render is False.
+      Series longer than the axis width (e.g. the parent rows of a wide default interval) are downsampled with downsample ('minmax' or 'lttb', None to plot every point).
+      The 100 parent traces of the trace length graph are sampled reproducibly if seed is given.
+      '''
+      comparison = trace_comparison(test_trace, train_trace, seconds_past, interval, test_index, train_index, test_time_index, train_time_index, seed=seed)
 
-      return test_trace_filtered, train_trace_filtered, test_trace_length_list, train_trace_length_list,test_trace_filtered_parent_os_021, train_trace_filtered_parent_os_021, test_trace_filtered_parent_os_022, train_trace_filtered_parent_os_022
+      if render:
+            render_trace_comparison(comparison, output, show, downsample)
 
+      return (comparison.test_trace_filtered, comparison.train_trace_filtered,
+              comparison.test_trace_length_list, comparison.train_trace_length_list,
+              comparison.test_trace_filtered_parent_hosts['os_021'], comparison.train_trace_filtered_parent_hosts['os_021'],
+              comparison.test_trace_filtered_parent_hosts['os_022'], comparison.train_trace_filtered_parent_hosts['os_022'])
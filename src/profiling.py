@@ -0,0 +1,151 @@
+import pandas as pd
+import functools
+import json
+import os
+import time
+
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List
+
+
+# Pipeline Instrumentation
+# Readers, index builders, comparisons and plots are decorated with @profiled. The decorator is a no-op until profiling is enabled
+# (with the profile() context manager), then every call records its wall time, rows and DataFrame sizes
+class Profiler:
+    '''
+    Collects one record per profiled call:
+    - name / stage: the qualified function name, and its stage ('reader', 'index', 'compute', 'compare' or 'plot')
+    - seconds: wall time, including the nested profiled calls (see depth / parent)
+    - input_rows / output_rows: rows of the DataFrame arguments / results, and rows_per_second (the larger of the two, per second)
+    - input_mb / output_mb / size_delta_mb: shallow size of the DataFrame arguments / results, and their difference
+      (the size of the data in and out of the call, not the memory used by the process, which is not measured)
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.records: List[dict] = []
+        self._stack: List[str] = []
+        self._start = time.perf_counter()
+
+    def reset(self) -> None:
+        self.records = []
+        self._stack = []
+        self._start = time.perf_counter()
+
+    def summary(self) -> pd.DataFrame:
+        '''
+        Return the records aggregated per function, sorted by total time (nested calls are counted in their callers too).
+        '''
+        records = pd.DataFrame(self.records, columns=['name', 'stage', 'seconds', 'input_rows', 'output_rows', 'size_delta_mb'])
+        summary = records.groupby(['name', 'stage'], sort=False).agg(
+            calls=('seconds', 'size'), seconds=('seconds', 'sum'), input_rows=('input_rows', 'sum'),
+            output_rows=('output_rows', 'sum'), size_delta_mb=('size_delta_mb', 'sum'))
+
+        return summary.sort_values('seconds', ascending=False).reset_index()
+
+    def report(self, path: str) -> None:
+        '''
+        Write the records and their summary to a JSON report.
+        '''
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+
+        with open(path, 'w') as f:
+            json.dump({'records': self.records, 'summary': self.summary().to_dict(orient='records')}, f, indent=2, default=str)
+
+
+PROFILER = Profiler()
+
+
+def _frames(value: Any) -> List[pd.DataFrame]:
+    '''
+    Return the DataFrames of a value, looking one level into tuples, lists and dictionaries (e.g. NamedTuple results).
+    '''
+    if isinstance(value, pd.DataFrame):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [item for item in value if isinstance(item, pd.DataFrame)]
+    if isinstance(value, dict):
+        return [item for item in value.values() if isinstance(item, pd.DataFrame)]
+
+    return []
+
+
+def _size(frames: List[pd.DataFrame]) -> tuple:
+    # Shallow memory usage: deep=True would scan every string of the object columns
+    return sum(len(df) for df in frames), sum(int(df.memory_usage(index=True, deep=False).sum()) for df in frames) / 2**20
+
+
+@contextmanager
+def stage(name: str, stage: str = 'stage', inputs: Any = None) -> Iterator[dict]:
+    '''
+    Profile a block of code as a single record. The yielded record can be given an 'output' (e.g. the DataFrame produced),
+    whose rows and memory are then recorded.
+    '''
+    if not PROFILER.enabled:
+        yield {}
+        return
+
+    input_rows, input_mb = _size(_frames(inputs) if inputs is not None else [])
+    record = {'name': name, 'stage': stage, 'depth': len(PROFILER._stack), 'parent': PROFILER._stack[-1] if PROFILER._stack else None}
+
+    PROFILER._stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        PROFILER._stack.pop()
+
+        output_rows, output_mb = _size(_frames(record.pop('output', None)))
+        record.update({
+            'start': start - PROFILER._start,
+            'seconds': seconds,
+            'input_rows': input_rows,
+            'output_rows': output_rows,
+            'rows_per_second': max(input_rows, output_rows) / seconds if seconds > 0 else None,
+            'input_mb': input_mb,
+            'output_mb': output_mb,
+            'size_delta_mb': output_mb - input_mb,
+        })
+        PROFILER.records.append(record)
+
+
+def profiled(stage_name: str) -> Callable:
+    '''
+    Decorator recording every call of the function as a stage_name record, while profiling is enabled.
+    '''
+    def decorator(func: Callable) -> Callable:
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+
+            with stage(name, stage_name, list(args) + list(kwargs.values())) as record:
+                result = func(*args, **kwargs)
+                record['output'] = result
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profile(path: str = None) -> Iterator[Profiler]:
+    '''
+    Enable profiling within the block, and write the JSON report to path (if given) on exit.
+
+        with profile("output/profile.json") as profiler:
+            run_failure(...)
+        print(profiler.summary())
+    '''
+    PROFILER.reset()
+    PROFILER.enabled = True
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.enabled = False
+        if path is not None: PROFILER.report(path)
@@ -0,0 +1,235 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import time
+
+from typing import Dict, Tuple
+
+from .indexes import epoch_ms, midnight_ms, around_ms
+from .kpi_tensor import KpiTensor, build_kpi_tensor
+from .profiling import profiled
+
+
+# Failure Propagation (Lead / Lag Analysis)
+# Host KPIs, per-cmdb_id trace latency and error rate, and ESB statistics are aligned on common time buckets around a failure,
+# and every pair of series is cross-correlated at every lag in one batch of FFTs. A pair correlating best when series A is shifted
+# later than series B means B moved first: B -> A is an edge of the lead / lag graph
+ESB_SERIES_COLUMNS = ['avg_time', 'succee_rate']
+
+
+def _bucket_means(keys: pd.Series, timestamps: np.ndarray, values: np.ndarray, start_ms: int, bucket_ms: int, n_buckets: int) -> pd.DataFrame:
+    '''
+    Average the values per (key, bucket) with np.bincount, into a (bucket x key) dataframe with NaN for empty buckets.
+    '''
+    codes, uniques = pd.factorize(keys)
+    cells = codes * n_buckets + (timestamps - start_ms) // bucket_ms
+    sums = np.bincount(cells, weights=values, minlength=len(uniques) * n_buckets)
+    counts = np.bincount(cells, minlength=len(uniques) * n_buckets)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame((sums / counts).reshape(len(uniques), n_buckets).T, columns=list(uniques))
+
+
+@profiled('compute')
+def failure_series(seconds_past: float,
+                   test_host: pd.DataFrame = None,
+                   test_trace: pd.DataFrame = None,
+                   test_esb: pd.DataFrame = None,
+                   window: float = 1800,
+                   bucket: str = '1min',
+                   kpi_tensor: KpiTensor = None) -> pd.DataFrame:
+    '''
+    Return the series of every source within ±window/2 seconds of the failure time, aligned on common buckets (rows)
+    with one column per series, named '<source>:<node>:<metric>':
+    - 'host:<cmdb_id>:<name>' from read_host() (or from a KpiTensor with the same bucket size, sliced instead of scanned)
+    - 'trace:<cmdb_id>:elapsedTime' and 'trace:<cmdb_id>:error_rate' from read_trace()
+    - 'esb:<serviceName>:avg_time' and 'esb:<serviceName>:succee_rate' from read_esb()
+    '''
+    bucket_ms = int(pd.Timedelta(bucket) / pd.Timedelta(milliseconds=1))
+    frames = []
+
+    # Common grid of the window, resolved against midnight of the day of the data
+    if kpi_tensor is not None:
+        day_start_ms = kpi_tensor.start_ms
+    else:
+        reference = next(((df, column) for df, column in [(test_host, 'timestamp'), (test_trace, 'startTime'), (test_esb, 'startTime')]
+                          if df is not None and len(df)), None)
+        if reference is None:
+            raise ValueError("failure_series() needs a kpi_tensor or at least one non-empty test_host, test_trace or test_esb dataframe")
+        day_start_ms = midnight_ms(int(epoch_ms(reference[0][reference[1]]).min()))
+    start_ms, end_ms = around_ms(day_start_ms, seconds_past, window)
+    start_ms -= start_ms % bucket_ms
+    n_buckets = int((end_ms - start_ms) // bucket_ms + 1)
+
+    # Host KPIs
+    if kpi_tensor is not None and kpi_tensor.bucket_ms == bucket_ms:
+        buckets = kpi_tensor.buckets(start_ms, end_ms)
+        values = np.full((len(kpi_tensor), n_buckets), np.nan, dtype=np.float32)
+        offset = int((kpi_tensor.start_ms + buckets.start * bucket_ms - start_ms) // bucket_ms)
+        sliced = kpi_tensor.values[:, buckets]
+        values[:, offset:offset + sliced.shape[1]] = sliced
+        names = [f"host:{kpi_tensor.hosts[host]}:{kpi_tensor.kpis[kpi]}" for host, kpi in kpi_tensor.series]
+        frames.append(pd.DataFrame(values.T.astype(np.float64), columns=names))
+    elif test_host is not None:
+        timestamps = epoch_ms(test_host['timestamp'])
+        mask = (timestamps >= start_ms) & (timestamps <= end_ms)
+        host = test_host[mask]
+        keys = 'host:' + host['cmdb_id'].astype(str) + ':' + host['name'].astype(str)
+        frames.append(_bucket_means(keys, timestamps[mask], host['value'].to_numpy(dtype=np.float64), start_ms, bucket_ms, n_buckets))
+
+    # Trace latency and error rate per cmdb_id
+    if test_trace is not None:
+        timestamps = epoch_ms(test_trace['startTime'])
+        mask = (timestamps >= start_ms) & (timestamps <= end_ms)
+        trace = test_trace[mask]
+        cmdb_id = trace['cmdb_id'].astype(str)
+        frames.append(_bucket_means('trace:' + cmdb_id + ':elapsedTime', timestamps[mask], trace['elapsedTime'].to_numpy(dtype=np.float64),
+                                    start_ms, bucket_ms, n_buckets))
+        frames.append(_bucket_means('trace:' + cmdb_id + ':error_rate', timestamps[mask], (~trace['success'].to_numpy(dtype=bool)).astype(np.float64),
+                                    start_ms, bucket_ms, n_buckets))
+
+    # ESB
+    if test_esb is not None:
+        timestamps = epoch_ms(test_esb['startTime'])
+        mask = (timestamps >= start_ms) & (timestamps <= end_ms)
+        esb = test_esb[mask]
+        for column in ESB_SERIES_COLUMNS:
+            frames.append(_bucket_means('esb:' + esb['serviceName'].astype(str) + ':' + column, timestamps[mask],
+                                        esb[column].to_numpy(dtype=np.float64), start_ms, bucket_ms, n_buckets))
+
+    series = pd.concat(frames, axis=1)
+    series.index = pd.to_datetime(start_ms + np.arange(n_buckets, dtype=np.int64) * bucket_ms, unit='ms', utc=True).tz_convert('Asia/Singapore')
+
+    return series
+
+
+def lagged_cross_correlation(series: np.ndarray, max_lag: int, memory_budget: int = 256 * 2 ** 20) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Cross-correlate every pair of columns of a (time x series) array at every lag in [-max_lag, max_lag], with one batch of FFTs.
+
+    Each column is standardised (missing values count as the mean), so that the lag 0 value is the Pearson correlation.
+    Return the (series x series) correlation of largest magnitude over the lags, and the lag it occurs at:
+    lag[i, j] = k > 0 means series i best matches series j shifted k buckets later, i.e. j leads i.
+
+    The pairs are processed in blocks of rows sized so that the cross spectra of a block fit in memory_budget bytes.
+    '''
+    n_time, n_series = series.shape
+    standardised = series - np.nanmean(series, axis=0)
+    norm = np.sqrt(np.nansum(standardised ** 2, axis=0))
+    standardised = np.nan_to_num(standardised / np.where(norm > 0, norm, np.inf))
+
+    # Zero padding to at least twice the length avoids the wrap-around of circular correlation
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_time)))
+    spectrum = np.fft.rfft(standardised, n=n_fft, axis=0)
+    lags = np.arange(-max_lag, max_lag + 1)
+
+    # Only 2 * max_lag + 1 lags are needed, so the inverse transform is a (lag x frequency) matrix product instead of a full irfft
+    frequencies = np.arange(spectrum.shape[0])
+    weights = np.where((frequencies == 0) | (frequencies == n_fft // 2), 1.0, 2.0) / n_fft
+    inverse = weights * np.exp(2j * np.pi * np.outer(lags % n_fft, frequencies) / n_fft)
+
+    best_correlation = np.zeros((n_series, n_series))
+    best_lag = np.zeros((n_series, n_series), dtype=np.int64)
+
+    # Blocks of rows bound the (frequency x block x series) complex128 intermediate to the memory budget
+    block_size = max(int(memory_budget // (len(frequencies) * max(n_series, 1) * 16)), 1)
+    for first in range(0, n_series, block_size):
+        block = slice(first, min(first + block_size, n_series))
+        cross_spectrum = spectrum[:, block, None] * np.conj(spectrum[:, None, :])
+        correlation = (inverse @ cross_spectrum.reshape(len(frequencies), -1)).real.reshape(len(lags), -1, n_series)
+
+        best = np.argmax(np.abs(correlation), axis=0)
+        best_correlation[block] = np.take_along_axis(correlation, best[None], axis=0)[0]
+        best_lag[block] = lags[best]
+
+    return best_correlation, best_lag
+
+
+@profiled('compare')
+def lead_lag_graph(series: pd.DataFrame, max_lag: int = 5, min_correlation: float = 0.6) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    '''
+    Build the lead / lag graph of aligned series (e.g. failure_series()), skipping series without variation in the window.
+
+    Return:
+    - edges: leader -> follower pairs with a positive lag (in buckets, and in seconds) and |correlation| >= min_correlation,
+      sorted by |correlation|
+    - nodes: every series ranked by how much it leads the others (sum of |correlation| of its outgoing edges less its incoming edges)
+    '''
+    values = series.to_numpy(dtype=np.float64)
+    varying = np.nanstd(values, axis=0) > 0
+    names = series.columns[varying]
+
+    correlation, lag = lagged_cross_correlation(values[:, varying], max_lag)
+
+    # lag[i, j] > 0: j leads i
+    follower, leader = np.nonzero((lag > 0) & (np.abs(correlation) >= min_correlation))
+    bucket_seconds = (series.index[1] - series.index[0]).total_seconds() if len(series) > 1 else 0
+    edges = pd.DataFrame({
+        'leader': names[leader],
+        'follower': names[follower],
+        'lag': lag[follower, leader],
+        'lag_seconds': lag[follower, leader] * bucket_seconds,
+        'correlation': correlation[follower, leader],
+    })
+    edges = edges.iloc[np.argsort(-np.abs(edges['correlation'].to_numpy()), kind='stable')].reset_index(drop=True)
+
+    weight = np.abs(edges['correlation'])
+    leads = weight.groupby(edges['leader']).sum().reindex(names, fill_value=0)
+    follows = weight.groupby(edges['follower']).sum().reindex(names, fill_value=0)
+    nodes = pd.DataFrame({'series': names, 'out_degree': edges['leader'].value_counts().reindex(names, fill_value=0).to_numpy(),
+                          'in_degree': edges['follower'].value_counts().reindex(names, fill_value=0).to_numpy(),
+                          'lead_score': (leads - follows).to_numpy()})
+    nodes = nodes.sort_values('lead_score', ascending=False, ignore_index=True)
+
+    return edges, nodes
+
+
+def propagation_for_failures(failures_path: str = "data/failures.json",
+                             test_host: pd.DataFrame = None,
+                             test_trace: pd.DataFrame = None,
+                             test_esb: pd.DataFrame = None,
+                             window: float = 1800,
+                             bucket: str = '1min',
+                             max_lag: int = 5,
+                             min_correlation: float = 0.6) -> Dict[int, dict]:
+    '''
+    Compute the lead / lag graph of every failure of failures_path. The host KPIs are pivoted into a KpiTensor once and sliced per failure.
+
+    Return, per failure time, the edges and nodes of lead_lag_graph() and the seconds taken.
+    '''
+    with open(failures_path) as f:
+        failures = json.load(f)
+
+    kpi_tensor = build_kpi_tensor(test_host, bucket) if test_host is not None else None
+
+    results = {}
+    for seconds_past, _ in failures:
+        start = time.perf_counter()
+        series = failure_series(seconds_past, None, test_trace, test_esb, window, bucket, kpi_tensor)
+        edges, nodes = lead_lag_graph(series, max_lag, min_correlation)
+        results[seconds_past] = {'edges': edges, 'nodes': nodes, 'seconds': time.perf_counter() - start}
+
+    return results
+
+
+if __name__ == '__main__':
+    from .utils import has_msg_time, read_host, read_trace, read_esb
+
+    parser = argparse.ArgumentParser(description="Build the lead / lag graph of every failure of data/failures.json.")
+    parser.add_argument('--prefix', default="test_data")
+    parser.add_argument('--failures', default="data/failures.json")
+    parser.add_argument('--window', type=float, default=1800, help="seconds around each failure")
+    parser.add_argument('--bucket', default='1min')
+    parser.add_argument('--max-lag', type=int, default=5, help="largest lag, in buckets")
+    parser.add_argument('--min-correlation', type=float, default=0.6)
+    parser.add_argument('--top', type=int, default=10, help="edges and leaders printed per failure")
+    args = parser.parse_args()
+
+    results = propagation_for_failures(args.failures, read_host(args.prefix), read_trace(args.prefix, test_data=has_msg_time(args.prefix)),
+                                       read_esb(f"data/{args.prefix}/esb.csv"), args.window, args.bucket, args.max_lag, args.min_correlation)
+
+    for seconds_past, result in results.items():
+        print(f"\n=== Failure at {seconds_past}s: {len(result['nodes'])} series, {len(result['edges'])} edges ({result['seconds']:.2f}s) ===")
+        print(result['nodes'].head(args.top).to_string(index=False))
+        print(result['edges'].head(args.top).to_string(index=False))
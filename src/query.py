@@ -0,0 +1,231 @@
+import pandas as pd
+import numpy as np
+import glob
+
+from typing import Callable, List, Tuple, Union
+
+from .utils import read_host, read_esb, iter_trace, _concat_frames
+from .indexes import TimeIndex, epoch_ms, midnight_ms, around_ms
+from .profiling import profiled
+
+
+# Lazy Queries
+# A Query accumulates filters, a projection, a sample and an aggregation, and only runs them on collect(), in a single pass:
+# predicates are evaluated column by column on the candidate row positions, and the rows are copied once at the end
+TIME_COLUMNS = {'host': 'timestamp', 'trace': 'startTime', 'esb': 'startTime'}
+
+# Predicates that iter_trace() can apply while reading the trace CSVs
+TRACE_PUSHDOWN_COLUMNS = ('cmdb_id', 'serviceName')
+
+
+class Query:
+    '''
+    Lazy query over a host, trace or ESB source, e.g. the parent spans of os_021 around a failure:
+
+        Query('trace', trace_df).window(seconds_past, 600).roots().where(cmdb_id='os_021').collect()
+
+    The source is either a dataframe already loaded (optionally with its TimeIndex, so that windows are answered with np.searchsorted),
+    or the CSV files of prefix_path (data/<prefix_path>/...), read only when collected. For trace files, the time window, roots()
+    and the cmdb_id / serviceName filters are pushed down into iter_trace(), so rows outside the query are never converted or kept.
+    Host and ESB files are read with read_host() / read_esb() (with the columnar cache if cache is True).
+
+    Every method returns a new Query, so a common prefix (e.g. a window) can be shared by several queries.
+    '''
+
+    def __init__(self,
+                 source: str,
+                 frame: pd.DataFrame = None,
+                 prefix_path: str = "test_data",
+                 time_index: TimeIndex = None,
+                 test_data: bool = False,
+                 cache: bool = False):
+        if source not in TIME_COLUMNS:
+            raise ValueError(f"source must be one of {list(TIME_COLUMNS)}, not {source!r}")
+
+        self.source = source
+        self.frame = frame
+        self.prefix_path = prefix_path
+        self.time_index = time_index
+        self.test_data = test_data
+        self.cache = cache
+        self.plan = {'window': None, 'between': None, 'roots': False, 'equals': {}, 'predicates': [], 'columns': None, 'sample': None, 'agg': None}
+
+    def _with(self, **changes) -> 'Query':
+        query = Query(self.source, self.frame, self.prefix_path, self.time_index, self.test_data, self.cache)
+        query.plan = {**self.plan, **changes}
+        return query
+
+    # Plan
+    def window(self, seconds_past: float, interval: float) -> 'Query':
+        '''
+        Keep the rows within ±interval/2 seconds of seconds_past (seconds past 00:00 of the day of the data, as in data/failures.json).
+        '''
+        return self._with(window=(seconds_past, interval), between=None)
+
+    def between(self, start_ms: int, end_ms: int) -> 'Query':
+        '''
+        Keep the rows with start_ms <= time <= end_ms (epoch milliseconds).
+        '''
+        return self._with(between=(start_ms, end_ms), window=None)
+
+    def roots(self) -> 'Query':
+        '''
+        Keep the parent spans only (pid == "None"), for trace sources.
+        '''
+        if self.source != 'trace':
+            raise ValueError("roots() only applies to trace sources")
+
+        return self._with(roots=True)
+
+    def where(self, predicate: Callable[[pd.DataFrame], pd.Series] = None, **equals) -> 'Query':
+        '''
+        Keep the rows where every column equals its value (or is in it, for lists), and where predicate(df) is True if given.
+        Column filters are evaluated before any row is copied; predicates see the rows left by all the other filters.
+        '''
+        merged = dict(self.plan['equals'])
+        for column, value in equals.items():
+            values = set(value) if isinstance(value, (list, tuple, set)) else {value}
+            merged[column] = merged[column] & values if column in merged else values
+
+        predicates = self.plan['predicates'] + ([predicate] if predicate is not None else [])
+        return self._with(equals=merged, predicates=predicates)
+
+    def select(self, *columns: str) -> 'Query':
+        return self._with(columns=list(columns))
+
+    def sample(self, n: int, seed: int = None) -> 'Query':
+        '''
+        Keep n random rows (all of them if there are fewer), in their original order.
+        '''
+        return self._with(sample=(n, seed))
+
+    def agg(self, by: Union[str, List[str]] = None, **aggregations: Tuple[str, Union[str, Callable]]) -> 'Query':
+        '''
+        Aggregate the rows with named aggregations, e.g. agg(by='cmdb_id', mean_elapsed=('elapsedTime', 'mean'), spans=('id', 'size')).
+        '''
+        return self._with(agg=(by, aggregations))
+
+    def explain(self) -> str:
+        plan = {key: value for key, value in self.plan.items() if value not in (None, False, {}, [])}
+        origin = f"dataframe ({len(self.frame)} rows)" if self.frame is not None else f"files data/{self.prefix_path}"
+        return f"{self.source} query over {origin}: {plan}"
+
+    # Execution
+    def _bounds(self, day_start_ms: int) -> Tuple[int, int]:
+        if self.plan['between'] is not None:
+            return self.plan['between']
+        if self.plan['window'] is not None and day_start_ms is not None:
+            return around_ms(day_start_ms, *self.plan['window'])
+
+        return None
+
+    def _candidates(self, frame: pd.DataFrame, time_index: TimeIndex = None) -> np.ndarray:
+        '''
+        Return the row positions matching the time window and column filters, evaluated one column at a time.
+        '''
+        time_column = TIME_COLUMNS[self.source]
+
+        if self.plan['window'] is None and self.plan['between'] is None:
+            positions = np.arange(len(frame))
+        elif time_index is not None:
+            bounds = self._bounds(time_index.day_start_ms)
+            positions = np.sort(time_index.positions(*bounds)) if bounds is not None else np.empty(0, dtype=np.int64)
+        else:
+            timestamps = epoch_ms(frame[time_column])
+            bounds = self._bounds(midnight_ms(int(timestamps.min())) if len(timestamps) else None)
+            positions = np.flatnonzero((timestamps >= bounds[0]) & (timestamps <= bounds[1])) if bounds is not None else np.empty(0, dtype=np.int64)
+
+        if self.plan['roots']:
+            if 'pid' in frame.columns:
+                pid = frame['pid'].iloc[positions]
+                positions = positions[((pid == 'None') | pid.isna()).to_numpy()]
+            else:
+                positions = positions[frame['parent'].to_numpy()[positions] < 0]
+
+        for column, values in self.plan['equals'].items():
+            positions = positions[frame[column].iloc[positions].isin(list(values)).to_numpy()]
+
+        return positions
+
+    def _finish(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Apply the predicates, sample, projection and aggregation to the filtered rows.
+        '''
+        for predicate in self.plan['predicates']:
+            df = df[np.asarray(predicate(df), dtype=bool)]
+
+        if self.plan['sample'] is not None:
+            n, seed = self.plan['sample']
+            if n < len(df):
+                df = df.iloc[np.sort(np.random.default_rng(seed).choice(len(df), n, replace=False))]
+
+        if self.plan['agg'] is not None:
+            by, aggregations = self.plan['agg']
+            if by is None:
+                return pd.DataFrame({name: [df[column].agg(func)] for name, (column, func) in aggregations.items()})
+            return df.groupby(by, observed=True).agg(**aggregations).reset_index()
+
+        if self.plan['columns'] is not None:
+            df = df[self.plan['columns']]
+
+        return df
+
+    def _collect_frame(self, frame: pd.DataFrame, time_index: TimeIndex = None) -> pd.DataFrame:
+        positions = self._candidates(frame, time_index)
+
+        # Without predicates, the sample is drawn from the positions, so only the sampled rows are copied
+        if self.plan['sample'] is not None and not self.plan['predicates']:
+            n, seed = self.plan['sample']
+            if n < len(positions):
+                positions = np.sort(np.random.default_rng(seed).choice(positions, n, replace=False))
+            query = self._with(sample=None)
+        else:
+            query = self
+
+        # Copy only the needed columns, unless the predicates need to see the whole rows
+        columns = self.plan['columns']
+        if columns is not None and not self.plan['predicates'] and self.plan['agg'] is None:
+            return frame.iloc[positions, [frame.columns.get_loc(column) for column in columns]]
+
+        return query._finish(frame.iloc[positions])
+
+    def _collect_trace_files(self) -> pd.DataFrame:
+        files = glob.glob(f"data/{self.prefix_path}/trace/*.csv")
+
+        # The window is resolved against the day of the data, from the earliest startTime of all the files (as in TimeIndex)
+        bounds = self._bounds(None)
+        if self.plan['window'] is not None:
+            earliest = [chunk.startTime.min() for file in files
+                        for chunk in pd.read_csv(file, usecols=['startTime'], dtype={'startTime': np.uint64}, chunksize=1_000_000) if len(chunk)]
+            bounds = self._bounds(midnight_ms(int(min(earliest)))) if earliest else None
+
+        pushed = {column: list(values) for column, values in self.plan['equals'].items() if column in TRACE_PUSHDOWN_COLUMNS}
+        residual = self._with(window=None, between=None, roots=False, sample=None, agg=None, predicates=[],
+                              equals={column: values for column, values in self.plan['equals'].items() if column not in TRACE_PUSHDOWN_COLUMNS})
+
+        chunks = []
+        for chunk in iter_trace(self.prefix_path, start_time=bounds[0] if bounds else None, end_time=bounds[1] if bounds else None,
+                                roots_only=self.plan['roots'], test_data=self.test_data, **pushed):
+            # Residual column filters and the projection are applied per chunk, so only the matching rows and columns are kept
+            chunk = chunk.iloc[residual._candidates(chunk)]
+            if self.plan['columns'] is not None and not self.plan['predicates'] and self.plan['agg'] is None:
+                chunk = chunk[self.plan['columns']]
+            chunks.append(chunk)
+
+        df = _concat_frames(chunks)
+        return self._with(window=None, between=None, roots=False, equals={})._finish(df) if len(df.columns) else df
+
+    @profiled('reader')
+    def collect(self) -> pd.DataFrame:
+        '''
+        Run the query and return the matching rows (or the aggregation).
+        '''
+        if self.frame is not None:
+            return self._collect_frame(self.frame, self.time_index)
+
+        if self.source == 'trace':
+            return self._collect_trace_files()
+        if self.source == 'host':
+            return self._collect_frame(read_host(self.prefix_path, cache=self.cache))
+
+        return self._collect_frame(read_esb(f"data/{self.prefix_path}/esb.csv", cache=self.cache))
@@ -0,0 +1,265 @@
+import pandas as pd
+import numpy as np
+import json
+import time
+
+from typing import List, Union
+
+from .indexes import TimeIndex
+from .baseline import BaselineProfile
+from .profiling import profiled
+
+
+# Root Cause Ranking
+# Every host KPI series (cmdb_id, name), every trace node (cmdb_id) and every ESB service (serviceName) is scored against the same time of day of the train day,
+# using a robust deviation (median / MAD), so that thousands of KPIs are ranked in a few vectorized groupby passes
+MAD_TO_STD = 1.4826
+ESB_SCORED_COLUMNS = ['avg_time', 'succee_rate']
+
+
+def robust_baseline(df: pd.DataFrame, keys: List[str], value: str) -> pd.DataFrame:
+    '''
+    Return the baseline statistics (median, mad, mean, std, count) of value per keys, computed in vectorized groupby passes.
+    '''
+    grouped = df.groupby(keys, observed=True)[value]
+    baseline = grouped.agg(['median', 'mean', 'std', 'count'])
+
+    # MAD = median(|x - median(x)|), with the median of each group broadcast back to its rows
+    deviation = (df[value] - grouped.transform('median')).abs()
+    baseline['mad'] = deviation.groupby([df[key] for key in keys], observed=True).median()
+
+    return baseline
+
+
+def _robust_scale(baseline: pd.DataFrame) -> pd.Series:
+    '''
+    Scale used to normalise deviations: MAD (as a std estimate), falling back to the std for flat baselines,
+    and floored relative to the median so that constant KPIs do not divide by zero.
+    '''
+    scale = (MAD_TO_STD * baseline['mad']).where(baseline['mad'] > 0, baseline['std'])
+    floor = 1e-3 * baseline['median'].abs() + 1e-9
+
+    return scale.fillna(0).clip(lower=floor)
+
+
+def _score_rows(test: pd.DataFrame, baseline: pd.DataFrame, keys: List[str], value: str) -> pd.DataFrame:
+    '''
+    Score every test row against the baseline of its series (robust z), and aggregate the scores per series:
+    - score: mean |robust z| over the window (sustained shifts and repeated spikes)
+    - peak: max |robust z| over the window
+    Series without a baseline (not present on the train day) are skipped.
+    '''
+    baseline = baseline.assign(scale=_robust_scale(baseline))
+    matched = baseline.reindex(pd.MultiIndex.from_frame(test[keys].astype(str)) if len(keys) > 1 else test[keys[0]].astype(str))
+
+    z = ((test[value].to_numpy(dtype=np.float64) - matched['median'].to_numpy()) / matched['scale'].to_numpy())
+    scored = pd.DataFrame({key: test[key].astype(str).to_numpy() for key in keys})
+    scored['abs_z'] = np.abs(z)
+    scored['test_value'] = test[value].to_numpy(dtype=np.float64)
+    scored = scored[np.isfinite(scored['abs_z'])]
+
+    result = scored.groupby(keys).agg(score=('abs_z', 'mean'), peak=('abs_z', 'max'), test_median=('test_value', 'median'))
+
+    return result.join(baseline[['median', 'scale']].rename(columns={'median': 'baseline_median', 'scale': 'baseline_scale'}))
+
+
+def _with_str_index(baseline: pd.DataFrame) -> pd.DataFrame:
+    # Category keys are compared as strings, so that test and train categories do not need to match
+    if isinstance(baseline.index, pd.MultiIndex):
+        baseline.index = pd.MultiIndex.from_arrays([level.astype(str) for level in [baseline.index.get_level_values(i) for i in range(baseline.index.nlevels)]], names=baseline.index.names)
+    else:
+        baseline.index = baseline.index.astype(str)
+
+    return baseline
+
+
+@profiled('compare')
+def score_host(test_host: pd.DataFrame,
+               train_host: pd.DataFrame,
+               seconds_past: int,
+               window: int = 600,
+               baseline_window: int = 3600,
+               test_index: TimeIndex = None,
+               train_index: TimeIndex = None,
+               baseline: Union[pd.DataFrame, BaselineProfile] = None) -> pd.DataFrame:
+    '''
+    Score every (cmdb_id, name) host KPI within ±window/2 seconds of the failure time against the train day,
+    within ±baseline_window/2 seconds of the same time of day.
+
+    A precomputed baseline may be given instead of train_host: either a dataframe indexed by (cmdb_id, name) with median, std and mad columns,
+    or a BaselineProfile (see baseline.build_host_profile()), looked up at the bucket of the failure time.
+    '''
+    if test_index is None: test_index = TimeIndex(test_host, 'timestamp', ['cmdb_id', 'name'])
+    test = test_index.around(seconds_past, window)
+
+    if isinstance(baseline, BaselineProfile):
+        baseline = baseline.frame(seconds_past).dropna(subset=['median'])
+    elif baseline is None:
+        if train_index is None: train_index = TimeIndex(train_host, 'timestamp', ['cmdb_id', 'name'])
+        baseline = robust_baseline(train_index.around(seconds_past, baseline_window), ['cmdb_id', 'name'], 'value')
+    baseline = _with_str_index(baseline.copy())
+
+    scores = _score_rows(test, baseline, ['cmdb_id', 'name'], 'value').reset_index()
+    scores.insert(0, 'source', 'host')
+
+    return scores
+
+
+@profiled('compare')
+def score_trace(test_trace: pd.DataFrame,
+                train_trace: pd.DataFrame,
+                seconds_past: int,
+                window: int = 600,
+                baseline_window: int = 3600,
+                test_index: TimeIndex = None,
+                train_index: TimeIndex = None) -> pd.DataFrame:
+    '''
+    Score every trace node (cmdb_id) within ±window/2 seconds of the failure time against the train day:
+    - 'elapsedTime': robust z of the elapsedTime of its spans
+    - 'success': z of its error rate, against the binomial spread of the train error rate
+    '''
+    if test_index is None: test_index = TimeIndex(test_trace, 'startTime')
+    if train_index is None: train_index = TimeIndex(train_trace, 'startTime')
+    test = test_index.around(seconds_past, window)
+    train = train_index.around(seconds_past, baseline_window)
+
+    # Latency
+    latency = _score_rows(test, _with_str_index(robust_baseline(train, ['cmdb_id'], 'elapsedTime')), ['cmdb_id'], 'elapsedTime').reset_index()
+    latency['name'] = 'elapsedTime'
+
+    # Error rate
+    test_errors = (~test['success'].astype(bool)).groupby(test['cmdb_id'].astype(str)).agg(['mean', 'count'])
+    train_errors = (~train['success'].astype(bool)).groupby(train['cmdb_id'].astype(str)).agg(['mean', 'count'])
+    errors = test_errors.join(train_errors, lsuffix='_test', rsuffix='_train', how='inner')
+
+    # Binomial standard error of the test error rate, under the train error rate (+1 pseudo-count so that error-free baselines can still score)
+    train_rate = (errors['mean_train'] * errors['count_train'] + 1) / (errors['count_train'] + 2)
+    standard_error = np.sqrt(train_rate * (1 - train_rate) / errors['count_test'])
+    error_rate = pd.DataFrame({
+        'cmdb_id': errors.index,
+        'name': 'success',
+        'score': ((errors['mean_test'] - errors['mean_train']).clip(lower=0) / standard_error).to_numpy(),
+        'test_median': errors['mean_test'].to_numpy(),
+        'baseline_median': errors['mean_train'].to_numpy(),
+        'baseline_scale': standard_error.to_numpy(),
+    })
+    error_rate['peak'] = error_rate['score']
+
+    scores = pd.concat([latency, error_rate], ignore_index=True)
+    scores.insert(0, 'source', 'trace')
+
+    return scores
+
+
+@profiled('compare')
+def score_esb(test_esb: pd.DataFrame,
+              train_esb: pd.DataFrame,
+              seconds_past: int,
+              window: int = 600,
+              baseline_window: int = 3600,
+              test_index: TimeIndex = None,
+              train_index: TimeIndex = None) -> pd.DataFrame:
+    '''
+    Score the avg_time and succee_rate of every ESB service (serviceName) within ±window/2 seconds of the failure time against the train day,
+    with the same robust z as score_host(). The serviceName is reported in the cmdb_id column, and the ESB column in the name column.
+    '''
+    if test_index is None: test_index = TimeIndex(test_esb, 'startTime')
+    if train_index is None: train_index = TimeIndex(train_esb, 'startTime')
+    test = test_index.around(seconds_past, window)
+    train = train_index.around(seconds_past, baseline_window)
+
+    scores = []
+    for column in ESB_SCORED_COLUMNS:
+        column_scores = _score_rows(test, _with_str_index(robust_baseline(train, ['serviceName'], column)), ['serviceName'], column).reset_index()
+        column_scores.insert(1, 'name', column)
+        scores.append(column_scores.rename(columns={'serviceName': 'cmdb_id'}))
+
+    scores = pd.concat(scores, ignore_index=True)
+    scores.insert(0, 'source', 'esb')
+
+    return scores
+
+
+@profiled('compare')
+def rank_root_causes(seconds_past: int,
+                     test_host: pd.DataFrame,
+                     train_host: pd.DataFrame,
+                     test_trace: pd.DataFrame = None,
+                     train_trace: pd.DataFrame = None,
+                     test_esb: pd.DataFrame = None,
+                     train_esb: pd.DataFrame = None,
+                     window: int = 600,
+                     baseline_window: int = 3600,
+                     test_host_index: TimeIndex = None,
+                     train_host_index: TimeIndex = None,
+                     test_trace_index: TimeIndex = None,
+                     train_trace_index: TimeIndex = None,
+                     test_esb_index: TimeIndex = None,
+                     train_esb_index: TimeIndex = None,
+                     host_baseline: Union[pd.DataFrame, BaselineProfile] = None) -> pd.DataFrame:
+    '''
+    Rank every host KPI, trace node and ESB service (if the trace and ESB dataframes are given) as a root cause candidate
+    of the failure at seconds_past (seconds past 00:00, as in data/failures.json).
+
+    Return one row per candidate (source, cmdb_id, name), sorted by score (mean |robust z| over the window) with a 1-based rank.
+    Pass prebuilt TimeIndexes (or a precomputed host baseline, e.g. a BaselineProfile) to rank many failures without re-indexing the data.
+    '''
+    scores = [score_host(test_host, train_host, seconds_past, window, baseline_window, test_host_index, train_host_index, host_baseline)]
+
+    if test_trace is not None and train_trace is not None:
+        scores.append(score_trace(test_trace, train_trace, seconds_past, window, baseline_window, test_trace_index, train_trace_index))
+
+    if test_esb is not None and train_esb is not None:
+        scores.append(score_esb(test_esb, train_esb, seconds_past, window, baseline_window, test_esb_index, train_esb_index))
+
+    ranking = pd.concat(scores, ignore_index=True).sort_values(['score', 'peak'], ascending=False, ignore_index=True)
+    ranking.insert(0, 'rank', np.arange(1, len(ranking) + 1))
+
+    return ranking
+
+
+def benchmark_failures(test_host: pd.DataFrame,
+                       train_host: pd.DataFrame,
+                       test_trace: pd.DataFrame = None,
+                       train_trace: pd.DataFrame = None,
+                       test_esb: pd.DataFrame = None,
+                       train_esb: pd.DataFrame = None,
+                       failures_path: str = "data/failures.json",
+                       **kwargs) -> pd.DataFrame:
+    '''
+    Use the known failures of failures_path as an accuracy and latency benchmark of rank_root_causes().
+
+    Return one row per (failure, target) with the rank of the target (the best ranked candidate of that cmdb_id if the target KPI is null)
+    and the time taken to rank the failure. The indexes are built once and shared across failures.
+    '''
+    with open(failures_path) as f:
+        failures = json.load(f)
+
+    kwargs.setdefault('test_host_index', TimeIndex(test_host, 'timestamp', ['cmdb_id', 'name']))
+    if train_host is not None:
+        kwargs.setdefault('train_host_index', TimeIndex(train_host, 'timestamp', ['cmdb_id', 'name']))
+    if test_trace is not None and train_trace is not None:
+        kwargs.setdefault('test_trace_index', TimeIndex(test_trace, 'startTime'))
+        kwargs.setdefault('train_trace_index', TimeIndex(train_trace, 'startTime'))
+    if test_esb is not None and train_esb is not None:
+        kwargs.setdefault('test_esb_index', TimeIndex(test_esb, 'startTime'))
+        kwargs.setdefault('train_esb_index', TimeIndex(train_esb, 'startTime'))
+
+    results = []
+    for seconds_past, targets in failures:
+        start = time.perf_counter()
+        ranking = rank_root_causes(seconds_past, test_host, train_host, test_trace, train_trace, test_esb, train_esb, **kwargs)
+        seconds = time.perf_counter() - start
+
+        for cmdb_id, kpi in targets:
+            matches = ranking[(ranking.cmdb_id == cmdb_id) & ((ranking.name == kpi) if kpi is not None else True)]
+            results.append({
+                'seconds_past': seconds_past,
+                'cmdb_id': cmdb_id,
+                'kpi': kpi,
+                'rank': int(matches['rank'].min()) if len(matches) else None,
+                'candidates': len(ranking),
+                'seconds': seconds,
+            })
+
+    return pd.DataFrame(results).astype({'rank': 'Int64'})
@@ -0,0 +1,230 @@
+import multiprocessing
+import contextlib
+import argparse
+import json
+import os
+import re
+import time
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+from .utils import read_host, read_trace, read_esb
+from .indexes import TimeIndex, TraceIndex
+from .query import Query
+from .profiling import profile
+from .plots import compare_esb, compare_host, compare_trace_for_failure, host_time_index, default_trace_interval
+from .compute_actual_time import compare_trace_childrens_failure1
+
+
+# Batch Failure Report Runner
+# All the data is loaded (and indexed) once, then every failure of data/failures.json is processed against the shared state
+_STATE = {}
+
+
+def load_state(test_prefix: str = "test_data",
+               train_prefix: str = "train_data/2020_05_04",
+               cache: bool = False,
+               workers: int = 1,
+               verbose: bool = False) -> dict:
+    """
+    Load the host, trace and ESB data of both days once, and build the indexes shared by every failure.
+    """
+    state = {
+        'test_host': read_host(test_prefix, cache=cache, workers=workers),
+        'train_host': read_host(train_prefix, cache=cache, workers=workers),
+        'test_trace': read_trace(test_prefix, test_data=True, cache=cache, workers=workers),
+        'train_trace': read_trace(train_prefix, cache=cache, workers=workers),
+        'test_esb': read_esb(f"data/{test_prefix}/esb.csv", cache=cache),
+        'train_esb': read_esb(f"data/{train_prefix}/esb.csv", cache=cache),
+    }
+
+    state['test_host_index'] = host_time_index(state['test_host'])
+    state['train_host_index'] = host_time_index(state['train_host'])
+    state['test_trace_index'] = TraceIndex(state['test_trace'])
+    state['train_trace_index'] = TraceIndex(state['train_trace'])
+    state['test_trace_time_index'] = TimeIndex(state['test_trace'], 'startTime')
+    state['train_trace_time_index'] = TimeIndex(state['train_trace'], 'startTime')
+
+    if verbose:
+        for name, df in state.items():
+            if hasattr(df, 'shape'):
+                print("Loaded %s with %s rows and %s columns" % ((name,) + df.shape))
+
+    return state
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(name))
+
+
+def run_failure(seconds_past: int,
+                targets: List[Tuple[str, str]],
+                output_dir: str,
+                esb_interval: int = 60,
+                host_interval: int = 600,
+                trace_interval: int = -1,
+                figures: bool = True,
+                state: dict = None,
+                seed: int = 0,
+                self_time_sample: int = 100,
+                self_time_hosts: Tuple[str, ...] = ('os_021', 'os_022')) -> dict:
+    """
+    Run every comparison for a single failure and write the tables (CSV) and figures (PNG) to output_dir/<seconds_past>/.
+
+    Figures are rendered headless (Agg) straight to the files, or skipped entirely if figures is False.
+
+    The self time comparison (compare_trace_childrens_failure1(): slow test traces vs normal train traces, per parent host of self_time_hosts)
+    uses up to self_time_sample traces per side. All the random samples are drawn from seed, so reports are reproducible across runs and workers.
+
+    targets is the list of (cmdb_id, kpi) of the failure. A null kpi (e.g. docker_007) compares every host KPI of that cmdb_id.
+    Each step is run independently, so a failing step is recorded in the returned summary instead of aborting the failure.
+    """
+    state = state if state is not None else _STATE
+    failure_dir = os.path.join(output_dir, str(seconds_past))
+    os.makedirs(failure_dir, exist_ok=True)
+
+    summary = {'seconds_past': seconds_past, 'targets': targets, 'outputs': [], 'errors': []}
+    start = time.perf_counter()
+
+    def step(name: str, func) -> None:
+        try:
+            summary['outputs'].extend(func())
+        except Exception:
+            summary['errors'].append({'step': name, 'error': traceback.format_exc()})
+
+    # ESB
+    def esb_step() -> List[str]:
+        paths = [os.path.join(failure_dir, name) for name in ['esb_test.csv', 'esb_train.csv', 'esb.png']]
+        test_esb, train_esb = compare_esb(seconds_past, esb_interval, test_esb=state['test_esb'], train_esb=state['train_esb'],
+                                          output=paths[2], show=False, render=figures)
+
+        test_esb.to_csv(paths[0], index=False)
+        train_esb.to_csv(paths[1], index=False)
+
+        return paths if figures else paths[:2]
+
+    step('esb', esb_step)
+
+    # Host KPIs
+    for cmdb_id, kpi in targets:
+        if kpi is None:
+            kpis = state['test_host'].loc[state['test_host'].cmdb_id == cmdb_id, 'name'].unique().tolist()
+        else:
+            kpis = [kpi]
+
+        for name in kpis:
+            def host_step(cmdb_id=cmdb_id, name=name) -> List[str]:
+                prefix = os.path.join(failure_dir, f"host_{_safe_name(cmdb_id)}_{_safe_name(name)}")
+                paths = [prefix + '_test.csv', prefix + '_train.csv', prefix + '.png']
+                test_host, train_host = compare_host(state['test_host'], state['train_host'], seconds_past, cmdb_id, name, host_interval,
+                                                     test_index=state['test_host_index'], train_index=state['train_host_index'],
+                                                     output=paths[2], show=False, render=figures)
+
+                test_host.to_csv(paths[0], index=False)
+                train_host.to_csv(paths[1], index=False)
+
+                return paths if figures else paths[:2]
+
+            step(f'host:{cmdb_id}:{name}', host_step)
+
+    # Trace
+    def trace_step() -> List[str]:
+        paths = [os.path.join(failure_dir, name) for name in ['trace_lengths.json', 'trace.png']]
+        results = compare_trace_for_failure(state['test_trace'], state['train_trace'], seconds_past, trace_interval,
+                                            test_index=state['test_trace_index'], train_index=state['train_trace_index'],
+                                            test_time_index=state['test_trace_time_index'], train_time_index=state['train_trace_time_index'],
+                                            output=paths[1], show=False, render=figures, seed=seed)
+        test_lengths, train_lengths = results[2], results[3]
+
+        with open(paths[0], 'w') as f:
+            json.dump({'test': test_lengths, 'train': train_lengths}, f)
+
+        return paths if figures else paths[:1]
+
+    step('trace', trace_step)
+
+    # Self time of every cmdb_id:serviceName:dsName in slow vs normal traces, per parent host
+    for host in self_time_hosts:
+        def self_time_step(host=host) -> List[str]:
+            path = os.path.join(failure_dir, f"self_time_{_safe_name(host)}.csv")
+            interval = trace_interval if trace_interval != -1 else default_trace_interval(state['test_trace'])
+            test_trace_filtered = state['test_trace_time_index'].around(seconds_past, interval)
+            train_trace_filtered = state['train_trace_time_index'].around(seconds_past, interval)
+            parent_host = [Query('trace', state[f'{day}_trace'], time_index=state[f'{day}_trace_time_index']).window(seconds_past, interval).roots()
+                           .where(cmdb_id=host).collect() for day in ('test', 'train')]
+
+            table = compare_trace_childrens_failure1(test_trace_filtered, train_trace_filtered, *parent_host,
+                                                     test_index=state['test_trace_index'], train_index=state['train_trace_index'],
+                                                     sample=self_time_sample, seed=seed)
+            table.to_csv(path, index=False)
+
+            return [path]
+
+        step(f'self_time:{host}', self_time_step)
+
+    summary['seconds'] = time.perf_counter() - start
+
+    return summary
+
+
+def _run_failure_task(task: Tuple[tuple, dict]) -> dict:
+    args, kwargs = task
+    return run_failure(*args, **kwargs)
+
+
+def run_failures(failures_path: str = "data/failures.json",
+                 output_dir: str = "output",
+                 workers: int = 1,
+                 state: dict = None,
+                 **kwargs) -> List[dict]:
+    """
+    Process every (time, [(cmdb_id, kpi)]) entry of failures_path against data loaded once, and write a summary.json to output_dir.
+
+    If workers > 1, failures are processed in parallel by forked processes that share the loaded data (copy-on-write).
+    The data is loaded with load_state() unless a state is given.
+    """
+    global _STATE
+    _STATE = state if state is not None else load_state()
+
+    with open(failures_path) as f:
+        failures = json.load(f)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(seconds_past, [tuple(target) for target in targets], output_dir) for seconds_past, targets in failures]
+
+    # Forked workers inherit _STATE without pickling it, so parallelism is only used where fork is available
+    if workers > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            summaries = list(executor.map(_run_failure_task, [(task, kwargs) for task in tasks]))
+    else:
+        summaries = [run_failure(*task, **kwargs) for task in tasks]
+
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+        json.dump(summaries, f, indent=2)
+
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run every comparison for each failure in a failures.json file, loading the data only once.")
+    parser.add_argument('--failures', default="data/failures.json", help="path to the failures file")
+    parser.add_argument('--output', default="output", help="directory to write the tables and figures to")
+    parser.add_argument('--test-prefix', default="test_data")
+    parser.add_argument('--train-prefix', default="train_data/2020_05_04")
+    parser.add_argument('--workers', type=int, default=1, help="number of failures processed in parallel")
+    parser.add_argument('--read-workers', type=int, default=1, help="number of processes used to parse the CSV files")
+    parser.add_argument('--cache', action='store_true', help="use the columnar on-disk cache (requires pyarrow)")
+    parser.add_argument('--no-figures', action='store_true', help="only write the tables, skipping figure rendering")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the trace samples, for reproducible reports")
+    parser.add_argument('--profile', default=None, help="write a JSON report of the time, rows and memory of every stage to this path")
+    args = parser.parse_args()
+
+    # Stages run in forked workers are not recorded, so profiling runs the failures in this process
+    with profile(args.profile) if args.profile else contextlib.nullcontext():
+        state = load_state(args.test_prefix, args.train_prefix, cache=args.cache, workers=args.read_workers, verbose=True)
+        summaries = run_failures(args.failures, args.output, workers=1 if args.profile else args.workers, state=state, figures=not args.no_figures, seed=args.seed)
+
+    for summary in summaries:
+        print("Failure at %ss: %s outputs, %s errors in %.2f seconds" % (summary['seconds_past'], len(summary['outputs']), len(summary['errors']), summary['seconds']))
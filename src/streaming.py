@@ -0,0 +1,314 @@
+import pandas as pd
+import numpy as np
+import argparse
+import heapq
+import socket
+import glob
+import time
+import os
+
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from .baseline import BaselineProfile
+
+
+# Streaming Anomaly Detection
+# Host KPI rows (read_host() schema) and ESB rows (read_esb() schema) are consumed one at a time, from tailed CSV files,
+# a local socket or a replay of finished CSV files, and every row is scored as soon as it arrives
+HOST_COLUMNS = ['itemid', 'name', 'bomc_id', 'timestamp', 'value', 'cmdb_id']
+ESB_COLUMNS = ['serviceName', 'startTime', 'avg_time', 'num', 'succee_num', 'succee_rate']
+ESB_MONITORED_COLUMNS = ['avg_time', 'succee_rate']
+
+
+class Alert(NamedTuple):
+    timestamp: int                # epoch ms of the anomalous sample
+    source: str                   # 'host' or 'esb'
+    key: Tuple[str, str]          # (cmdb_id, name) or (serviceName, column)
+    value: float
+    expected: float               # EWMA mean before the sample
+    score: float                  # |value - expected| / EWMA std
+
+
+def schema(columns: List[str]) -> str:
+    '''
+    Return 'host' or 'esb' from the header of a CSV file.
+    '''
+    if set(HOST_COLUMNS) <= set(columns):
+        return 'host'
+    if set(ESB_COLUMNS) <= set(columns):
+        return 'esb'
+
+    raise ValueError(f"Columns {columns} match neither the host nor the ESB schema")
+
+
+def _number(value) -> float:
+    '''
+    Parse a CSV field (a string or a number) as a float, NaN for empty or missing fields.
+    '''
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return np.nan
+
+    return float(value)
+
+
+def samples(source: str, row: dict) -> Iterator[Tuple[Tuple[str, str], int, float]]:
+    '''
+    Return the (series key, epoch ms, value) samples of a host or ESB row (with values as strings or numbers).
+
+    Empty fields are missing values: a row without a timestamp has no samples, and empty values are skipped.
+    '''
+    timestamp = _number(row['timestamp' if source == 'host' else 'startTime'])
+    if np.isnan(timestamp):
+        return
+
+    if source == 'host':
+        keyed_values = [((str(row['cmdb_id']), str(row['name'])), row['value'])]
+    else:
+        keyed_values = [((str(row['serviceName']), column), row[column]) for column in ESB_MONITORED_COLUMNS]
+
+    for key, value in keyed_values:
+        value = _number(value)
+        if not np.isnan(value):
+            yield key, int(timestamp), value
+
+
+class StreamDetector:
+    '''
+    Constant-memory detector over many series: each series only keeps [count, EWMA mean, EWMA variance, last alert time].
+
+    A sample is anomalous when it is more than threshold EWMA standard deviations away from the EWMA mean (after warmup samples).
+    The update of the statistics is clipped at threshold standard deviations, so that a failure does not immediately become the new normal.
+
+    If a BaselineProfile of the train day is given (keyed like the samples, see baseline.build_host_profile() / build_esb_profile()),
+    an alert also requires the sample to be more than threshold robust deviations (MAD) away from the train median of its time-of-day bucket.
+    Alerts of the same series are raised at most once every cooldown seconds.
+    '''
+
+    def __init__(self, alpha: float = 0.05, threshold: float = 4.0, warmup: int = 30, cooldown: float = 300,
+                 profile: BaselineProfile = None, on_alert: Callable[[Alert], None] = None):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.cooldown_ms = cooldown * 1000
+        self.profile = profile
+        self.on_alert = on_alert
+        self.state: Dict[Tuple[str, str], List[float]] = {}
+
+    def __len__(self) -> int:
+        return len(self.state)
+
+    def _profile_score(self, key: Tuple[str, str], timestamp: int, value: float) -> float:
+        if self.profile is None:
+            return np.inf
+        if key not in self.profile:
+            return 0.0
+
+        seconds_past = (pd.Timestamp(timestamp, unit='ms', tz='Asia/Singapore') - pd.Timestamp(timestamp, unit='ms', tz='Asia/Singapore').normalize()).total_seconds()
+        stats = self.profile.lookup(key, seconds_past)
+        if np.isnan(stats['median']):
+            return 0.0
+
+        scale = 1.4826 * stats['mad'] if stats['mad'] > 0 else stats['std']
+        scale = max(np.nan_to_num(scale), 1e-3 * abs(stats['median']) + 1e-9)
+        return abs(value - stats['median']) / scale
+
+    def update(self, key: Tuple[str, str], timestamp: int, value: float, source: str = 'host') -> Alert:
+        '''
+        Score one sample and update its series. Return the Alert raised (also passed to on_alert), or None.
+        '''
+        if np.isnan(value):
+            return None
+
+        state = self.state.get(key)
+        if state is None:
+            self.state[key] = [1, value, 0.0, -np.inf]
+            return None
+
+        count, mean, variance, last_alert = state
+        std = np.sqrt(variance) + 1e-9 * (abs(mean) + 1)
+        score = abs(value - mean) / std
+
+        alert = None
+        if count >= self.warmup and score > self.threshold and timestamp - last_alert >= self.cooldown_ms \
+                and self._profile_score(key, timestamp, value) > self.threshold:
+            alert = Alert(timestamp, source, key, value, mean, float(score))
+            state[3] = timestamp
+            if self.on_alert is not None: self.on_alert(alert)
+
+        # Clipped EWMA update (the variance only starts from the spread seen so far)
+        residual = float(np.clip(value - mean, -self.threshold * std, self.threshold * std)) if count >= self.warmup else value - mean
+        state[0] = count + 1
+        state[1] = mean + self.alpha * residual
+        state[2] = (1 - self.alpha) * (variance + self.alpha * residual ** 2)
+
+        return alert
+
+    def process(self, source: str, row: dict) -> List[Alert]:
+        '''
+        Score every sample of a host or ESB row.
+        '''
+        alerts = [self.update(key, timestamp, value, source) for key, timestamp, value in samples(source, row)]
+        return [alert for alert in alerts if alert is not None]
+
+    def run(self, rows: Iterable[Tuple[str, dict]]) -> List[Alert]:
+        '''
+        Consume (source, row) pairs (from tail_csv(), listen() or replay()) and return every alert raised.
+        '''
+        alerts = []
+        for source, row in rows:
+            alerts.extend(self.process(source, row))
+
+        return alerts
+
+
+# Sources
+def tail_csv(paths: List[str], poll_interval: float = 1.0, from_start: bool = False, stop: Callable[[], bool] = None) -> Iterator[Tuple[str, dict]]:
+    '''
+    Follow CSV files (like tail -f) and yield a (source, row) pair for every complete line appended to them.
+
+    Lines already in the files are skipped unless from_start is True. Partial lines (still being written) are kept until completed.
+    The files are polled every poll_interval seconds, until stop() returns True.
+    '''
+    files = []
+    for path in paths:
+        f = open(path, 'r')
+        header = f.readline().strip().split(',')
+        if not from_start: f.seek(0, os.SEEK_END)
+        files.append([f, header, schema(header), ''])
+
+    try:
+        while stop is None or not stop():
+            read = False
+            for entry in files:
+                f, header, source, partial = entry
+                for line in iter(f.readline, ''):
+                    if not line.endswith('\n'):
+                        partial += line
+                        break
+                    line, partial = partial + line, ''
+                    read = True
+                    yield source, dict(zip(header, line.rstrip('\r\n').split(',')))
+                entry[3] = partial
+
+            if not read: time.sleep(poll_interval)
+    finally:
+        for entry in files:
+            entry[0].close()
+
+
+def listen(port: int, host: str = '127.0.0.1') -> Iterator[Tuple[str, dict]]:
+    '''
+    Accept connections on a local TCP socket, one at a time, and yield a (source, row) pair for every CSV line received.
+    Each connection starts with the CSV header line of its schema (host or ESB), followed by the rows.
+    '''
+    with socket.create_server((host, port)) as server:
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('r') as stream:
+                header = stream.readline().strip().split(',')
+                source = schema(header)
+                for line in stream:
+                    yield source, dict(zip(header, line.rstrip('\r\n').split(',')))
+
+
+def _records(df: pd.DataFrame, time_column: str, source: str) -> Iterator[Tuple[int, str, dict]]:
+    columns = df.columns.tolist()
+    for record in df.itertuples(index=False, name=None):
+        row = dict(zip(columns, record))
+        yield int(_number(row[time_column])), source, row
+
+
+def _file_records(path: str, chunksize: int) -> Iterator[Tuple[int, str, dict]]:
+    '''
+    Yield the (epoch ms, source, row) records of a host or ESB CSV file in timestamp order, reading chunksize rows at a time.
+
+    A first pass over the time column only checks whether the file is already in timestamp order: if so, it is streamed chunk by chunk,
+    otherwise it has to be loaded whole and sorted. Rows without a timestamp are skipped.
+    '''
+    source = schema(pd.read_csv(path, nrows=0).columns.tolist())
+    time_column = 'timestamp' if source == 'host' else 'startTime'
+
+    in_order, last = True, -np.inf
+    for chunk in pd.read_csv(path, usecols=[time_column], chunksize=chunksize):
+        timestamps = chunk[time_column].to_numpy(dtype=np.float64)
+        timestamps = timestamps[~np.isnan(timestamps)]
+        if len(timestamps):
+            in_order &= bool(timestamps[0] >= last) and not np.any(timestamps[1:] < timestamps[:-1])
+            last = timestamps[-1]
+
+    if in_order:
+        chunks = pd.read_csv(path, dtype=str, chunksize=chunksize)
+    else:
+        df = pd.read_csv(path, dtype=str)
+        chunks = [df.iloc[np.argsort(df[time_column].astype(np.float64).to_numpy(), kind='stable')]]
+
+    for chunk in chunks:
+        yield from _records(chunk[chunk[time_column].notna()], time_column, source)
+
+
+def replay(prefix_path: str = "test_data", speed: float = None, chunksize: int = 100_000) -> Iterator[Tuple[str, dict]]:
+    '''
+    Replay the host and ESB CSV files of a day in timestamp order, as a stream of (source, row) pairs.
+
+    With a speed (e.g. 600 for 10 minutes of data per second), rows are yielded at that multiple of their real pace;
+    otherwise they are yielded as fast as they are consumed.
+
+    Files are read chunksize rows at a time, so memory is bounded by one chunk per file (for files in timestamp order, see _file_records()).
+    '''
+    streams = [_file_records(path, chunksize) for path in glob.glob(f"data/{prefix_path}/host/*.csv") + glob.glob(f"data/{prefix_path}/esb.csv")]
+
+    start_wall, first_timestamp = time.perf_counter(), None
+    for timestamp, source, row in heapq.merge(*streams, key=lambda item: item[0]):
+        if speed is not None:
+            if first_timestamp is None: first_timestamp = timestamp
+            delay = start_wall + (timestamp - first_timestamp) / 1000 / speed - time.perf_counter()
+            if delay > 0: time.sleep(delay)
+
+        yield source, row
+
+
+def merge_profiles(profiles: List[BaselineProfile]) -> BaselineProfile:
+    '''
+    Merge baseline profiles of different series (e.g. the host and ESB profiles of a train day) into one.
+
+    Raise ValueError if the profiles do not share their statistics and time-of-day buckets, as their values could not be looked up alike.
+    '''
+    first = profiles[0]
+    for profile in profiles[1:]:
+        if profile.bucket_seconds != first.bucket_seconds or profile.n_buckets != first.n_buckets:
+            raise ValueError(f"Cannot merge profiles with buckets of {profile.bucket_seconds} s x {profile.n_buckets} "
+                             f"and {first.bucket_seconds} s x {first.n_buckets}")
+        if profile.stats != first.stats:
+            raise ValueError(f"Cannot merge profiles with statistics {profile.stats} and {first.stats}")
+
+    return BaselineProfile([key for profile in profiles for key in profile.keys], first.key_names, first.stats,
+                           np.concatenate([profile.values for profile in profiles]), first.bucket_seconds)
+
+
+def _print_alert(alert: Alert) -> None:
+    when = pd.Timestamp(alert.timestamp, unit='ms', tz='Asia/Singapore').strftime('%H:%M:%S')
+    print("%s %s %s: %.4g (expected %.4g, score %.1f)" % (when, alert.source, '/'.join(alert.key), alert.value, alert.expected, alert.score), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Detect anomalies in host KPI and ESB rows as they arrive.")
+    parser.add_argument('mode', choices=['replay', 'tail', 'listen'])
+    parser.add_argument('paths', nargs='*', help="CSV files to follow (tail mode)")
+    parser.add_argument('--prefix', default="test_data", help="day to replay (replay mode)")
+    parser.add_argument('--speed', type=float, default=None, help="replay speed-up factor (default: as fast as possible)")
+    parser.add_argument('--port', type=int, default=9999, help="local port to listen on (listen mode)")
+    parser.add_argument('--profile', nargs='*', default=[], help="baseline profiles (.npz) of the train day, see src.baseline")
+    parser.add_argument('--threshold', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    args = parser.parse_args()
+
+    profile = merge_profiles([BaselineProfile.load(path) for path in args.profile]) if args.profile else None
+
+    if args.mode == 'replay':
+        rows = replay(args.prefix, args.speed)
+    elif args.mode == 'tail':
+        rows = tail_csv(args.paths)
+    else:
+        rows = listen(args.port)
+
+    StreamDetector(args.alpha, args.threshold, profile=profile, on_alert=_print_alert).run(rows)
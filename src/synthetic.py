@@ -0,0 +1,249 @@
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+
+from typing import List, Tuple
+
+
+# Synthetic Dataset Generator
+# Host, trace and ESB CSVs with the exact schemas of read_host(), read_trace() and read_esb(), at a configurable scale,
+# with injected failures in the format of data/failures.json, so that the readers and analyses can be benchmarked offline
+HOST_KPIS = {
+    'os_linux': ([f'os_{i:03d}' for i in range(1, 23)], ['CPU_util_pct', 'Memory_used_pct', 'Sent_queue', 'Recv_total', 'Send_total']),
+    'db_oracle_11g': ([f'db_{i:03d}' for i in range(1, 14)], ['On_Off_State', 'tnsping_result_time', 'Proc_User_Used_Pct', 'Sess_Connect']),
+    'dcos_docker': ([f'docker_{i:03d}' for i in range(1, 9)], ['container_cpu_used', 'container_mem_used', 'container_thread_used']),
+    'mw_redis': ([f'redis_{i:03d}' for i in range(1, 13)], ['used_memory', 'connected_clients']),
+}
+HOST_COLUMNS = ['itemid', 'name', 'bomc_id', 'timestamp', 'value', 'cmdb_id']
+TRACE_COLUMNS = ['callType', 'startTime', 'elapsedTime', 'success', 'traceId', 'id', 'pid', 'cmdb_id', 'serviceName', 'dsName']
+ESB_COLUMNS = ['serviceName', 'startTime', 'avg_time', 'num', 'succee_num', 'succee_rate']
+TRACE_FILES = {'OSB': 'trace_osb', 'CSF': 'trace_csf', 'RemoteProcess': 'trace_remote_process', 'LOCAL': 'trace_local', 'JDBC': 'trace_jdbc'}
+
+# Failures are injected for this long after the failure time, and multiply the latency of the spans of the failed node by this factor
+FAILURE_DURATION = 300
+FAILURE_LATENCY_FACTOR = 5.0
+FAILURE_ERROR_RATE = 0.3
+
+
+def _day_start_ms(day: str) -> int:
+    return pd.Timestamp(day, tz='Asia/Singapore').value // 10**6
+
+
+def _failed(cmdb_id: np.ndarray, timestamp: np.ndarray, day_start: int, failures: list) -> np.ndarray:
+    '''
+    Return the mask of the samples (cmdb_id, epoch ms) falling in an injected failure of their cmdb_id.
+    '''
+    mask = np.zeros(len(timestamp), dtype=bool)
+    for seconds_past, targets in failures:
+        start = day_start + seconds_past * 1000
+        in_window = (timestamp >= start) & (timestamp < start + FAILURE_DURATION * 1000)
+        mask |= in_window & np.isin(cmdb_id, [target[0] for target in targets])
+
+    return mask
+
+
+def generate_host(day: str, interval: int = 60, failures: list = (), rng: np.random.Generator = None) -> dict:
+    '''
+    Return the host KPI dataframe of every file of HOST_KPIS, one sample per KPI every interval seconds,
+    as a daily cycle plus noise, with a shift of 10 standard deviations during the injected failures.
+    '''
+    if rng is None: rng = np.random.default_rng()
+    day_start = _day_start_ms(day)
+    timestamps = day_start + np.arange(0, 86400, interval, dtype=np.int64) * 1000
+    cycle = np.sin(2 * np.pi * np.arange(len(timestamps)) / len(timestamps))
+
+    frames = {}
+    for filename, (cmdb_ids, kpis) in HOST_KPIS.items():
+        series = [(cmdb_id, kpi) for cmdb_id in cmdb_ids for kpi in kpis]
+        n = len(timestamps)
+
+        # The level and noise of every KPI are the same on every day (only the samples differ), so that the days are comparable
+        kpi_rng = np.random.default_rng(len(frames))
+        level = kpi_rng.uniform(10, 100, len(series))
+        noise = level * kpi_rng.uniform(0.01, 0.05, len(series))
+        values = level[:, None] * (1 + 0.1 * cycle[None, :]) + noise[:, None] * rng.standard_normal((len(series), n))
+
+        df = pd.DataFrame({
+            'itemid': np.repeat(np.arange(len(series), dtype=np.uint64) + 1000 * len(frames), n),
+            'name': np.repeat([kpi for _, kpi in series], n),
+            'bomc_id': np.repeat([f'ZJ-{i:03d}' for i in range(len(series))], n),
+            'timestamp': np.tile(timestamps, len(series)),
+            'value': values.ravel(),
+            'cmdb_id': np.repeat([cmdb_id for cmdb_id, _ in series], n),
+        })
+
+        # Injected failures shift the target KPI (or every KPI of the cmdb_id for a null KPI)
+        for seconds_past, targets in failures:
+            start = day_start + seconds_past * 1000
+            in_window = (df['timestamp'] >= start) & (df['timestamp'] < start + FAILURE_DURATION * 1000)
+            for cmdb_id, kpi in targets:
+                mask = in_window & (df['cmdb_id'] == cmdb_id) & ((df['name'] == kpi) if kpi is not None else True)
+                df.loc[mask, 'value'] += 10 * np.repeat(noise, n)[mask.to_numpy()]
+
+        frames[filename] = df
+
+    return frames
+
+
+def generate_trace(day: str, n_traces: int = 10000, failures: list = (), rng: np.random.Generator = None, test_data: bool = True) -> pd.DataFrame:
+    '''
+    Return a trace dataframe of n_traces traces spread over the day, built level by level with numpy:
+    OSB root (os_021 / os_022) -> 1-3 CSF calls -> one RemoteProcess on a docker each -> 0-4 LOCAL / JDBC calls.
+
+    Children run one after the other, so every elapsedTime is the sum of its children plus its own time.
+    During an injected failure, the spans on the failed cmdb_id (or calling the failed database) are slower and fail more often.
+    '''
+    if rng is None: rng = np.random.default_rng()
+    day_start = _day_start_ms(day)
+    failures = list(failures)
+
+    # Structure: number of children per span, and the parent position of every child within the previous level
+    root_start = np.sort(day_start + rng.integers(0, 86400 * 1000, n_traces))
+    n_csf = rng.integers(1, 4, n_traces)
+    csf_parent = np.repeat(np.arange(n_traces), n_csf)
+    remote_parent = np.arange(len(csf_parent))
+    n_leaf = rng.integers(0, 5, len(remote_parent))
+    leaf_parent = np.repeat(remote_parent, n_leaf)
+
+    # Nodes
+    root_cmdb = rng.choice(['os_021', 'os_022'], n_traces)
+    csf_service = rng.choice([f'csf_{i:03d}' for i in range(1, 6)], len(csf_parent))
+    remote_cmdb = rng.choice([f'docker_{i:03d}' for i in range(1, 9)], len(remote_parent))
+    leaf_jdbc = rng.random(len(leaf_parent)) < 0.5
+    leaf_ds = np.where(leaf_jdbc, rng.choice([f'db_{i:03d}' for i in range(1, 14)], len(leaf_parent)),
+                       rng.choice([f'local_method_{i:03d}' for i in range(1, 20)], len(leaf_parent)))
+
+    # Own (self) times, slowed down by the failures of the node (approximated at the start of the trace)
+    def own_time(n: int, median: float, cmdb_id: np.ndarray, start: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        elapsed = rng.lognormal(np.log(median), 0.5, n)
+        failed = _failed(cmdb_id, start, day_start, failures)
+        elapsed[failed] *= FAILURE_LATENCY_FACTOR
+        success = ~(rng.random(n) < np.where(failed, FAILURE_ERROR_RATE, 0.001))
+        return elapsed.astype(np.int64) + 1, success
+
+    leaf_own, leaf_success = own_time(len(leaf_parent), 20, np.where(leaf_jdbc, leaf_ds, remote_cmdb[leaf_parent]), root_start[csf_parent[leaf_parent]])
+    remote_own, remote_success = own_time(len(remote_parent), 50, remote_cmdb, root_start[csf_parent])
+    csf_own, csf_success = own_time(len(csf_parent), 10, root_cmdb[csf_parent], root_start[csf_parent])
+    root_own, root_success = own_time(n_traces, 30, root_cmdb, root_start)
+
+    # Elapsed times, bottom up (failures propagate to the ancestors)
+    leaf_elapsed = leaf_own
+    remote_elapsed = remote_own + np.bincount(leaf_parent, weights=leaf_elapsed, minlength=len(remote_parent)).astype(np.int64)
+    csf_elapsed = csf_own + remote_elapsed
+    root_elapsed = root_own + np.bincount(csf_parent, weights=csf_elapsed, minlength=n_traces).astype(np.int64)
+    remote_success &= np.bincount(leaf_parent, weights=~leaf_success, minlength=len(remote_parent)) == 0
+    csf_success &= remote_success
+    root_success &= np.bincount(csf_parent, weights=~csf_success, minlength=n_traces) == 0
+
+    # Start times, top down: siblings run one after the other, after a short delay within their parent
+    def sequential_start(parent: np.ndarray, parent_start: np.ndarray, elapsed: np.ndarray) -> np.ndarray:
+        finished_before = np.cumsum(elapsed) - elapsed
+        first = np.searchsorted(parent, parent, side='left')
+        return parent_start[parent] + 1 + finished_before - finished_before[first]
+
+    csf_start = sequential_start(csf_parent, root_start, csf_elapsed)
+    remote_start = csf_start + 1
+    leaf_start = sequential_start(leaf_parent, remote_start, leaf_elapsed)
+
+    # Identifiers
+    trace_ids = pd.Series(np.arange(n_traces)).map(f"{day.replace('-', '')}{{:08x}}".format).to_numpy()
+    offsets = np.cumsum([0, n_traces, len(csf_parent), len(remote_parent)])
+    span_ids = pd.Series(np.arange(offsets[-1] + len(leaf_parent))).map('{:012x}'.format).to_numpy()
+    root_ids, csf_ids, remote_ids, leaf_ids = np.split(span_ids, offsets[1:])
+    root_trace = np.arange(n_traces)
+
+    levels = [
+        ('OSB', root_start, root_elapsed, root_success, root_trace, root_ids, np.full(n_traces, 'None'), root_cmdb, np.full(n_traces, 'osb_001'), ''),
+        ('CSF', csf_start, csf_elapsed, csf_success, csf_parent, csf_ids, root_ids[csf_parent], root_cmdb[csf_parent], csf_service, ''),
+        ('RemoteProcess', remote_start, remote_elapsed, remote_success, csf_parent, remote_ids, csf_ids, remote_cmdb, csf_service, ''),
+        (np.where(leaf_jdbc, 'JDBC', 'LOCAL'), leaf_start, leaf_elapsed, leaf_success, csf_parent[leaf_parent], leaf_ids, remote_ids[leaf_parent],
+         remote_cmdb[leaf_parent], csf_service[leaf_parent], leaf_ds),
+    ]
+
+    trace_df = pd.concat([pd.DataFrame(dict(zip(TRACE_COLUMNS, [call_type, start, elapsed, success, trace_ids[trace], ids, pid, cmdb_id, service, ds_name])))
+                          for call_type, start, elapsed, success, trace, ids, pid, cmdb_id, service, ds_name in levels], ignore_index=True)
+
+    # The test day also records when the span message was received
+    if test_data: trace_df['msgTime'] = trace_df['startTime'] + rng.integers(0, 50, len(trace_df))
+
+    return trace_df
+
+
+def generate_esb(trace_df: pd.DataFrame, day: str) -> pd.DataFrame:
+    '''
+    Return the per-minute ESB statistics of the OSB root spans of trace_df (avg_time in seconds, as in the real esb.csv).
+    '''
+    roots = trace_df[trace_df['callType'] == 'OSB']
+    minute = (roots['startTime'] - _day_start_ms(day)) // 60000
+
+    grouped = roots.groupby(minute)
+    esb_df = pd.DataFrame({'num': grouped.size(), 'succee_num': grouped['success'].sum(), 'avg_time': grouped['elapsedTime'].mean() / 1000})
+    esb_df = esb_df.reindex(np.arange(1440), fill_value=0)
+
+    esb_df['serviceName'] = 'osb_001'
+    esb_df['startTime'] = _day_start_ms(day) + esb_df.index.to_numpy() * 60000
+    esb_df['succee_rate'] = np.where(esb_df['num'] > 0, esb_df['succee_num'] / esb_df['num'].clip(lower=1), 1.0)
+
+    return esb_df[ESB_COLUMNS]
+
+
+def generate_day(prefix_path: str,
+                 day: str,
+                 n_traces: int = 10000,
+                 host_interval: int = 60,
+                 failures: list = (),
+                 test_data: bool = True,
+                 seed: int = None,
+                 data_dir: str = "data") -> None:
+    '''
+    Write the host/<file>.csv, trace/<file>.csv and esb.csv files of one day to data_dir/prefix_path, readable with
+    read_host(prefix_path), read_trace(prefix_path, test_data=test_data) and read_esb(f"data/{prefix_path}/esb.csv").
+    '''
+    rng = np.random.default_rng(seed)
+    directory = os.path.join(data_dir, prefix_path)
+    os.makedirs(os.path.join(directory, 'host'), exist_ok=True)
+    os.makedirs(os.path.join(directory, 'trace'), exist_ok=True)
+
+    for filename, host_df in generate_host(day, host_interval, failures, rng).items():
+        host_df.to_csv(os.path.join(directory, 'host', f'{filename}.csv'), index=False)
+
+    trace_df = generate_trace(day, n_traces, failures, rng, test_data)
+    # Spans are written per callType, in time order (the files are not ordered by trace)
+    for call_type, filename in TRACE_FILES.items():
+        trace_df[trace_df['callType'] == call_type].sort_values('startTime').to_csv(os.path.join(directory, 'trace', f'{filename}.csv'), index=False)
+
+    generate_esb(trace_df, day).to_csv(os.path.join(directory, 'esb.csv'), index=False)
+
+
+def generate_dataset(prefix_path: str = "synthetic",
+                     n_traces: int = 10000,
+                     host_interval: int = 60,
+                     failures: List[list] = None,
+                     seed: int = 0,
+                     data_dir: str = "data") -> None:
+    '''
+    Write a synthetic copy of the dataset layout under data_dir/prefix_path: a normal train day (train_data/2020_05_04),
+    a test day (test_data) with the injected failures, and their failures.json (data/failures.json by default).
+    '''
+    if failures is None:
+        with open(os.path.join(data_dir, 'failures.json')) as f:
+            failures = json.load(f)
+
+    generate_day(f"{prefix_path}/train_data/2020_05_04", '2020-05-04', n_traces, host_interval, [], False, seed, data_dir)
+    generate_day(f"{prefix_path}/test_data", '2020-05-30', n_traces, host_interval, failures, True, seed + 1, data_dir)
+
+    with open(os.path.join(data_dir, prefix_path, 'failures.json'), 'w') as f:
+        json.dump(failures, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic train and test day with the schemas of the readers.")
+    parser.add_argument('--prefix', default="synthetic", help="written to data/<prefix>/{train_data/2020_05_04,test_data}")
+    parser.add_argument('--traces', type=int, default=10000, help="number of traces per day")
+    parser.add_argument('--host-interval', type=int, default=60, help="seconds between host KPI samples")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_dataset(args.prefix, args.traces, args.host_interval, seed=args.seed)
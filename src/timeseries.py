@@ -0,0 +1,99 @@
+import pandas as pd
+import numpy as np
+
+from typing import Callable, List, Union
+from .profiling import profiled
+
+
+# Time-of-day Helpers
+# Train and test data are recorded on different days, so they are compared on their time of day, placed on a fixed reference date
+# (1900-01-01, the date datetime.strptime() used to give for '%H:%M:%S' strings)
+REFERENCE_DATE = pd.Timestamp('1900-01-01')
+
+
+def time_of_day(timestamps: pd.Series) -> pd.Series:
+    '''
+    Return the time of day of each timestamp as a naive datetime64 on REFERENCE_DATE, keeping sub-second precision.
+
+    The offset from midnight is derived directly from the datetime64 values (in the local Asia/Singapore time of the readers),
+    instead of formatting every timestamp to a string and parsing it back with strptime.
+    Raw epoch milliseconds (e.g. compact_trace() columns) are converted to Asia/Singapore time first.
+    '''
+    if not isinstance(timestamps, pd.Series):
+        timestamps = pd.Series(timestamps)
+
+    if pd.api.types.is_integer_dtype(timestamps.dtype):
+        timestamps = pd.to_datetime(timestamps, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = timestamps.dt.tz_localize(None)
+
+    return REFERENCE_DATE + (timestamps - timestamps.dt.normalize())
+
+
+def seconds_to_time_of_day(seconds_past: float) -> pd.Timestamp:
+    '''
+    Return the failure time (seconds past 00:00, as in data/failures.json) as a datetime on REFERENCE_DATE.
+    '''
+    return REFERENCE_DATE + pd.Timedelta(seconds=seconds_past)
+
+
+def time_of_day_seconds(timestamps: pd.Series) -> np.ndarray:
+    '''
+    Return the time of day of each timestamp as (fractional) seconds past 00:00.
+    '''
+    return ((time_of_day(timestamps) - REFERENCE_DATE) / pd.Timedelta(seconds=1)).to_numpy()
+
+
+# Train vs Test Alignment
+def infer_frequency(timestamps: pd.Series, minimum: str = '1s') -> pd.Timedelta:
+    '''
+    Infer the sampling interval of a series as the median spacing of its timestamps (at least minimum).
+    '''
+    spacing = pd.Series(np.sort(time_of_day(timestamps).to_numpy())).diff().median()
+    if pd.isna(spacing):
+        return pd.Timedelta(minimum)
+
+    return max(pd.Timedelta(spacing).round('1s'), pd.Timedelta(minimum))
+
+
+@profiled('compare')
+def align_series(test: pd.DataFrame,
+                 train: pd.DataFrame,
+                 time_column: str,
+                 value_columns: List[str],
+                 freq: Union[str, pd.Timedelta] = None,
+                 agg: Union[str, Callable] = 'mean') -> pd.DataFrame:
+    '''
+    Resample the test and train days onto a common time-of-day grid, so that they can be compared point by point
+    even when the two series have different lengths or sampling times.
+
+    Both days are aggregated per bucket of freq (inferred from the test series if None) with agg, and reindexed onto the same grid
+    (covering both series), with NaN for buckets without data.
+
+    Return a single dataframe indexed by time of day (see time_of_day()), with '<column>_train', '<column>_test'
+    and '<column>_delta' (test - train) columns for each value column.
+    '''
+    if freq is None:
+        freq = infer_frequency(test[time_column] if len(test) else train[time_column])
+    freq = pd.Timedelta(freq)
+
+    resampled = {}
+    for day, df in [('train', train), ('test', test)]:
+        series = df[value_columns].set_axis(pd.DatetimeIndex(time_of_day(df[time_column])), axis=0)
+        resampled[day] = series.resample(freq).agg(agg)
+
+    # Common grid covering both days
+    bounds = [resampled[day].index for day in resampled if len(resampled[day])]
+    if bounds:
+        grid = pd.date_range(min(index.min() for index in bounds), max(index.max() for index in bounds), freq=freq, name='time_of_day')
+    else:
+        grid = pd.DatetimeIndex([], name='time_of_day')
+
+    aligned = pd.DataFrame(index=grid)
+    for column in value_columns:
+        aligned[f'{column}_train'] = resampled['train'][column].reindex(grid).to_numpy()
+        aligned[f'{column}_test'] = resampled['test'][column].reindex(grid).to_numpy()
+        aligned[f'{column}_delta'] = aligned[f'{column}_test'] - aligned[f'{column}_train']
+
+    return aligned
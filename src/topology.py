@@ -0,0 +1,223 @@
+import pandas as pd
+import numpy as np
+
+from typing import List
+
+from .compute_actual_time import parent_positions
+from .indexes import epoch_ms
+from .profiling import profiled
+
+
+# Service Call Graph / Topology
+# Latency histogram bins (ms) shared by every edge, so that graphs built over different windows can be merged by adding histograms
+# Log-spaced from 1 ms to ~65 s, with an underflow bin for elapsedTime <= 0 (e.g. int16 overflow) and an overflow bin
+LATENCY_BIN_EDGES = np.concatenate([[-np.inf, 1], np.geomspace(2, 2**16, 60), [np.inf]])
+
+
+def read_cmdb(cmdb_filepath: str = "data/cmdb.xlsx") -> pd.DataFrame:
+    '''
+    Read the system structure, where the column "name" is deployed on the column "host".
+
+    The "type" and "number" columns are only filled on the first row of each type, so they are forward filled.
+    '''
+    cmdb = pd.read_excel(cmdb_filepath)
+    cmdb[['type', 'number']] = cmdb[['type', 'number']].ffill()
+
+    return cmdb
+
+
+def _node_labels(trace_df: pd.DataFrame, level: str, cmdb: pd.DataFrame = None) -> pd.Series:
+    '''
+    Return the node of every span: its 'serviceName' or 'cmdb_id', or for level 'host' the host its cmdb_id is deployed on (from cmdb.xlsx).
+    cmdb_ids without a host in cmdb.xlsx are kept as their own host.
+    '''
+    if level in ('serviceName', 'cmdb_id'):
+        return trace_df[level].astype(str)
+
+    if level == 'host':
+        if cmdb is None: cmdb = read_cmdb()
+        hosts = cmdb.dropna(subset=['host']).set_index('name')['host']
+        cmdb_id = trace_df['cmdb_id'].astype(str)
+        return cmdb_id.map(hosts).fillna(cmdb_id)
+
+    raise ValueError(f"level must be one of 'serviceName', 'cmdb_id' or 'host', not {level!r}")
+
+
+class CallGraph:
+    '''
+    Weighted caller -> callee graph, with one edge per (caller, callee, time bucket), stored as compact arrays:
+    - nodes: the node labels, src / dst index into nodes
+    - bucket: start of the time bucket (epoch ms)
+    - calls / errors: number of calls and of failed calls (success == False) on the edge
+    - latency_histogram: (edge x LATENCY_BIN_EDGES bin) counts of the callee's elapsedTime, from which percentiles are derived
+
+    Edges are sorted by (src, dst, bucket), and indptr gives the slice of the edges of every caller (CSR adjacency).
+    Graphs built over different windows of the same day (e.g. chunks of iter_trace()) are combined with merge().
+    '''
+
+    def __init__(self, nodes: pd.Index, src: np.ndarray, dst: np.ndarray, bucket: np.ndarray,
+                 calls: np.ndarray, errors: np.ndarray, latency_histogram: np.ndarray, bucket_ms: int, level: str):
+        self.nodes = pd.Index(nodes)
+        self.bucket_ms = bucket_ms
+        self.level = level
+
+        # Sort the edges by (src, dst, bucket) and build the CSR offsets
+        order = np.lexsort((bucket, dst, src))
+        self.src = src[order].astype(np.int32)
+        self.dst = dst[order].astype(np.int32)
+        self.bucket = bucket[order].astype(np.int64)
+        self.calls = calls[order].astype(np.int64)
+        self.errors = errors[order].astype(np.int64)
+        self.latency_histogram = latency_histogram[order].astype(np.uint32)
+
+        self.indptr = np.zeros(len(self.nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.src, minlength=len(self.nodes)), out=self.indptr[1:])
+
+    def __len__(self) -> int:
+        return len(self.src)
+
+    def callees(self, node: str) -> pd.DataFrame:
+        '''
+        Return the edges (over all time buckets) going out of node.
+        '''
+        code = self.nodes.get_loc(node)
+        return self.edges(rows=slice(self.indptr[code], self.indptr[code + 1]))
+
+    def merge(self, other: 'CallGraph') -> 'CallGraph':
+        '''
+        Return the graph with the calls of both graphs, summing the counts and latency histograms of identical (caller, callee, bucket) edges.
+        '''
+        if (self.bucket_ms, self.level) != (other.bucket_ms, other.level):
+            raise ValueError("Only graphs with the same bucket size and level can be merged")
+
+        nodes = self.nodes.append(other.nodes).unique()
+        remap_self = nodes.get_indexer(self.nodes)
+        remap_other = nodes.get_indexer(other.nodes)
+
+        return _aggregate_edges(nodes,
+                                np.concatenate([remap_self[self.src], remap_other[other.src]]),
+                                np.concatenate([remap_self[self.dst], remap_other[other.dst]]),
+                                np.concatenate([self.bucket, other.bucket]),
+                                np.concatenate([self.calls, other.calls]),
+                                np.concatenate([self.errors, other.errors]),
+                                np.concatenate([self.latency_histogram, other.latency_histogram]),
+                                self.bucket_ms, self.level)
+
+    def percentiles(self, quantiles: List[float] = (0.5, 0.95, 0.99), rows: slice = slice(None)) -> np.ndarray:
+        '''
+        Return the (edge x quantile) latency percentiles of the edges in rows, estimated as the upper edge of the histogram bin holding each quantile.
+        '''
+        cumulative = np.cumsum(self.latency_histogram[rows], axis=1)
+        upper_edges = LATENCY_BIN_EDGES[1:].copy()
+        upper_edges[0] = 0
+
+        result = np.empty((len(cumulative), len(quantiles)))
+        for i, quantile in enumerate(quantiles):
+            target = np.ceil(quantile * self.calls[rows])[:, None]
+            result[:, i] = upper_edges[np.argmax(cumulative >= target, axis=1)]
+
+        return result
+
+    def edges(self, quantiles: List[float] = (0.5, 0.95, 0.99), rows: slice = slice(None)) -> pd.DataFrame:
+        '''
+        Return the edges in rows (all of them by default) as a dataframe with caller, callee, bucket (Asia/Singapore), calls, errors,
+        error_rate and latency percentiles, indexed by edge position.
+        Only the arrays of the sliced edges are converted, so a slice of indptr costs the size of the slice, not of the graph.
+        '''
+        calls, errors = self.calls[rows], self.errors[rows]
+        edges = pd.DataFrame({
+            'caller': self.nodes[self.src[rows]],
+            'callee': self.nodes[self.dst[rows]],
+            'bucket': pd.to_datetime(self.bucket[rows], unit='ms', utc=True).tz_convert('Asia/Singapore'),
+            'calls': calls,
+            'errors': errors,
+            'error_rate': errors / np.maximum(calls, 1),
+        }, index=pd.RangeIndex(len(self))[rows])
+
+        for quantile, values in zip(quantiles, self.percentiles(quantiles, rows).T):
+            edges[f'p{int(round(quantile * 100))}'] = values
+
+        return edges
+
+    def totals(self) -> pd.DataFrame:
+        '''
+        Return the edges aggregated over all time buckets.
+        '''
+        return self.edges().groupby(['caller', 'callee'], sort=False).agg(calls=('calls', 'sum'), errors=('errors', 'sum')).assign(
+            error_rate=lambda df: df.errors / df.calls).reset_index()
+
+
+def _edge_keys(src: np.ndarray, dst: np.ndarray, bucket: np.ndarray, n_nodes: int, bucket_ms: int) -> tuple:
+    '''
+    Intern every (src, dst, bucket) row into a dense edge code, via a single int64 key (faster than np.unique over rows).
+
+    Return the (src, dst, bucket) of every edge, and the edge code of every row.
+    '''
+    first_bucket = bucket.min() if len(bucket) else 0
+    bucket_index = (bucket - first_bucket) // bucket_ms
+    n_buckets = int(bucket_index.max()) + 1 if len(bucket) else 1
+
+    keys = (src.astype(np.int64) * n_nodes + dst) * n_buckets + bucket_index
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+
+    edge_bucket = unique_keys % n_buckets * bucket_ms + first_bucket
+    edge_pair = unique_keys // n_buckets
+
+    return edge_pair // n_nodes, edge_pair % n_nodes, edge_bucket, inverse.ravel()
+
+
+def _aggregate_edges(nodes: pd.Index, src: np.ndarray, dst: np.ndarray, bucket: np.ndarray,
+                     calls: np.ndarray, errors: np.ndarray, latency_histogram: np.ndarray, bucket_ms: int, level: str) -> CallGraph:
+    '''
+    Sum the calls, errors and latency histograms of identical (src, dst, bucket) edges into a CallGraph.
+    '''
+    edge_src, edge_dst, edge_bucket, inverse = _edge_keys(src, dst, bucket, len(nodes), bucket_ms)
+    n_edges = len(edge_src)
+
+    summed_histogram = np.zeros((n_edges, latency_histogram.shape[1]), dtype=np.int64)
+    np.add.at(summed_histogram, inverse, latency_histogram)
+
+    return CallGraph(nodes, edge_src, edge_dst, edge_bucket,
+                     np.bincount(inverse, weights=calls, minlength=n_edges),
+                     np.bincount(inverse, weights=errors, minlength=n_edges),
+                     summed_histogram, bucket_ms, level)
+
+
+@profiled('compute')
+def build_call_graph(trace_df: pd.DataFrame,
+                     level: str = 'cmdb_id',
+                     bucket: str = '1min',
+                     cmdb: pd.DataFrame = None) -> CallGraph:
+    '''
+    Build the caller -> callee graph of a trace dataframe (read_trace(), iter_trace() chunks or compact_trace() output) in one vectorized pass.
+
+    Every span with a parent in the dataframe is a call from the parent's node to the span's node, at the span's startTime bucket.
+    The node is the span's 'serviceName', 'cmdb_id' (service instance), or 'host' (the host the cmdb_id is deployed on, from cmdb.xlsx).
+
+    Parents are only resolved within trace_df, so for incremental builds pass whole traces (e.g. time windows) and merge() the graphs.
+    '''
+    bucket_ms = int(pd.Timedelta(bucket) / pd.Timedelta(milliseconds=1))
+
+    parent = parent_positions(trace_df)
+    child = np.flatnonzero(parent >= 0)
+    parent = parent[child]
+
+    node_codes, nodes = pd.factorize(_node_labels(trace_df, level, cmdb))
+    nodes = pd.Index(nodes)
+
+    start_ms = epoch_ms(trace_df['startTime'])[child]
+    elapsed = trace_df['elapsedTime'].to_numpy(dtype=np.int64)[child]
+    failed = ~trace_df['success'].to_numpy(dtype=bool)[child]
+
+    edge_src, edge_dst, edge_bucket, inverse = _edge_keys(node_codes[parent], node_codes[child], start_ms - start_ms % bucket_ms, len(nodes), bucket_ms)
+    n_edges = len(edge_src)
+    n_bins = len(LATENCY_BIN_EDGES) - 1
+
+    # Count the calls, errors and latency histogram bin of every edge with np.bincount
+    latency_bin = np.searchsorted(LATENCY_BIN_EDGES, elapsed, side='right') - 1
+    latency_histogram = np.bincount(inverse * n_bins + latency_bin, minlength=n_edges * n_bins).reshape(n_edges, n_bins)
+
+    return CallGraph(nodes, edge_src, edge_dst, edge_bucket,
+                     np.bincount(inverse, minlength=n_edges),
+                     np.bincount(inverse, weights=failed, minlength=n_edges),
+                     latency_histogram, bucket_ms, level)
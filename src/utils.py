@@ -1,18 +1,144 @@
 import pandas as pd
 import numpy as np
 import glob
+import hashlib
+import json
+import os
+import time
 
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List, Tuple, Union
+
+from .indexes import TraceIndex, epoch_ms
+from .profiling import profiled
+
+
+# Multi-file Ingestion
+def _read_csv_timed(file: str, dtype: dict) -> Tuple[pd.DataFrame, float]:
+    """
+    Read a single CSV file and return it together with the time taken (in seconds).
+
+    Defined at module level so that it can be pickled and sent to the worker processes.
+    """
+    start = time.perf_counter()
+    df = pd.read_csv(file, dtype=dtype)
+
+    return df, time.perf_counter() - start
+
+
+def _concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate the dataframes of each file, keeping 'category' dtypes.
+
+    pd.concat falls back to object dtype when the categories of each file differ (e.g. different cmdb_id in each file),
+    so every category column is first set to the union of the categories across all files.
+    """
+    if not frames:
+        return pd.DataFrame()
+
+    category_columns = [column for column, dtype in frames[0].dtypes.items() if isinstance(dtype, pd.CategoricalDtype)]
+
+    for column in category_columns:
+        # Index.append (rather than union_categoricals) tolerates files where the categories are inferred with different dtypes
+        categories = frames[0][column].cat.categories.append([frame[column].cat.categories for frame in frames[1:]]).unique()
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _read_csv_files(files: List[str], dtype: dict, workers: int = 1, verbose: bool = False) -> pd.DataFrame:
+    """
+    Read all the files into a single dataframe, parsing them concurrently in a process pool if workers > 1.
+
+    The time taken to parse each file is stored in df.attrs['file_timings'] (and printed if verbose).
+    """
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            results = list(executor.map(_read_csv_timed, files, [dtype] * len(files)))
+    else:
+        results = [_read_csv_timed(file, dtype) for file in files]
+
+    file_timings = {file: seconds for file, (_, seconds) in zip(files, results)}
+
+    if verbose:
+        for file, seconds in file_timings.items():
+            print("Parsed %s in %.2f seconds" % (file, seconds))
+
+    df = _concat_frames([frame for frame, _ in results])
+    df.attrs['file_timings'] = file_timings
+
+    return df
+
+
+# Columnar On-Disk Cache
+# The cache is keyed on the source file paths, sizes and mtimes (plus the reader options), so any change to the CSVs invalidates it
+CACHE_DIR = "data/.cache"
+
+
+def _cache_path(kind: str, files: List[str], options: dict, cache_dir: str = CACHE_DIR) -> str:
+    """
+    Return the path of the cached copy for the given source files and reader options.
+    """
+    file_stats = []
+    for file in sorted(files):
+        stat = os.stat(file)
+        file_stats.append([os.path.abspath(file), stat.st_size, stat.st_mtime_ns])
+
+    key = hashlib.sha1(json.dumps([kind, options, file_stats], default=str).encode()).hexdigest()[:16]
+
+    return os.path.join(cache_dir, f"{kind}-{key}.feather")
+
+
+def _read_cached(kind: str, 
+                 files: List[str], 
+                 options: dict, 
+                 loader: Callable[[], pd.DataFrame], 
+                 cache_dir: str = CACHE_DIR) -> pd.DataFrame:
+    """
+    Load the typed columnar (Feather/Arrow IPC) copy of the source files if it exists, otherwise run the loader and write the copy.
+
+    The copy keeps the dtype mappings, category columns and timezone-aware timestamps of the loader output, and is written uncompressed
+    so that later loads skip both CSV parsing and timezone conversion.
+
+    Note that the loaded dataframe is a full in-memory copy: the file is memory-mapped, so Arrow reads it without a heap copy of its own,
+    but to_pandas() converts every column into the numpy-backed category and datetime64 dtypes the rest of the code expects.
+    """
+    try:
+        from pyarrow import feather
+    except ImportError as e:
+        raise ImportError("cache=True requires pyarrow to be installed (pip install pyarrow)") from e
+
+    path = _cache_path(kind, files, options, cache_dir)
+
+    if os.path.exists(path):
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    df = loader()
+
+    # Write to a temporary file first, so that an interrupted write never leaves a corrupted cache behind
+    os.makedirs(cache_dir, exist_ok=True)
+    feather.write_feather(df, path + ".tmp", compression='uncompressed')
+    os.replace(path + ".tmp", path)
+
+    return df
 
 
 # Read Host Data
+@profiled('reader')
 def read_host(prefix_path: str = "test_data", 
               filename_pattern: str = "*", 
-              verbose: bool = False) -> pd.DataFrame:
+              verbose: bool = False,
+              cache: bool = False,
+              workers: int = 1) -> pd.DataFrame:
     """
     Using the filename pattern specified (e.g. 'os_linux' or '*'), read all the host data into a single dataframe.
 
     dtype mapping is specified to reduce memory usage.
+
+    If cache is True, a typed columnar copy is written to CACHE_DIR on first load and read back without CSV parsing on later loads (requires pyarrow).
+
+    If workers > 1, the files are parsed concurrently in a process pool of that size.
     """
     # For test_data, the memory usage is maintained at around 52.5+ MB.
     host_dtype_mapping = {
@@ -25,13 +151,22 @@ def read_host(prefix_path: str = "test_data",
     }
 
     host_pattern = f"data/{prefix_path}/host/{filename_pattern}.csv"
+    host_files = glob.glob(host_pattern)
 
-    # Combine all the files into 1 dataframe
-    host_df = pd.concat([pd.read_csv(file, dtype=host_dtype_mapping) for file in glob.glob(host_pattern)], ignore_index=True)
+    def load() -> pd.DataFrame:
+        # Combine all the files into 1 dataframe
+        host_df = _read_csv_files(host_files, host_dtype_mapping, workers, verbose)
 
-    # Convert timestamps to datetime64[ns, Asia/Singapore] via vectorized operation
-    # For test_data, no change in memory (52.5+ MB)
-    host_df['timestamp'] = pd.to_datetime(host_df['timestamp'], unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+        # Convert timestamps to datetime64[ns, Asia/Singapore] via vectorized operation
+        # For test_data, no change in memory (52.5+ MB)
+        host_df['timestamp'] = pd.to_datetime(host_df['timestamp'], unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+
+        return host_df
+
+    if cache:
+        host_df = _read_cached("host", host_files, {'dtype': host_dtype_mapping}, load)
+    else:
+        host_df = load()
 
     if verbose:
         print("The host dataframe has %s rows and %s columns" % host_df.shape)
@@ -42,14 +177,9 @@ def read_host(prefix_path: str = "test_data",
 
 
 # Read Trace Data
-def read_trace(prefix_path: str = "test_data", 
-              filename_pattern: str = "*", 
-              verbose: bool = False,
-              test_data: bool = False) -> pd.DataFrame:
+def _trace_dtype_mapping(test_data: bool = False) -> dict:
     """
-    Using the filename pattern specified (e.g. 'trace_fly_remote' or '*'), read all the trace data into a single dataframe.
-
-    dtype mapping is specified to reduce memory usage.
+    dtype mapping of the trace CSVs, shared by read_trace() and iter_trace().
     """
     # For test_data, the memory usage reduces from 1.5+ GB (default) to 1.4+ GB
     trace_dtype_mapping = {
@@ -67,17 +197,203 @@ def read_trace(prefix_path: str = "test_data",
     # If data is test_data, add msgTime column (Note that train_data does not have msgTime column)
     if test_data: trace_dtype_mapping.update({'msgTime': np.uint64}) 
 
-    trace_data_pattern = f"data/{prefix_path}/trace/{filename_pattern}.csv"
+    return trace_dtype_mapping
+
+
+def has_msg_time(prefix_path: str = "test_data", filename_pattern: str = "*") -> bool:
+    """
+    Whether the trace CSVs of a day have the msgTime column, i.e. the test_data flag to read them with (only test_data has msgTime).
+    """
+    trace_files = glob.glob(f"data/{prefix_path}/trace/{filename_pattern}.csv")
 
-    # Combine all the files into 1 dataframe
-    trace_df = pd.concat([pd.read_csv(file, dtype=trace_dtype_mapping) for file in glob.glob(trace_data_pattern)], ignore_index=True)
+    return bool(trace_files) and 'msgTime' in pd.read_csv(trace_files[0], nrows=0).columns
 
+
+def _convert_trace_columns(trace_df: pd.DataFrame, test_data: bool = False) -> pd.DataFrame:
+    """
+    Convert the raw trace columns, shared by read_trace() and iter_trace().
+    """
     # Convert timestamps to datetime64[ns, Asia/Singapore] via vectorized operation
     # For test_data, no noticeable change in memory (1.4+ GB)
     trace_df.elapsedTime = trace_df.elapsedTime.astype(np.int16)
     trace_df.startTime = pd.to_datetime(trace_df.startTime, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
     if test_data: trace_df.msgTime = pd.to_datetime(trace_df.msgTime, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
 
+    # Root spans have pid "None", which read_csv parses as a missing value (pandas >= 2.0), so the string is restored for the pid == 'None' filters
+    if trace_df.pid.isna().any():
+        if isinstance(trace_df.pid.dtype, pd.CategoricalDtype) and 'None' not in trace_df.pid.cat.categories:
+            trace_df['pid'] = trace_df.pid.cat.add_categories('None')
+        trace_df['pid'] = trace_df.pid.fillna('None')
+
+    return trace_df
+
+
+@profiled('reader')
+def read_trace(prefix_path: str = "test_data", 
+              filename_pattern: str = "*", 
+              verbose: bool = False,
+              test_data: bool = False,
+              cache: bool = False,
+              workers: int = 1,
+              compact: bool = False) -> pd.DataFrame:
+    """
+    Using the filename pattern specified (e.g. 'trace_fly_remote' or '*'), read all the trace data into a single dataframe.
+
+    dtype mapping is specified to reduce memory usage.
+
+    If cache is True, a typed columnar copy is written to CACHE_DIR on first load and read back without CSV parsing on later loads (requires pyarrow).
+
+    If workers > 1, the files are parsed concurrently in a process pool of that size.
+
+    If compact is True, the compact representation of compact_trace() is returned instead.
+    """
+    trace_dtype_mapping = _trace_dtype_mapping(test_data)
+
+    trace_data_pattern = f"data/{prefix_path}/trace/{filename_pattern}.csv"
+    trace_files = glob.glob(trace_data_pattern)
+
+    def load() -> pd.DataFrame:
+        # Combine all the files into 1 dataframe
+        trace_df = _read_csv_files(trace_files, trace_dtype_mapping, workers, verbose)
+
+        return _convert_trace_columns(trace_df, test_data)
+
+    if cache:
+        trace_df = _read_cached("trace", trace_files, {'dtype': trace_dtype_mapping}, load)
+    else:
+        trace_df = load()
+
+    if compact:
+        trace_df = compact_trace(trace_df)
+
+    if verbose:
+        print("The trace dataframe has %s rows and %s columns" % trace_df.shape)
+        print("\nSummary info of trace dataframe:")
+        trace_df.info()
+
+    return trace_df
+
+
+# Compact Trace Storage
+@profiled('compute')
+def compact_trace(trace_df: pd.DataFrame, keep_ids: bool = False) -> pd.DataFrame:
+    """
+    Convert the output of read_trace() into a compact representation:
+    - 'id' is interned into 'span', a dense integer key (the row position in the compact dataframe)
+    - 'pid' is resolved into 'parent', the span key of the parent (-1 for roots, so the "None" string sentinel goes away)
+    - 'startTime' (and 'msgTime') are stored as int64 epoch milliseconds, see trace_datetime() for timezone-aware views
+
+    Since 'parent' refers to span keys rather than row positions, it remains valid on any subset of the compact dataframe.
+    The string span ids are dropped unless keep_ids is True, as 'id' (object) and 'pid' (high-cardinality category) dominate the memory usage.
+    """
+    from .compute_actual_time import parent_positions
+
+    key_dtype = np.int32 if len(trace_df) < np.iinfo(np.int32).max else np.int64
+
+    compact_df = trace_df.drop(columns=[column for column in ['id', 'pid'] if column in trace_df.columns and not keep_ids])
+    compact_df = compact_df.reset_index(drop=True)
+
+    compact_df['span'] = np.arange(len(trace_df), dtype=key_dtype)
+    compact_df['parent'] = parent_positions(trace_df).astype(key_dtype)
+
+    for column in ['startTime', 'msgTime']:
+        if column in compact_df.columns and isinstance(compact_df[column].dtype, pd.DatetimeTZDtype):
+            compact_df[column] = epoch_ms(compact_df[column])
+
+    return compact_df
+
+
+def trace_datetime(trace_df: pd.DataFrame, column: str = 'startTime') -> pd.Series:
+    """
+    Return a timezone-aware (Asia/Singapore) view of a timestamp column, for both read_trace() and compact_trace() dataframes.
+
+    The conversion is only paid for the rows of the (usually filtered) dataframe that is passed in.
+    """
+    timestamps = trace_df[column]
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        return timestamps
+
+    return pd.to_datetime(timestamps, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+
+
+# Stream Trace Data
+def window_to_ms(day: str, seconds_past: int, interval: float) -> Tuple[int, int]:
+    """
+    Convert a failure time (seconds past 00:00 of the day, as in data/failures.json) and a range (in seconds) around it
+    into a [start, end] window of raw startTime values (epoch milliseconds), for use with iter_trace().
+
+    The day (e.g. '2020-05-30') is interpreted in Asia/Singapore time, like the rest of the readers.
+    """
+    midnight_ms = pd.Timestamp(day, tz='Asia/Singapore').value // 10**6
+    failure_ms = midnight_ms + int(seconds_past * 1000)
+
+    return int(failure_ms - interval * 1000 / 2), int(failure_ms + interval * 1000 / 2)
+
+
+def iter_trace(prefix_path: str = "test_data", 
+               filename_pattern: str = "*", 
+               start_time: int = None,
+               end_time: int = None,
+               cmdb_id: Union[str, List[str]] = None,
+               serviceName: Union[str, List[str]] = None,
+               roots_only: bool = False,
+               test_data: bool = False,
+               chunksize: int = 1_000_000) -> Iterator[pd.DataFrame]:
+    """
+    Streaming counterpart of read_trace(): read the trace CSVs in chunks and yield only the rows matching the predicates.
+
+    start_time and end_time (inclusive) are compared against the raw startTime (epoch milliseconds) before the datetime conversion,
+    so that rows outside the window are dropped before any conversion cost is paid. See window_to_ms() to build the window.
+
+    cmdb_id and serviceName accept a single value or a list of values. If roots_only is True, only parent rows (pid == "None") are kept.
+
+    Peak memory is bounded by chunksize, regardless of the size of the trace data.
+    """
+    trace_dtype_mapping = _trace_dtype_mapping(test_data)
+
+    # Filter on the raw strings, and only convert the matching rows to 'category'
+    category_columns = [column for column, dtype in trace_dtype_mapping.items() if dtype == 'category']
+    chunk_dtype_mapping = {column: (str if dtype == 'category' else dtype) for column, dtype in trace_dtype_mapping.items()}
+
+    if isinstance(cmdb_id, str): cmdb_id = [cmdb_id]
+    if isinstance(serviceName, str): serviceName = [serviceName]
+
+    trace_data_pattern = f"data/{prefix_path}/trace/{filename_pattern}.csv"
+
+    for file in glob.glob(trace_data_pattern):
+        for chunk in pd.read_csv(file, dtype=chunk_dtype_mapping, chunksize=chunksize):
+            mask = np.ones(len(chunk), dtype=bool)
+
+            if start_time is not None: mask &= (chunk.startTime >= start_time).to_numpy()
+            if end_time is not None: mask &= (chunk.startTime <= end_time).to_numpy()
+            if cmdb_id is not None: mask &= chunk.cmdb_id.isin(cmdb_id).to_numpy()
+            if serviceName is not None: mask &= chunk.serviceName.isin(serviceName).to_numpy()
+            # Note that pandas >= 2.0 parses the "None" string as NaN by default
+            if roots_only: mask &= ((chunk.pid == "None") | chunk.pid.isna()).to_numpy()
+
+            if not mask.any():
+                continue
+
+            chunk = chunk[mask]
+
+            # Only the matching rows are converted to the read_trace() dtypes
+            chunk = chunk.astype({column: 'category' for column in category_columns})
+
+            yield _convert_trace_columns(chunk, test_data)
+
+
+@profiled('reader')
+def read_trace_window(prefix_path: str = "test_data", 
+                      filename_pattern: str = "*", 
+                      verbose: bool = False,
+                      **kwargs) -> pd.DataFrame:
+    """
+    Read only the trace rows matching the predicates of iter_trace() (e.g. a time window around a failure) into a single dataframe.
+
+    The output has the same columns and dtypes as read_trace().
+    """
+    trace_df = _concat_frames(list(iter_trace(prefix_path, filename_pattern, **kwargs)))
+
     if verbose:
         print("The trace dataframe has %s rows and %s columns" % trace_df.shape)
         print("\nSummary info of trace dataframe:")
@@ -87,11 +403,16 @@ def read_trace(prefix_path: str = "test_data",
 
 
 # Read ESB Data
-def read_esb(esb_filepath, verbose=False):
+@profiled('reader')
+def read_esb(esb_filepath, verbose=False, cache=False, workers=1):
     """
     Using the filepath specified, read the ESB data into a single dataframe.
 
     dtype mapping is specified to reduce memory usage.
+
+    If cache is True, a typed columnar copy is written to CACHE_DIR on first load and read back without CSV parsing on later loads (requires pyarrow).
+
+    If workers > 1, the files are parsed concurrently in a process pool of that size.
     """
     # For test_data, the memory usage reduces from 33.9+ KB (default) to 20.5 KB
     esb_dtype_mapping = {
@@ -103,36 +424,47 @@ def read_esb(esb_filepath, verbose=False):
         'succee_rate': np.float64,
     }
 
-    # Combine all the files into 1 dataframe
-    esb_df = pd.concat([pd.read_csv(file, dtype=esb_dtype_mapping) for file in glob.glob(esb_filepath)], ignore_index=True)
+    esb_files = glob.glob(esb_filepath)
 
-    # Convert timestamps to datetime64[ns, Asia/Singapore] via vectorized operation
-    # For test_data, no noticeable change in memory (20.5 KB)
-    esb_df.startTime = pd.to_datetime(esb_df.startTime, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+    def load() -> pd.DataFrame:
+        # Combine all the files into 1 dataframe
+        esb_df = _read_csv_files(esb_files, esb_dtype_mapping, workers, verbose)
 
-    if verbose:
-        print("The ESB dataframe has %s rows and %s columns" % esb_df.shape)
-        print("Summary info of ESB dataframe:\n" + esb_df.info())
-        esb_df.head(5)
+        # Convert timestamps to datetime64[ns, Asia/Singapore] via vectorized operation
+        # For test_data, no noticeable change in memory (20.5 KB)
+        esb_df.startTime = pd.to_datetime(esb_df.startTime, unit='ms', utc=True).dt.tz_convert('Asia/Singapore')
+
+        return esb_df
 
+    if cache:
+        esb_df = _read_cached("esb", esb_files, {'dtype': esb_dtype_mapping}, load)
+    else:
+        esb_df = load()
+
+    if verbose:
+        # info() prints the summary itself (and returns None), so it cannot be concatenated to the header
         print("The ESB dataframe has %s rows and %s columns" % esb_df.shape)
         print("\nSummary info of ESB dataframe:")
         esb_df.info()
-        
+
     return esb_df
 
 
 # Calculate Trace Length
-def trace_length(df: pd.DataFrame, trace_list: List[str]) -> List[int]:
+@profiled('compute')
+def trace_length(df: pd.DataFrame, trace_list: List[str], index: TraceIndex = None) -> List[int]:
     """
     Query the dataframe to obtain each trace and return their length.
 
     This is helpful to determine if the failure resulted in a longer (e.g. calling alternative services for error handling) 
     or shorter (e.g. skipping certain calls through error handling) trace.
+
+    If a TraceIndex of the dataframe is given, the lengths are looked up from the index instead of scanning the dataframe.
     """
-    trace_length_list = []
+    if index is not None:
+        return index.lengths(trace_list).tolist()
 
-    for trace in trace_list:
-        trace_length_list.append(len(df[df.traceId == trace]))
+    # Count the spans of all the traces in a single pass, instead of filtering the dataframe once per trace
+    counts = df.traceId[df.traceId.isin(trace_list)].value_counts()
 
-    return trace_length_list
\ No newline at end of file
+    return [int(counts.get(trace, 0)) for trace in trace_list]
\ No newline at end of file
@@ -0,0 +1,123 @@
+import pandas as pd
+import numpy as np
+
+from src.compute_actual_time import (avg_actual_time, build_dictionary_graph, compare_trace_childrens, compare_trace_childrens_failure4,
+                                     compute_actual_time, compute_actual_time_vectorized)
+from src.indexes import TimeIndex, TraceIndex
+
+
+def _tree_frame() -> pd.DataFrame:
+    # Two traces with nested and sibling spans, with children listed before their parents
+    rows = [
+        ('t1', 't1-2', 't1-1', 300), ('t1', 't1-1', 't1-0', 700), ('t1', 't1-3', 't1-1', 250), ('t1', 't1-0', 'None', 1000),
+        ('t2', 't2-0', 'None', 900), ('t2', 't2-1', 't2-0', 400), ('t2', 't2-2', 't2-0', 350), ('t2', 't2-3', 't2-2', 350),
+    ]
+
+    return pd.DataFrame(rows, columns=['traceId', 'id', 'pid', 'elapsedTime'])
+
+
+def test_compute_actual_time_vectorized_matches_iterrows():
+    elapsed_time_dict, children_dict = build_dictionary_graph(_tree_frame())
+    expected = compute_actual_time(_tree_frame(), elapsed_time_dict, children_dict)
+    result = compute_actual_time_vectorized(_tree_frame())
+
+    np.testing.assert_array_equal(result.actual_time.to_numpy(dtype=np.int64), expected.actual_time.to_numpy(dtype=np.int64))
+    np.testing.assert_array_equal(result.actual_time.to_numpy(dtype=np.int64), [300, 150, 250, 300, 150, 400, 0, 350])
+
+
+def _trace_frame() -> pd.DataFrame:
+    # Three 3-span traces (OSB -> CSF -> JDBC) on 2020-05-31; the JDBC span of trace a2 starts after the window around 00:10:00
+    day_start = pd.Timestamp('2020-05-31', tz='Asia/Singapore')
+    rows = []
+    for trace_id, start_seconds, child_offset, csf_elapsed in [('a1', 590, 1, 3000), ('a2', 595, 30, 2500), ('b1', 600, 1, 3500)]:
+        start = day_start + pd.Timedelta(seconds=start_seconds)
+        rows += [
+            {'traceId': trace_id, 'id': f'{trace_id}-0', 'pid': 'None', 'startTime': start, 'elapsedTime': 5000,
+             'cmdb_id': 'os_021', 'serviceName': 'osb_001', 'dsName': None, 'callType': 'OSB', 'success': True},
+            {'traceId': trace_id, 'id': f'{trace_id}-1', 'pid': f'{trace_id}-0', 'startTime': start, 'elapsedTime': csf_elapsed,
+             'cmdb_id': 'docker_001', 'serviceName': 'csf_001', 'dsName': None, 'callType': 'CSF', 'success': True},
+            {'traceId': trace_id, 'id': f'{trace_id}-2', 'pid': f'{trace_id}-1', 'startTime': start + pd.Timedelta(seconds=child_offset),
+             'elapsedTime': 1000, 'cmdb_id': 'docker_001', 'serviceName': 'db_003', 'dsName': 'db_003', 'callType': 'JDBC', 'success': True},
+        ]
+
+    return pd.DataFrame(rows)
+
+
+def test_compare_trace_childrens_bootstrap_is_reproducible():
+    trace = _trace_frame()
+    roots = trace[trace.pid == 'None']
+
+    def compare(seed: int) -> pd.DataFrame:
+        return compare_trace_childrens(trace, trace, roots, roots, lambda df: df.elapsedTime > 4000, lambda df: df.elapsedTime > 4000,
+                                       sample=2, seed=seed, n_bootstrap=200)
+
+    first, second = compare(7), compare(7)
+
+    pd.testing.assert_frame_equal(first, second)
+    assert first.attrs['n_bootstrap'] == second.attrs['n_bootstrap'] == 200
+    assert (first.difference_high > first.difference_low).any()
+
+
+def _compare(with_index: bool) -> pd.DataFrame:
+    test_trace, train_trace = _trace_frame(), _trace_frame()
+    test_time_index, train_time_index = TimeIndex(test_trace, 'startTime'), TimeIndex(train_trace, 'startTime')
+    test_filtered, train_filtered = test_time_index.around(600, 30), train_time_index.around(600, 30)
+
+    return compare_trace_childrens(test_filtered, train_filtered,
+                                   test_filtered[test_filtered.pid == 'None'], train_filtered[train_filtered.pid == 'None'],
+                                   lambda df: df.elapsedTime > 4000, lambda df: df.elapsedTime > 4000, seed=0, n_bootstrap=10,
+                                   test_index=TraceIndex(test_trace) if with_index else None,
+                                   train_index=TraceIndex(train_trace) if with_index else None)
+
+
+def test_compare_trace_childrens_index_matches_no_index():
+    without_index, with_index = _compare(False), _compare(True)
+
+    pd.testing.assert_frame_equal(without_index[['unique_identifier', 'train_actual_time', 'test_actual_time', 'difference']].reset_index(drop=True),
+                                  with_index[['unique_identifier', 'train_actual_time', 'test_actual_time', 'difference']].reset_index(drop=True))
+
+
+def test_avg_actual_time_index_matches_no_index():
+    trace = _trace_frame()
+    filtered = TimeIndex(trace, 'startTime').around(600, 30)
+    sample_trace = ['a1', 'a2', 'b1']
+
+    expected = avg_actual_time(filtered, sample_trace)
+    result = avg_actual_time(filtered, sample_trace, TraceIndex(trace))
+
+    pd.testing.assert_frame_equal(expected, result)
+    # The JDBC span of a2 is outside the window, so only a1 and b1 contribute to it
+    assert np.isclose(result.set_index('unique_identifier').actual_time['docker_001:db_003:db_003'], 2 * 1000 / 3)
+
+
+def test_compare_trace_childrens_identifiers_on_one_side_are_nan():
+    test_trace = _trace_frame()
+    train_trace = test_trace[test_trace.serviceName != 'db_003']
+
+    result = compare_trace_childrens(test_trace, train_trace, test_trace[test_trace.pid == 'None'], train_trace[train_trace.pid == 'None'],
+                                     lambda df: df.elapsedTime > 4000, lambda df: df.elapsedTime > 4000, seed=0, n_bootstrap=50)
+    result = result.set_index('unique_identifier')
+
+    jdbc = result.loc['docker_001:db_003:db_003']
+    assert np.isclose(jdbc.test_actual_time, 1000) and np.isnan(jdbc.train_actual_time)
+    assert jdbc[['difference', 'difference_low', 'difference_high']].isna().all()
+    assert result.drop(index='docker_001:db_003:db_003').notna().all().all()
+
+
+def _root_frame(day: str, spans) -> pd.DataFrame:
+    # Single-span traces from (start time of day, elapsedTime) pairs
+    day_start = pd.Timestamp(day, tz='Asia/Singapore')
+    return pd.DataFrame([{'traceId': f't{number}', 'id': f't{number}-0', 'pid': 'None', 'startTime': day_start + pd.Timedelta(start),
+                          'elapsedTime': elapsed, 'cmdb_id': 'os_021', 'serviceName': 'osb_001', 'dsName': None}
+                         for number, (start, elapsed) in enumerate(spans)])
+
+
+def test_compare_trace_childrens_failure4_uses_the_day_of_the_data():
+    # The erroneous calls (04:29 - 04:30 of the test day) average 3000 ms
+    test_trace = _root_frame('2020-05-31', [('04:29:30', 3000), ('10:00:00', 1000), ('10:00:01', 5000)])
+    train_trace = _root_frame('2020-05-04', [('10:00:00', 3500), ('10:00:01', 4000), ('10:00:02', 9000)])
+
+    result = compare_trace_childrens_failure4(test_trace, train_trace, test_trace, train_trace, seed=0, n_bootstrap=10)
+
+    assert result.attrs['n_test_traces'] == 1 and result.attrs['n_train_traces'] == 2
+    assert np.isclose(result.set_index('unique_identifier').difference['os_021:osb_001:nan'], 3750 - 1000)
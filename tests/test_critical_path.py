@@ -0,0 +1,36 @@
+import pandas as pd
+
+from src.critical_path import critical_path
+
+
+def _tree_frame() -> pd.DataFrame:
+    # r -> (a, b), b -> (c, d): b ends last under r and d ends last under b, so the path is r -> b -> d
+    # The second trace (s -> e) is below min_elapsed
+    day_start = pd.Timestamp('2020-05-31', tz='Asia/Singapore')
+    rows = [
+        ('t1', 'r', 'None', 0, 1000), ('t1', 'a', 'r', 0, 300), ('t1', 'b', 'r', 100, 800),
+        ('t1', 'c', 'b', 100, 200), ('t1', 'd', 'b', 400, 450),
+        ('t2', 's', 'None', 0, 500), ('t2', 'e', 's', 0, 400),
+    ]
+    df = pd.DataFrame(rows, columns=['traceId', 'id', 'pid', 'start', 'elapsedTime'])
+    df['startTime'] = day_start + pd.to_timedelta(df.pop('start'), unit='ms')
+
+    return df
+
+
+def test_critical_path_on_hand_built_tree():
+    df = critical_path(_tree_frame(), min_elapsed=600).set_index('id')
+
+    assert df.on_critical_path.to_dict() == {'r': True, 'a': False, 'b': True, 'c': False, 'd': True, 's': False, 'e': False}
+    assert df.critical_depth[['r', 'b', 'd']].tolist() == [0, 1, 2]
+    assert df.critical_time[['r', 'b', 'd']].tolist() == [200, 350, 450]
+    assert df.critical_time[['a', 'c', 's', 'e']].tolist() == [0, 0, 0, 0]
+    assert df.critical_root[['r', 'b', 'd']].tolist() == [0, 0, 0]
+
+
+def test_critical_path_walks_every_trace_without_min_elapsed():
+    df = critical_path(_tree_frame()).set_index('id')
+
+    assert df.on_critical_path[['s', 'e']].tolist() == [True, True]
+    assert df.critical_root[['s', 'e']].tolist() == [5, 5]
+    assert df.critical_time[['s', 'e']].tolist() == [100, 400]
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from src.downsample import lttb_indices
+
+
+def _reference_lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    # Bucket by bucket, as in the LTTB paper
+    n = len(x)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected, previous = [0], 0
+    for bucket in range(n_out - 2):
+        following = slice(edges[bucket + 1], edges[bucket + 2] if bucket + 2 < len(edges) else n)
+        average_x, average_y = x[following].mean(), y[following].mean()
+        candidates = range(edges[bucket], edges[bucket + 1])
+        areas = [abs((x[previous] - average_x) * (y[i] - y[previous]) - (x[previous] - x[i]) * (average_y - y[previous])) for i in candidates]
+        previous = candidates[int(np.argmax(areas))]
+        selected.append(previous)
+
+    return np.array(selected + [n - 1])
+
+
+@pytest.mark.parametrize('n, n_out', [(10, 3), (10, 9), (1000, 7), (5000, 333)])
+def test_lttb_indices_matches_reference(n, n_out):
+    rng = np.random.default_rng(n_out)
+    x = np.sort(rng.integers(0, 10**6, n)).astype(np.float64)
+    y = rng.normal(size=n).cumsum()
+
+    np.testing.assert_array_equal(lttb_indices(x, y, n_out), _reference_lttb(x, y, n_out))
+
+
+def test_lttb_indices_drops_nan():
+    x = np.arange(20, dtype=np.float64)
+    y = np.sin(x)
+    y[[3, 11]] = np.nan
+
+    keep = lttb_indices(x, y, 5)
+    assert len(keep) == 5 and not np.isnan(y[keep]).any()
+    assert keep[0] == 0 and keep[-1] == 19
@@ -0,0 +1,66 @@
+import pandas as pd
+import numpy as np
+
+from src.error_origin import error_origin_counts, error_origins, span_depths
+
+
+def _chain_frame() -> pd.DataFrame:
+    # t1: r -> a -> b -> c failed, a -> d succeeded, r -> e failed; the error surfaces at r and originates at c (the deepest)
+    # t2: s succeeded -> f -> g failed; the error surfaces at f and originates at g
+    day_start = pd.Timestamp('2020-05-31', tz='Asia/Singapore')
+    rows = [
+        ('t1', 'r', 'None', False), ('t1', 'a', 'r', False), ('t1', 'b', 'a', False), ('t1', 'c', 'b', False),
+        ('t1', 'd', 'a', True), ('t1', 'e', 'r', False),
+        ('t2', 's', 'None', True), ('t2', 'f', 's', False), ('t2', 'g', 'f', False),
+    ]
+    df = pd.DataFrame(rows, columns=['traceId', 'id', 'pid', 'success'])
+    df['startTime'] = day_start + pd.to_timedelta(range(len(df)), unit='ms')
+
+    return df
+
+
+def test_error_origins_on_failed_chains():
+    df = error_origins(_chain_frame())
+    ids = df.id.tolist()
+    origin = {span: (ids[position] if position >= 0 else None) for span, position in zip(ids, df.error_origin)}
+
+    assert origin == {'r': 'c', 'a': 'c', 'b': 'c', 'c': 'c', 'd': None, 'e': 'e', 's': None, 'f': 'g', 'g': 'g'}
+    assert df.error_depth.tolist() == [0, 1, 2, 3, 2, 1, 0, 1, 2]
+    assert df.id[df.error_surface].tolist() == ['r', 'f']
+
+
+def test_span_depths_matches_walking_up_the_parents():
+    rng = np.random.default_rng(0)
+    # Random forest: the parent of every span is one of the spans before it, or missing
+    parent = np.array([rng.integers(-1, position) if position else -1 for position in range(2000)])
+
+    expected = np.zeros(len(parent), dtype=np.int32)
+    for position in range(len(parent)):
+        ancestor = parent[position]
+        while ancestor >= 0:
+            expected[position] += 1
+            ancestor = parent[ancestor]
+
+    np.testing.assert_array_equal(span_depths(parent), expected)
+
+
+def test_span_depths_stops_on_cycles():
+    # 0 -> 1 -> 2 -> 0 is a cycle, 3 hangs below it and 4 -> 5 is a chain to a root
+    parent = np.array([2, 0, 1, 2, 5, -1])
+
+    np.testing.assert_array_equal(span_depths(parent), [0, 0, 0, 0, 1, 0])
+
+
+def test_error_origin_counts_buckets_the_chain_on_its_surface():
+    # The failed chain r -> a -> b surfaces at r (00:00:59.9) and originates at b, whose span starts in the following minute
+    day_start = pd.Timestamp('2020-05-31', tz='Asia/Singapore')
+    df = pd.DataFrame({'traceId': 't1', 'id': ['r', 'a', 'b'], 'pid': ['None', 'r', 'a'], 'success': False,
+                       'startTime': day_start + pd.to_timedelta([59_900, 59_950, 60_100], unit='ms'),
+                       'cmdb_id': ['os_021', 'docker_001', 'db_003'], 'serviceName': ['osb_001', 'csf_001', 'db_003'],
+                       'callType': ['OSB', 'CSF', 'JDBC']})
+
+    counts = error_origin_counts(df, '1min')
+
+    assert len(counts) == 1
+    assert counts.loc[0, ['cmdb_id', 'errors', 'failed_spans', 'surfaced_at']].tolist() == ['db_003', 1, 3, 'os_021']
+    assert counts.loc[0, 'bucket'] == day_start
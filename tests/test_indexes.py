@@ -0,0 +1,61 @@
+import pandas as pd
+import numpy as np
+
+from src.indexes import TimeIndex, TraceIndex
+
+
+def _trace_frame() -> pd.DataFrame:
+    # Interleaved traces, one with its root listed last, one with two roots and one without a root
+    rows = [
+        ('t1', 't1-1', 't1-0'), ('t2', 't2-0', 'None'), ('t1', 't1-2', 't1-1'), ('t3', 't3-1', 't3-0'),
+        ('t2', 't2-1', 't2-0'), ('t1', 't1-0', 'None'), ('t2', 't2-9', 'None'), ('t3', 't3-2', 't3-1'),
+    ]
+    df = pd.DataFrame(rows, columns=['traceId', 'id', 'pid'])
+    df['traceId'] = df.traceId.astype('category')
+    df.index = df.index * 10
+
+    return df
+
+
+def test_trace_index_matches_boolean_masks():
+    df = _trace_frame()
+    index = TraceIndex(df)
+    trace_list = ['t2', 'missing', 't1', 't3']
+
+    for trace_id in trace_list:
+        mask = df.traceId == trace_id
+        assert index.length(trace_id) == mask.sum()
+        pd.testing.assert_frame_equal(index.trace(trace_id), df[mask])
+        pd.testing.assert_frame_equal(index.root(trace_id), df[mask & (df.pid == 'None')].head(1))
+
+    np.testing.assert_array_equal(index.lengths(trace_list), [(df.traceId == trace_id).sum() for trace_id in trace_list])
+    np.testing.assert_array_equal(index.positions(trace_list), np.concatenate([np.flatnonzero(df.traceId == trace_id) for trace_id in trace_list]))
+    pd.testing.assert_frame_equal(index.roots(trace_list),
+                                  pd.concat([df[(df.traceId == trace_id) & (df.pid == 'None')].head(1) for trace_id in trace_list]))
+
+
+def _host_frame() -> pd.DataFrame:
+    # Interleaved KPI series, one of which has a null name
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'cmdb_id': rng.choice(['os_021', 'os_022'], 200), 'name': rng.choice(['CPU', 'Memory', None], 200),
+                       'timestamp': rng.integers(0, 60_000, 200)})
+    df['cmdb_id'] = df.cmdb_id.astype('category')
+
+    return df
+
+
+def test_time_index_matches_boolean_masks():
+    df = _host_frame()
+    index = TimeIndex(df, 'timestamp', ['cmdb_id', 'name'])
+    in_window = (df.timestamp >= 10_000) & (df.timestamp <= 30_000)
+
+    positions = index.positions(10_000, 30_000)
+    np.testing.assert_array_equal(np.sort(positions), np.flatnonzero(in_window))
+    assert np.all(np.diff(df.timestamp.to_numpy()[positions]) >= 0)
+
+    for key, mask in [(('os_021', 'CPU'), df.name == 'CPU'), (('os_022', None), df.name.isna()), (('os_022', np.nan), df.name.isna())]:
+        mask &= in_window & (df.cmdb_id == key[0])
+        np.testing.assert_array_equal(np.sort(index.positions(10_000, 30_000, key)), np.flatnonzero(mask))
+        assert mask.any()
+
+    assert len(index.positions(10_000, 30_000, ('os_023', 'CPU'))) == 0
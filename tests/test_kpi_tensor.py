@@ -0,0 +1,20 @@
+import pandas as pd
+import numpy as np
+
+from src.kpi_tensor import build_kpi_tensor
+
+
+def test_build_kpi_tensor_matches_groupby_mean_in_blocks():
+    rng = np.random.default_rng(0)
+    n = 2000
+    host = pd.DataFrame({'cmdb_id': rng.choice(['os_021', 'os_022', 'db_003'], n), 'name': rng.choice(['CPU', 'Memory', 'Disk'], n),
+                         'timestamp': pd.Timestamp('2020-05-30', tz='Asia/Singapore') + pd.to_timedelta(rng.integers(0, 3600, n), unit='s'),
+                         'value': np.where(rng.random(n) < 0.1, np.nan, rng.normal(size=n))})
+
+    # A budget of a single series per block
+    tensor = build_kpi_tensor(host, '1min', memory_budget=1)
+
+    expected = host.groupby(['cmdb_id', 'name', host.timestamp.dt.floor('1min')]).value.mean()
+    for (cmdb_id, name, bucket), value in expected.items():
+        np.testing.assert_allclose(tensor.kpi(cmdb_id, name)[bucket], value, rtol=1e-6, equal_nan=True)
+    assert len(tensor) == len(expected.index.droplevel(2).unique())
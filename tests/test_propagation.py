@@ -0,0 +1,11 @@
+import pandas as pd
+import pytest
+
+from src.propagation import failure_series
+
+
+def test_failure_series_without_any_source_raises():
+    with pytest.raises(ValueError):
+        failure_series(600)
+    with pytest.raises(ValueError):
+        failure_series(600, test_host=pd.DataFrame({'timestamp': pd.Series([], dtype='datetime64[ns, Asia/Singapore]')}))
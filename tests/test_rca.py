@@ -0,0 +1,28 @@
+import pandas as pd
+import numpy as np
+
+from src.rca import rank_root_causes, score_esb
+
+
+def _esb_frame(day: str, avg_time: np.ndarray, succee_rate: np.ndarray) -> pd.DataFrame:
+    # One ESB row per minute of osb_001, from 00:00
+    start = pd.Timestamp(day, tz='Asia/Singapore')
+    return pd.DataFrame({'serviceName': pd.Categorical(['osb_001'] * len(avg_time)),
+                         'startTime': start + pd.to_timedelta(np.arange(len(avg_time)), unit='min'),
+                         'avg_time': avg_time, 'num': 100, 'succee_num': (succee_rate * 100).astype(int), 'succee_rate': succee_rate})
+
+
+def test_score_esb_flags_the_shifted_column():
+    rng = np.random.default_rng(0)
+    train_esb = _esb_frame('2020-05-04', 0.3 + rng.normal(0, 0.01, 120), np.ones(120) - rng.uniform(0, 0.01, 120))
+    avg_time = 0.3 + rng.normal(0, 0.01, 120)
+    avg_time[55:65] += 1.0
+    test_esb = _esb_frame('2020-05-30', avg_time, np.ones(120) - rng.uniform(0, 0.01, 120))
+
+    scores = score_esb(test_esb, train_esb, 3600, window=600).set_index('name')
+    assert scores.loc['avg_time', 'score'] > 10 > scores.loc['succee_rate', 'score']
+    assert (scores.cmdb_id == 'osb_001').all() and (scores.source == 'esb').all()
+
+    host = pd.DataFrame({'cmdb_id': 'os_021', 'name': 'CPU', 'timestamp': test_esb.startTime, 'value': 1.0})
+    ranking = rank_root_causes(3600, host, host.assign(timestamp=train_esb.startTime), test_esb=test_esb, train_esb=train_esb, window=600)
+    assert ranking.iloc[0][['source', 'cmdb_id', 'name']].tolist() == ['esb', 'osb_001', 'avg_time']
@@ -0,0 +1,46 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+from src.baseline import BaselineProfile
+from src.streaming import merge_profiles, replay, samples
+
+
+def test_samples_skip_empty_fields():
+    host_row = {'itemid': '1', 'name': 'CPU', 'bomc_id': 'ZJ-001', 'timestamp': '1590768000000', 'value': '', 'cmdb_id': 'os_021'}
+    esb_row = {'serviceName': 'osb_001', 'startTime': '1590768000000', 'avg_time': '0.5', 'num': '10', 'succee_num': '', 'succee_rate': ''}
+
+    assert list(samples('host', host_row)) == []
+    assert list(samples('host', dict(host_row, timestamp='', value='1.5'))) == []
+    assert list(samples('esb', esb_row)) == [(('osb_001', 'avg_time'), 1590768000000, 0.5)]
+
+
+def test_replay_merges_chunked_files_in_timestamp_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data' / 'day' / 'host').mkdir(parents=True)
+
+    # One file in timestamp order (streamed in chunks), one out of order (sorted whole), and a row without a timestamp
+    timestamps = np.arange(0, 60_000 * 10, 60_000) + 1590768000000
+    pd.DataFrame({'itemid': 1, 'name': 'CPU', 'bomc_id': 'ZJ-001', 'timestamp': timestamps, 'value': np.arange(10.0), 'cmdb_id': 'os_021'}) \
+        .to_csv(tmp_path / 'data' / 'day' / 'host' / 'os_linux.csv', index=False)
+    pd.DataFrame({'serviceName': 'osb_001', 'startTime': pd.array(list(timestamps[::-1] + 30_000) + [None], dtype='Int64'), 'avg_time': 1.0, 'num': 1,
+                  'succee_num': 1, 'succee_rate': 1.0}).to_csv(tmp_path / 'data' / 'day' / 'esb.csv', index=False)
+
+    rows = list(replay('day', chunksize=3))
+
+    assert len(rows) == 20
+    assert [source for source, _ in rows] == ['host', 'esb'] * 10
+    assert [int(row['timestamp' if source == 'host' else 'startTime']) for source, row in rows] == sorted(list(timestamps) + list(timestamps + 30_000))
+
+
+def test_merge_profiles_requires_the_same_buckets_and_statistics():
+    host = BaselineProfile([('os_021', 'CPU')], ['cmdb_id', 'name'], ['median', 'mad'], np.zeros((1, 24, 2), dtype=np.float32), 3600)
+    esb = BaselineProfile([('osb_001', 'avg_time')], ['serviceName', 'column'], ['median', 'mad'], np.ones((1, 24, 2), dtype=np.float32), 3600)
+
+    merged = merge_profiles([host, esb])
+    assert merged.keys == [('os_021', 'CPU'), ('osb_001', 'avg_time')] and merged.values.shape == (2, 24, 2)
+
+    with pytest.raises(ValueError):
+        merge_profiles([host, BaselineProfile(esb.keys, esb.key_names, esb.stats, np.ones((1, 48, 2), dtype=np.float32), 1800)])
+    with pytest.raises(ValueError):
+        merge_profiles([host, BaselineProfile(esb.keys, esb.key_names, ['median', 'std'], esb.values, 3600)])
@@ -0,0 +1,27 @@
+import pandas as pd
+import numpy as np
+
+from src.topology import build_call_graph
+
+
+def _trace_frame(n_traces: int = 50, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for trace in range(n_traces):
+        start = 1590768000000 + int(rng.integers(0, 3_600_000))
+        rows.append((f't{trace}', f'{trace}-0', 'None', 'os_021', start, int(rng.integers(1, 500)), True))
+        for span in range(1, 6):
+            rows.append((f't{trace}', f'{trace}-{span}', f'{trace}-{int(rng.integers(0, span))}', str(rng.choice(['docker_001', 'docker_002', 'db_003'])),
+                         start + span, int(rng.integers(1, 500)), bool(rng.random() < 0.9)))
+
+    return pd.DataFrame(rows, columns=['traceId', 'id', 'pid', 'cmdb_id', 'startTime', 'elapsedTime', 'success'])
+
+
+def test_callees_matches_slice_of_edges():
+    graph = build_call_graph(_trace_frame(), level='cmdb_id')
+    edges = graph.edges()
+
+    for node in graph.nodes:
+        callees = graph.callees(node)
+        pd.testing.assert_frame_equal(callees, edges[edges.caller == node])
+        assert (callees.caller == node).all()
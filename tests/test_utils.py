@@ -0,0 +1,86 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+from src.utils import compact_trace, read_trace, read_trace_window, trace_datetime
+
+
+def _trace_rows() -> pd.DataFrame:
+    # Two traces per file, 1 s apart, on os_021 and os_022
+    day_start_ms = int(pd.Timestamp('2020-05-31', tz='Asia/Singapore').timestamp() * 1000)
+    rows = []
+    for trace_number in range(4):
+        trace_id, start = f't{trace_number}', day_start_ms + trace_number * 1000
+        host = 'os_021' if trace_number % 2 else 'os_022'
+        rows += [
+            {'callType': 'OSB', 'startTime': start, 'elapsedTime': 900, 'success': True, 'traceId': trace_id, 'id': f'{trace_id}-0',
+             'pid': 'None', 'cmdb_id': host, 'serviceName': 'osb_001', 'dsName': None},
+            {'callType': 'JDBC', 'startTime': start + 10, 'elapsedTime': 300, 'success': trace_number != 2, 'traceId': trace_id,
+             'id': f'{trace_id}-1', 'pid': f'{trace_id}-0', 'cmdb_id': 'docker_001', 'serviceName': 'db_003', 'dsName': 'db_003'},
+        ]
+
+    return pd.DataFrame(rows)
+
+
+@pytest.fixture
+def trace_data(tmp_path, monkeypatch):
+    # The readers resolve data/<prefix_path>/trace/*.csv against the working directory
+    monkeypatch.chdir(tmp_path)
+    trace_directory = tmp_path / 'data' / 'test_data' / 'trace'
+    trace_directory.mkdir(parents=True)
+
+    rows = _trace_rows()
+    rows.iloc[:4].to_csv(trace_directory / 'trace_a.csv', index=False)
+    rows.iloc[4:].to_csv(trace_directory / 'trace_b.csv', index=False)
+
+    return rows
+
+
+def _normalized(df: pd.DataFrame) -> pd.DataFrame:
+    # Categories depend on the rows that were read, so values are compared as objects
+    df = df.astype({column: object for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)})
+    return df.sort_values('id').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('predicates', [
+    {},
+    {'cmdb_id': 'os_021'},
+    {'serviceName': ['db_003'], 'start_time_offset': 1000, 'end_time_offset': 2010},
+    {'roots_only': True, 'end_time_offset': 2000},
+])
+def test_iter_trace_pushdown_matches_read_and_filter(trace_data, predicates):
+    predicates = dict(predicates)
+    day_start_ms = int(trace_data.startTime.min())
+    if 'start_time_offset' in predicates: predicates['start_time'] = day_start_ms + predicates.pop('start_time_offset')
+    if 'end_time_offset' in predicates: predicates['end_time'] = day_start_ms + predicates.pop('end_time_offset')
+
+    trace = read_trace('test_data')
+    start_ms = (trace.startTime - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+
+    mask = np.ones(len(trace), dtype=bool)
+    if 'start_time' in predicates: mask &= start_ms >= predicates['start_time']
+    if 'end_time' in predicates: mask &= start_ms <= predicates['end_time']
+    if 'cmdb_id' in predicates: mask &= trace.cmdb_id.isin([predicates['cmdb_id']])
+    if 'serviceName' in predicates: mask &= trace.serviceName.isin(predicates['serviceName'])
+    if predicates.get('roots_only'): mask &= (trace.pid == 'None') | trace.pid.isna()
+
+    result = read_trace_window('test_data', chunksize=3, **predicates)
+
+    pd.testing.assert_frame_equal(_normalized(result), _normalized(trace[mask]))
+
+
+def test_compact_trace_round_trip(trace_data):
+    trace = read_trace('test_data')
+    compact = compact_trace(trace, keep_ids=True)
+
+    # Parent keys resolve back to the pids, and roots get a parent of -1
+    parent = compact.parent.to_numpy()
+    is_root = ((trace.pid == 'None') | trace.pid.isna()).to_numpy()
+    np.testing.assert_array_equal(parent < 0, is_root)
+    np.testing.assert_array_equal(compact.id.to_numpy(dtype=object)[parent[~is_root]], trace.pid.astype(object).to_numpy()[~is_root])
+    np.testing.assert_array_equal(compact.span.to_numpy(), np.arange(len(trace)))
+
+    # Timestamps convert back to the read_trace() datetimes, and the other columns are unchanged
+    pd.testing.assert_series_equal(trace_datetime(compact), trace.startTime.reset_index(drop=True))
+    for column in ['traceId', 'elapsedTime', 'success', 'cmdb_id', 'serviceName']:
+        pd.testing.assert_series_equal(compact[column], trace[column].reset_index(drop=True))